@@ -62,12 +62,19 @@ def main():
 
     sweeps = schemas[ns.schema]
 
+    # ADM find the bricks touching each sweep up front (rather than
+    # ADM testing every brick in every sweep), and hand out the sweeps
+    # ADM with the most bricks first, so a few big ones don't finish last.
+    sweepbricks = sweep_bricks(sweeps, bricks)
+    order = np.argsort([-len(I) for I in sweepbricks], kind='stable')
+    sweeps = [(sweeps[i], sweepbricks[i]) for i in order]
+
     t0 = time()
 
     nbricks_tot = np.zeros((), 'i8')
     nobj_tot = np.zeros((), 'i8')
 
-    def work(sweep):
+    def work(sweep, ibricks):
         # ADM the general format for a sweeps file.
         template = "sweep-%(ramin)s%(decmin)s-%(ramax)s%(decmax)s.%(format)s"
         def formatdec(dec):
@@ -97,7 +104,11 @@ def main():
                 print("won't overwrite files related to {}".format(filename))
                 return filename, 0, 0
 
-        data, header, nbricks = make_sweep(sweep, bricks, ns, ALL_DTYPE=ALL_DTYPE)
+        # ADM first pass: find the rows of each brick that go in this
+        # ADM sweep, reading only the columns needed to select them.
+        selected, header = select_sweep_rows(sweep, [bricks[i] for i in ibricks], ns)
+        nbricks = len(selected)
+        nobj = sum([len(rows) for _, rows in selected])
 
         header.update({
             'RAMIN'  : sweep[0],
@@ -106,6 +117,18 @@ def main():
             'DECMAX' : sweep[3],
             })
 
+        # ADM the columns to always include to form a unique ID.
+        uniqid = [dt for dt in SWEEP_DTYPE.descr if
+                  dt[0]=="RELEASE" or dt[0]=="BRICKID" or dt[0]=="OBJID"]
+        # ADM write out separate sweeps for:
+        # ADM    the SWEEP_DTYPE columns (without light-curves).
+        sweepdt = [dt for dt in SWEEP_DTYPE.descr if 'LC' not in dt[0]]
+        # ADM    the SWEEP_DTYPE columns (just light-curves).
+        lcdt = uniqid + [dt for dt in SWEEP_DTYPE.descr if 'LC' in dt[0]]
+        # ADM    the remaining "extra" columns.
+        alldt = uniqid + [dt for dt in ALL_DTYPE.descr if dt[0] not in SWEEP_DTYPE.names]
+
+        writers = []
         for format in ns.format:
             filename = template %  \
                 dict(ramin=formatra(sweep[0]),
@@ -113,29 +136,25 @@ def main():
                      ramax=formatra(sweep[2]),
                      decmax=formatdec(sweep[3]),
                      format=format)
+            if nobj == 0:
+                continue
+            for dt, odn, end in zip([sweepdt, lcdt, alldt], outdirnames, ender):
+                fn = filename.replace(".fits", end)
+                dest = os.path.join(ns.dest, odn, fn)
+                if len(dt) > 0:
+                    writers.append(SweepWriter(dest, np.dtype(dt), header,
+                                               format, unitdict=unitdict))
 
-            if len(data) > 0:
-                # ADM the columns to always include to form a unique ID.
-                uniqid = [dt for dt in SWEEP_DTYPE.descr if
-                          dt[0]=="RELEASE" or dt[0]=="BRICKID" or dt[0]=="OBJID"]
-                # ADM write out separate sweeps for:
-                # ADM    the SWEEP_DTYPE columns (without light-curves).
-                sweepdt = [dt for dt in SWEEP_DTYPE.descr if 'LC' not in dt[0]]
-                # ADM    the SWEEP_DTYPE columns (just light-curves).
-                lcdt = uniqid + [dt for dt in SWEEP_DTYPE.descr if 'LC' in dt[0]]
-                # ADM    the remaining "extra" columns.
-                alldt = uniqid + [dt for dt in ALL_DTYPE.descr if dt[0] not in SWEEP_DTYPE.names]
-                for dt, odn, end in zip([sweepdt, lcdt, alldt], outdirnames, ender):
-                    fn = filename.replace(".fits", end)
-                    dest = os.path.join(ns.dest, odn, fn)
-                    if len(dt) > 0:
-                        newdata = np.empty(len(data), dtype=dt)
-                        for col in newdata.dtype.names:
-                            newdata[col] = data[col]
-                        save_sweep_file(dest, newdata,
-                                        header, format, unitdict=unitdict)
-
-        return filename, nbricks, len(data)
+        # ADM second pass: read the selected rows, a bounded number at a
+        # ADM time, and append them to each of the output files.
+        if len(writers):
+            for chunk in iter_sweep_chunks(selected, ns, ALL_DTYPE):
+                for w in writers:
+                    w.append(chunk)
+            for w in writers:
+                w.close()
+
+        return filename, nbricks, nobj
 
     def reduce(filename, nbricks, nobj):
         nbricks_tot[...] += nbricks
@@ -151,7 +170,7 @@ def main():
             )
 
     with sharedmem.MapReduce(np=ns.numproc) as pool:
-        pool.map(work, sweeps, reduce=reduce)
+        pool.map(work, sweeps, reduce=reduce, star=True)
 
 
 def list_bricks(ns):
@@ -216,121 +235,192 @@ def sweep_schema_blocks(nra, ndec):
 
     return [(ra[i], dec[j], ra[i+1], dec[j+1]) for i in range(len(ra) - 1) for j in range(len(dec) - 1)]
 
+def sweep_bricks(sweeps, bricks, tol=0.1):
+    """Returns, for each sweep, the indices of the bricks whose regions
+    intersect it (as in :func:`intersect`, vectorized over bricks)."""
+    regions = np.array([region for _, _, region in bricks], dtype='f8').reshape(-1, 4)
+    r1, d1, r2, d2 = [regions[:, i] for i in range(4)]
+    result = []
+    for sweep in sweeps:
+        dx = np.minimum(sweep[2], r2) - np.maximum(sweep[0], r1)
+        dy = np.minimum(sweep[3], d2) - np.maximum(sweep[1], d1)
+        # ADM both regions are padded by tol on every side.
+        result.append(np.flatnonzero((dx + 2*tol > 0) & (dy + 2*tol > 0)))
+    return result
+
 class NA: pass
 
-def make_sweep(sweep, bricks, ns, ALL_DTYPE=None):
-    data = [np.empty(0, dtype=ALL_DTYPE)]
-    header = {}
+def merge_header(header, header2):
+    for key, value in header2.items():
+        if key not in header:
+            header[key] = value
+        else:
+            if header[key] is NA:
+                pass
+            else:
+                if header[key] != value:
+                    header[key] = NA
+
+# ADM the columns needed to decide which rows go in a sweep.
+SELECT_COLUMNS = ['BRICK_PRIMARY', 'RA', 'DEC']
+
+def select_sweep_rows(sweep, bricks, ns):
+    """Returns ([(filename, rows), ...], header) for the BRICK_PRIMARY
+    objects of the given bricks that lie within the sweep, reading only
+    the columns needed to select them, and the merged header of the
+    bricks."""
     ra1, dec1, ra2, dec2 = sweep
-    def merge_header(header, header2):
-        for key, value in header2.items():
-            if key not in header:
-                header[key] = value
+    selected = []
+    header = {}
+    for brickname, filename, region in bricks:
+        if not intersect(sweep, region):
+            continue
+        try:
+            with fitsio.FITS(filename) as ff:
+                chunkheader = ff[0].read_header()
+                objects = ff[1].read(columns=SELECT_COLUMNS, upper=True)
+        except:
+            if ns.ignore_errors:
+                print('IO error on %s' % filename)
+                continue
             else:
-                if header[key] is NA:
-                    pass
-                else:
-                    if header[key] != value:
-                        header[key] = NA
-
-    with sharedmem.MapReduce(np=0) as pool:
-        def filter(brickname, filename, region):
-            if not intersect(sweep, region):
-                return None, None
-            try:
-                objects = fitsio.read(filename, 1, upper=True)
-                chunkheader = fitsio.read_header(filename, 0)
-            except:
-                if ns.ignore_errors:
-                    print('IO error on %s' % filename)
-                    return None, None
-                else:
-                    raise
-            # ADM check all the column dtypes match.
-            if not ns.ignore_errors:
-                sflds = SWEEP_DTYPE.fields
-                tflds = objects.dtype.fields
-                for fld in sflds:
-                    sdt, tdt = sflds[fld][0], tflds[fld][0]
-                    # ADM handle the case where str_ type is converted
-                    # ADM to bytes_ type by fitsio versions < 1.
-                    if sdt.char=="S" and tdt.char=='U':
-                        sdt = '<U{}'.format(sdt.itemsize)
-                    if sdt != tdt:
-                        msg = 'sweeps/Tractor dtypes differ for field '
-                        msg += '{}. Sweeps: {}, Tractor: {}'.format(fld, sdt, tdt)
-                        raise ValueError(msg)
-
-            mask = objects['BRICK_PRIMARY'] != 0
-            objects = objects[mask]
-            mask = objects['RA'] >= ra1
-            mask &= objects['RA'] < ra2
-            mask &= objects['DEC'] >= dec1
-            mask &= objects['DEC'] < dec2
-            objects = objects[mask]
-
-            chunk = np.empty(len(objects), dtype=ALL_DTYPE)
-
-            for colname in chunk.dtype.names:
-                if colname not in objects.dtype.names:
-                    # skip missing columns
-                    continue
-                try:
-                    chunk[colname][...] = objects[colname][...]
-                except ValueError:
-                    print('failed on column `%s`' % colname)
-                    raise
-            chunkheader = dict([(key, chunkheader[key]) for key in chunkheader.keys()])
-            return chunk, chunkheader
-
-        def reduce(chunk, chunkheader):
-            if chunk is not None:
-                data.append(chunk)
-                merge_header(header, chunkheader)
-        pool.map(filter, bricks, star=True, reduce=reduce)
-
-    neff = len(data) - 1
-
-    data = np.concatenate(data, axis=0)
+                raise
+        mask = objects['BRICK_PRIMARY'] != 0
+        mask &= objects['RA'] >= ra1
+        mask &= objects['RA'] < ra2
+        mask &= objects['DEC'] >= dec1
+        mask &= objects['DEC'] < dec2
+        selected.append((filename, np.flatnonzero(mask)))
+        merge_header(header, dict([(key, chunkheader[key])
+                                   for key in chunkheader.keys()]))
     header = dict([(key, value) for key, value in header.items() if value is not NA])
-    return data, header, neff
-
-
-def save_sweep_file(filename, data, header, format, unitdict=None):
-    # ADM leave the root header unchanged.
-    hdr = header.copy()
-    if format == 'fits':
-        units = None
-        # ADM derive the units from the data columns if possible.
-        if unitdict is not None:
-            units = [unitdict[col] for col in data.dtype.names]
-
-        # ADM add the sweep code version header dependency.
-        dep = [int(key.split("DEPNAM")[-1]) for key in hdr.keys()
-               if 'DEPNAM' in key]
-        if len(dep) == 0:
-            nextdep = 0
+    return selected, header
+
+def read_sweep_rows(filename, rows, ns, ALL_DTYPE):
+    """Reads the given rows of a Tractor file, and only the columns in
+    ALL_DTYPE, into an array of dtype ALL_DTYPE.  Returns None on an IO
+    error if ns.ignore_errors is set."""
+    try:
+        with fitsio.FITS(filename) as ff:
+            colnames = [col for col in ff[1].get_colnames()
+                        if col.upper() in ALL_DTYPE.names]
+            objects = ff[1].read(columns=colnames, rows=rows, upper=True)
+    except:
+        if ns.ignore_errors:
+            print('IO error on %s' % filename)
+            return None
         else:
-            nextdep = np.max(dep) + 1
-        hdr["DEPNAM{:02d}".format(nextdep)] = 'gen_sweep'
-        hdr["DEPVER{:02d}".format(nextdep)] = git_version()
-
-        hdr = [dict(name=key, value=hdr[key]) for key in sorted(hdr.keys())]
-        # ADM write atomically, to a .tmp file, for extra safety.
-        with fitsio.FITS(filename+".tmp", mode='rw', clobber=True) as ff:
-            ff.create_image_hdu()
-            ff[0].write_keys(hdr)
-            ff.write_table(data, extname='SWEEP', units=units)
-        os.rename(filename+'.tmp', filename)
-
-    elif format == 'hdf5':
-        import h5py
-        with h5py.File(filename, 'w') as ff:
-            dset = ff.create_dataset('SWEEP', data=data)
+            raise
+    # ADM check all the column dtypes match.
+    if not ns.ignore_errors:
+        sflds = SWEEP_DTYPE.fields
+        tflds = objects.dtype.fields
+        for fld in sflds:
+            sdt, tdt = sflds[fld][0], tflds[fld][0]
+            # ADM handle the case where str_ type is converted
+            # ADM to bytes_ type by fitsio versions < 1.
+            if sdt.char=="S" and tdt.char=='U':
+                sdt = '<U{}'.format(sdt.itemsize)
+            if sdt != tdt:
+                msg = 'sweeps/Tractor dtypes differ for field '
+                msg += '{}. Sweeps: {}, Tractor: {}'.format(fld, sdt, tdt)
+                raise ValueError(msg)
+
+    chunk = np.empty(len(objects), dtype=ALL_DTYPE)
+    for colname in chunk.dtype.names:
+        if colname not in objects.dtype.names:
+            # skip missing columns
+            continue
+        try:
+            chunk[colname][...] = objects[colname][...]
+        except ValueError:
+            print('failed on column `%s`' % colname)
+            raise
+    return chunk
+
+def iter_sweep_chunks(selected, ns, ALL_DTYPE):
+    """Yields the selected rows as ALL_DTYPE arrays of about
+    ns.chunk_rows rows (whole bricks at a time), so that memory use is
+    bounded however large the sweep is."""
+    pending = []
+    npending = 0
+    for filename, rows in selected:
+        if len(rows) == 0:
+            continue
+        chunk = read_sweep_rows(filename, rows, ns, ALL_DTYPE)
+        if chunk is None:
+            continue
+        pending.append(chunk)
+        npending += len(chunk)
+        if npending >= ns.chunk_rows:
+            yield np.concatenate(pending, axis=0)
+            pending = []
+            npending = 0
+    if npending > 0:
+        yield np.concatenate(pending, axis=0)
+
+class SweepWriter(object):
+    """Writes a sweep file incrementally: the header is written when the
+    file is created, and rows (with the columns of *dtype*) are
+    appended with :meth:`append`.  FITS files are written to a .tmp
+    file and renamed into place by :meth:`close`."""
+    def __init__(self, filename, dtype, header, format, unitdict=None):
+        self.filename = filename
+        self.dtype = dtype
+        self.format = format
+        self.nrows = 0
+        # ADM leave the root header unchanged.
+        hdr = header.copy()
+        if format == 'fits':
+            self.units = None
+            # ADM derive the units from the data columns if possible.
+            if unitdict is not None:
+                self.units = [unitdict[col] for col in dtype.names]
+
+            # ADM add the sweep code version header dependency.
+            dep = [int(key.split("DEPNAM")[-1]) for key in hdr.keys()
+                   if 'DEPNAM' in key]
+            if len(dep) == 0:
+                nextdep = 0
+            else:
+                nextdep = np.max(dep) + 1
+            hdr["DEPNAM{:02d}".format(nextdep)] = 'gen_sweep'
+            hdr["DEPVER{:02d}".format(nextdep)] = git_version()
+
+            hdr = [dict(name=key, value=hdr[key]) for key in sorted(hdr.keys())]
+            # ADM write atomically, to a .tmp file, for extra safety.
+            self.ff = fitsio.FITS(filename+".tmp", mode='rw', clobber=True)
+            self.ff.create_image_hdu()
+            self.ff[0].write_keys(hdr)
+
+        elif format == 'hdf5':
+            import h5py
+            self.ff = h5py.File(filename, 'w')
+            self.dset = self.ff.create_dataset('SWEEP', shape=(0,), maxshape=(None,),
+                                               dtype=dtype)
             for key in hdr:
-                dset.attrs[key] = hdr[key]
-    else:
-        raise ValueError("Unknown format")
+                self.dset.attrs[key] = hdr[key]
+        else:
+            raise ValueError("Unknown format")
+
+    def append(self, chunk):
+        data = np.empty(len(chunk), dtype=self.dtype)
+        for col in data.dtype.names:
+            data[col] = chunk[col]
+        if self.format == 'fits':
+            if self.nrows == 0:
+                self.ff.write_table(data, extname='SWEEP', units=self.units)
+            else:
+                self.ff['SWEEP'].append(data)
+        else:
+            self.dset.resize((self.nrows + len(data),))
+            self.dset[self.nrows:] = data
+        self.nrows += len(data)
+
+    def close(self):
+        self.ff.close()
+        if self.format == 'fits':
+            os.rename(self.filename+'.tmp', self.filename)
 
 def intersect(region1, region2, tol=0.1):
     #  ra1, dec1, ra2, dec2 = region1
@@ -610,6 +700,10 @@ def parse_args():
                 If not set, all bricks in src are included, sorted by brickname.
             """)
 
+    ap.add_argument("--chunk-rows", type=int, default=100000,
+        help="""Number of rows to read before appending them to the output files;
+                bounds the memory used per process.""")
+
     ap.add_argument("--numproc", type=int, default=None,
         help="""Number of concurrent processes to use. 0 for sequential execution.
             Default is to use OMP_NUM_THREADS, or the number of cores on the node.""")
@@ -0,0 +1,9 @@
+#! /usr/bin/env python3
+'''
+Summarizes runbrick --telemetry event files; see legacypipe/perf.py.
+'''
+import sys
+from legacypipe.perf import main
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,7 @@ from glob import glob
 from astrometry.util.file import *
 import numpy as np
 from legacypipe.bits import IN_BLOB
+from legacypipe.runbrick import _read_checkpoint, _write_checkpoint
 
 indir = '/global/cscratch1/sd/dstn/dr9.3'
 outdir = '/global/cscratch1/sd/dstn/dr9.3.1'
@@ -10,7 +11,7 @@ fns = glob(os.path.join(indir, 'checkpoints', '*', 'checkpoint-*.pickle'))
 fns.sort()
 for fn in fns:
     outfn = fn.replace(indir, outdir)
-    chk = unpickle_from_file(fn)
+    chk = list(_read_checkpoint(fn))
     print(len(chk), fn, '->', outfn)
     keep = []
     for c in chk:
@@ -22,6 +23,5 @@ for fn in fns:
             #print('Skipping blob with BRIGHT bits')
             continue
         keep.append(c)
-    trymakedirs(outfn, dir=True)
-    pickle_to_file(keep, outfn)
+    _write_checkpoint(keep, outfn)
     print('Wrote', len(keep), 'of', len(chk), 'to', outfn)
@@ -0,0 +1,230 @@
+'''
+A simple model of the CPU time it takes to fit a blob, used to decide
+the order in which blobs are handed out in stage_fitblobs (and by
+farm.py).
+
+The model is log-linear in features that are known before a blob is
+fit:
+
+    log(cpu) = c0 + c1 log(nsrcs) + c2 log(npix) + c3 log(nimages)
+                  + c4 has_ref + c5 has_largegal
+
+where *has_ref* is whether any source in the blob is a reference
+source (Gaia, Tycho-2, SGA), and *has_largegal* whether any is a large
+galaxy; see blob_features, which computes them for both training and
+prediction.  The coefficients can be fit to the per-blob "cpu_blob"
+timings that one_blob records in the tractor catalogs, via
+
+    python -m legacypipe.blobcost --out blobcost.fits tractor/*/tractor-*.fits
+
+and passed to runbrick.py (or farm.py) with --blob-cost-model; without
+a model, blobs are issued in decreasing order of pixel count.
+
+Issuing blobs in decreasing order of predicted cost ("longest
+processing time first") keeps the few huge blobs that dominate a
+brick's wall time from being started last.
+'''
+import sys
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.blobcost')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class BlobCostModel(object):
+    feature_names = ['const', 'log_nsrcs', 'log_npix', 'log_nimages',
+                     'has_ref', 'has_largegal']
+
+    def __init__(self, coeffs):
+        self.coeffs = np.array(coeffs, np.float64)
+        assert(len(self.coeffs) == len(self.feature_names))
+
+    @staticmethod
+    def features(nsrcs, npix, nimages, has_ref, has_largegal):
+        '''
+        Returns the (N x 6) feature matrix for the given arrays.
+        '''
+        nsrcs = np.atleast_1d(nsrcs).astype(np.float64)
+        n = len(nsrcs)
+        X = np.empty((n, 6))
+        X[:,0] = 1.
+        X[:,1] = np.log(np.maximum(nsrcs, 1))
+        X[:,2] = np.log(np.maximum(np.broadcast_to(npix, n), 1))
+        X[:,3] = np.log(np.maximum(np.broadcast_to(nimages, n), 1))
+        X[:,4] = np.broadcast_to(has_ref, n)
+        X[:,5] = np.broadcast_to(has_largegal, n)
+        return X
+
+    def predict(self, nsrcs, npix, nimages, has_ref=False, has_largegal=False):
+        '''
+        Returns the predicted CPU time, in seconds, for each blob.
+        '''
+        X = self.features(nsrcs, npix, nimages, has_ref, has_largegal)
+        return np.exp(X.dot(self.coeffs))
+
+    @classmethod
+    def fit(cls, nsrcs, npix, nimages, has_ref, has_largegal, cpu):
+        '''
+        Least-squares fit of the coefficients to measured CPU times.
+        '''
+        X = cls.features(nsrcs, npix, nimages, has_ref, has_largegal)
+        y = np.log(np.maximum(cpu, 1e-3))
+        coeffs,_,_,_ = np.linalg.lstsq(X, y, rcond=None)
+        return cls(coeffs)
+
+    def write(self, fn):
+        from astrometry.util.fits import fits_table
+        T = fits_table()
+        for name,c in zip(self.feature_names, self.coeffs):
+            T.set(name, np.array([c]))
+        T.writeto(fn)
+
+    @classmethod
+    def read(cls, fn):
+        from astrometry.util.fits import fits_table
+        T = fits_table(fn)
+        return cls([T.get(name)[0] for name in cls.feature_names])
+
+def get_blob_cost_model(fn=None):
+    '''
+    Returns the cost model read from file *fn*, or None (keep the
+    blobs in order of pixel count) if *fn* is None.
+    '''
+    if fn is None:
+        return None
+    info('Reading blob cost model from', fn)
+    return BlobCostModel.read(fn)
+
+def blob_features(srcblob, ref_cat, npix, nimages):
+    '''
+    Returns the cost-model features (nsrcs, npix, nimages, has_ref,
+    has_largegal) of each blob, as arrays that can be passed to
+    BlobCostModel.predict or .fit.  This is used both for training
+    (from tractor catalogs) and for prediction (in runbrick and farm),
+    so that the features are defined the same way.
+
+    *srcblob*: per-source blob index (into *npix* and *nimages*), or -1
+    for none.
+    *ref_cat*: per-source reference catalog name ("G2", "T2", "L3", ...,
+    or blank); large galaxies are the "L" catalogs.
+    *npix*: per-blob number of pixels in the blob.
+    *nimages*: per-blob number of images overlapping the blob's bounding
+    box (see tim_blob_extents).
+    '''
+    npix = np.atleast_1d(npix)
+    nb = len(npix)
+    srcblob = np.atleast_1d(srcblob).astype(int)
+    refcat = np.char.strip(np.atleast_1d(ref_cat).astype(str))
+    I = np.flatnonzero(srcblob >= 0)
+    srcblob = srcblob[I]
+    refcat = refcat[I]
+    nsrcs = np.bincount(srcblob, minlength=nb)
+    has_ref = np.bincount(srcblob, weights=(refcat != ''), minlength=nb) > 0
+    has_largegal = np.bincount(srcblob, weights=np.char.startswith(refcat, 'L'),
+                               minlength=nb) > 0
+    return nsrcs, npix, np.atleast_1d(nimages), has_ref, has_largegal
+
+def tim_blob_extents(tims, targetwcs, bx0, bx1, by0, by1):
+    '''
+    Returns (extents, overlaps) for the blob bounding boxes *bx0*, *bx1*,
+    *by0*, *by1* (arrays, in *targetwcs* pixels) in each of the *tims*:
+    *extents* is a (ntims x nblobs x 4) array of the (x0, x1, y0, y1)
+    extent, in (one-indexed) tim pixels, of each blob's corners, and
+    *overlaps* a (ntims x nblobs) boolean array of whether the blob
+    overlaps the tim.  This is the test that runbrick uses to decide
+    which images are sent with a blob.
+
+    The corners of all the blobs are converted with one pixelxy2radec
+    call, plus one radec2pixelxy call per tim.
+    '''
+    bx0,bx1,by0,by1 = [np.atleast_1d(b) for b in (bx0,bx1,by0,by1)]
+    nb = len(bx0)
+    extents = np.zeros((len(tims), nb, 4))
+    overlaps = np.zeros((len(tims), nb), bool)
+    if nb == 0:
+        return extents, overlaps
+    rr,dd = targetwcs.pixelxy2radec(np.hstack([bx0,bx0,bx1,bx1]),
+                                    np.hstack([by0,by1,by1,by0]))
+    for itim,tim in enumerate(tims):
+        h,w = tim.shape
+        _,x,y = tim.subwcs.radec2pixelxy(rr, dd)
+        x = np.reshape(x, (4, nb))
+        y = np.reshape(y, (4, nb))
+        ext = extents[itim]
+        ext[:,0] = x.min(axis=0)
+        ext[:,1] = x.max(axis=0)
+        ext[:,2] = y.min(axis=0)
+        ext[:,3] = y.max(axis=0)
+        overlaps[itim] = np.logical_not((ext[:,1] < 0) | (ext[:,3] < 0) |
+                                        (ext[:,0] > w) | (ext[:,2] > h))
+    return extents, overlaps
+
+def blob_schedule(blobmap, blobsrcs, ref_cat, nimages, model):
+    '''
+    Returns (blob_order, costs): the blob ids with at least one pixel in
+    *blobmap*, in decreasing order of CPU time predicted by *model*
+    (ties broken by pixel count), and the predicted CPU time of every
+    blob.
+
+    *ref_cat*: the reference catalog name of each source.
+    *nimages*: the number of images overlapping each blob (see
+    tim_blob_extents).
+    '''
+    nb = len(blobsrcs)
+    npix = np.bincount(blobmap[blobmap >= 0].ravel(), minlength=nb)
+    srcblob = np.zeros(len(ref_cat), int) - 1
+    for iblob,I in enumerate(blobsrcs):
+        srcblob[I] = iblob
+    costs = model.predict(*blob_features(srcblob, ref_cat, npix, nimages))
+    I = np.flatnonzero(npix > 0)
+    I = I[np.lexsort((-npix[I], -costs[I]))]
+    if len(I):
+        debug('Predicted blob CPU times: total %.1f s, max %.1f s' %
+              (np.sum(costs[I]), costs[I[0]]))
+    return I, costs
+
+def catalog_blob_table(T):
+    '''
+    Reduces a tractor catalog *T* (one row per source) to per-blob
+    (nsrcs, npix, nimages, has_ref, has_largegal, cpu) arrays.
+    '''
+    blobs,I,inv = np.unique(T.blob, return_index=True, return_inverse=True)
+    feats = blob_features(inv, T.ref_cat, T.blob_npix[I], T.blob_nimages[I])
+    keep = (blobs >= 0)
+    return tuple(f[keep] for f in feats) + (T.cpu_blob[I][keep],)
+
+def main():
+    import argparse
+    from astrometry.util.fits import fits_table
+    parser = argparse.ArgumentParser(
+        description='Fit the blob CPU-time model to tractor catalogs.')
+    parser.add_argument('--out', required=True, help='Output model filename')
+    parser.add_argument('catalogs', nargs='+', help='Tractor catalog files')
+    opt = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+
+    cols = ['blob', 'ref_cat', 'blob_npix', 'blob_nimages', 'cpu_blob']
+    tables = []
+    for fn in opt.catalogs:
+        T = fits_table(fn, columns=cols)
+        if len(T) == 0:
+            continue
+        tables.append(catalog_blob_table(T))
+    X = [np.hstack(a) for a in zip(*tables)]
+    model = BlobCostModel.fit(*X)
+    for name,c in zip(model.feature_names, model.coeffs):
+        info('  %-12s %8.3f' % (name, c))
+    resid = np.log(np.maximum(X[-1], 1e-3)) - np.log(model.predict(*X[:-1]))
+    info('Fit to', len(X[-1]), 'blobs; RMS residual in log(cpu): %.2f' %
+         np.sqrt(np.mean(resid**2)))
+    model.write(opt.out)
+    info('Wrote', opt.out)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,6 +20,7 @@ def stage_blobmask(targetwcs=None,
                    nsatur=None,
                    record_event=None,
                    blob_dilate=None,
+                   nworkers=1,
                    **kwargs):
     from legacypipe.detection import detection_maps
     from legacypipe.runbrick import _add_stage_version
@@ -29,7 +30,8 @@ def stage_blobmask(targetwcs=None,
 
     record_event and record_event('stage_blobmask: detection maps')
     detmaps, detivs, satmaps = detection_maps(tims, targetwcs, bands, mp,
-                                              apodize=10, nsatur=nsatur)
+                                              apodize=10, nsatur=nsatur,
+                                              nworkers=nworkers)
 
     hot, saturated_pix = generate_blobmask(
         survey, bands, nsigma, detmaps, detivs, satmaps, blob_dilate,
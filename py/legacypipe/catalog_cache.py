@@ -0,0 +1,106 @@
+'''
+A process-wide cache of (column-pruned) brick tractor catalogs, for
+forced photometry, where the CCDs of an exposure all read the
+catalogs of largely the same bricks.
+
+Each catalog file is read once, cut to BRICK_PRIMARY, non-DUP
+sources, and sorted by Dec; lookups for a CCD then only examine the
+rows in the CCD's Dec range (found by binary search) before the exact
+pixel-space cut.
+'''
+import os
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.catalog_cache')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class BrickCatalogCache(object):
+    '''
+    Caches brick catalogs (with the given *columns*, which must include
+    ra, dec, brick_primary and type), up to *maxsize* bytes.
+    '''
+    def __init__(self, columns, maxsize=1e9):
+        from legacypipe.utils import LRUCache
+        self.columns = list(columns)
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def get(self, fn):
+        '''
+        Returns the primary, non-DUP sources in catalog *fn*, sorted by
+        Dec.  The returned table is shared: do not modify it.
+        '''
+        from astrometry.util.fits import fits_table
+        st = os.stat(fn)
+        key = (fn, st.st_mtime_ns, st.st_size)
+        T = self.cache.get(key)
+        if T is not None:
+            return T
+        debug('Reading', fn)
+        T = fits_table(fn, columns=self.columns)
+        hdr = T.get_header()
+        keep = T.brick_primary.copy()
+        # drop DUP sources
+        keep[np.char.strip(T.type.astype(str)) == 'DUP'] = False
+        I = np.flatnonzero(keep)
+        T = T[I[np.argsort(T.dec[I], kind='stable')]]
+        T._header = hdr
+        self.cache.put(key, T)
+        return T
+
+    def read_in_wcs(self, fn, chipwcs, margin=20):
+        '''
+        Returns a new table of the sources in catalog *fn* that are
+        within *margin* pixels of the image described by *chipwcs*.
+        '''
+        T = self.get(fn)
+        W,H = chipwcs.get_width(), chipwcs.get_height()
+        dlo,dhi = wcs_dec_range(chipwcs, margin)
+        i0,i1 = np.searchsorted(T.dec, [dlo, dhi])
+        I = np.arange(i0, i1)
+        _,xx,yy = chipwcs.radec2pixelxy(T.ra[I], T.dec[I])
+        I = I[(xx >= -margin) * (xx <= (W+margin)) *
+              (yy >= -margin) * (yy <= (H+margin))]
+        R = T[I]
+        R._header = T._header
+        return R
+
+def wcs_dec_range(wcs, margin, n=20):
+    '''
+    Returns the (min, max) Dec of the image (plus *margin* pixels)
+    described by *wcs*, evaluated along its boundary, padded slightly.
+    If the image contains a pole, the range extends to it.
+    '''
+    W,H = wcs.get_width(), wcs.get_height()
+    xx = np.linspace(0.5 - margin, W + 0.5 + margin, n)
+    yy = np.linspace(0.5 - margin, H + 0.5 + margin, n)
+    x = np.hstack([xx, xx, np.zeros(n) + xx[0], np.zeros(n) + xx[-1]])
+    y = np.hstack([np.zeros(n) + yy[0], np.zeros(n) + yy[-1], yy, yy])
+    _,dec = wcs.pixelxy2radec(x, y)[-2:]
+    # Pad by the spacing between boundary points, to cover curvature.
+    pad = wcs.pixel_scale() / 3600. * max(W, H) / n
+    dlo = np.min(dec) - pad
+    dhi = np.max(dec) + pad
+    for pole in [-90., 90.]:
+        ok,px,py = wcs.radec2pixelxy(0., pole)
+        if ok and (px >= xx[0]) and (px <= xx[-1]) and (py >= yy[0]) and (py <= yy[-1]):
+            dlo = min(dlo, pole)
+            dhi = max(dhi, pole)
+    return dlo, dhi
+
+# One cache per process, shared by all the CCDs it processes.
+_brick_catalog_cache = None
+def get_brick_catalog_cache(columns):
+    '''
+    Returns the process-wide BrickCatalogCache for *columns*.
+    '''
+    global _brick_catalog_cache
+    if (_brick_catalog_cache is None or
+        _brick_catalog_cache.columns != list(columns)):
+        _brick_catalog_cache = BrickCatalogCache(columns)
+    return _brick_catalog_cache
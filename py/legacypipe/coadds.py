@@ -4,6 +4,7 @@ from astrometry.util.fits import fits_table
 from astrometry.util.resample import resample_with_wcs, OverlapError
 from legacypipe.bits import DQ_BITS
 from legacypipe.survey import tim_get_resamp
+from legacypipe.resampling import cached_resampling
 from legacypipe.utils import copy_header_with_wcs
 
 import logging
@@ -214,7 +215,20 @@ def make_coadds(tims, bands, targetwcs,
                 callback=None, callback_args=None,
                 plots=False, ps=None,
                 lanczos=True, mp=None,
-                satur_val=10.):
+                satur_val=10.,
+                spill_dir=None):
+    '''
+    Coadds the *tims*, one band at a time.  The tims of a band are
+    resampled (by *mp*) while the previous band is being accumulated,
+    and each band's aperture photometry runs as soon as that band is
+    finished, so at most two bands' worth of resampled pixels are held
+    in memory.
+
+    *spill_dir*: if set, the finished per-band products that are
+    returned in the result (coimgs, comods, allmasks, ...) are moved to
+    memory-mapped temporary files in this directory, so that peak
+    memory stays near that of coadding a single band.
+    '''
     from astrometry.util.ttime import Time
     t0 = Time()
 
@@ -250,7 +264,7 @@ def make_coadds(tims, bands, targetwcs,
         C.allmasks = []
     if anymasks:
         C.anymasks = []
-    if max:
+    if get_max:
         C.maximgs = []
     if psf_images:
         C.psf_imgs = []
@@ -278,10 +292,10 @@ def make_coadds(tims, bands, targetwcs,
         # surface-brightness correction
         tim.sbscale = (targetwcs.pixel_scale() / tim.subwcs.pixel_scale())**2
 
-    # We create one iterator per band to do the tim resampling.  These all run in
-    # parallel when multi-processing.
-    imaps = []
-    for band in bands:
+    # We create one iterator per band to do the tim resampling.  When
+    # multi-processing, the next band's iterator is started while the
+    # current band is being accumulated.
+    def band_resampler(band):
         args = []
         for itim,tim in enumerate(tims):
             if tim.band != band:
@@ -296,12 +310,13 @@ def make_coadds(tims, bands, targetwcs,
                 bmo = blobmods[itim]
             args.append((itim,tim,mo,bmo,lanczos,targetwcs,sbscale))
         if mp is not None:
-            imaps.append(mp.imap_unordered(_resample_one, args))
-        else:
-            imaps.append(map(_resample_one, args))
+            return mp.imap_unordered(_resample_one, args)
+        return map(_resample_one, args)
 
-    # Args for aperture photometry
-    apargs = []
+    # The per-band products that get returned in "C"
+    band_products = ['coimgs', 'cowimgs', 'galdetivs', 'psfdetivs', 'comods',
+                     'coresids', 'coblobmods', 'coblobresids', 'allmasks',
+                     'anymasks', 'maximgs', 'satmaps']
 
     if xy:
         # To save the memory of 2 x float64 maps, we instead do arg min/max maps
@@ -317,8 +332,14 @@ def make_coadds(tims, bands, targetwcs,
         allresids = []
 
     tinyw = 1e-30
-    for iband,(band,timiter) in enumerate(zip(bands, imaps)):
+    timiter = None
+    if len(bands):
+        timiter = band_resampler(bands[0])
+    for iband,band in enumerate(bands):
         debug('Computing coadd for band', band)
+        nextiter = None
+        if iband+1 < len(bands):
+            nextiter = band_resampler(bands[iband+1])
 
         # coadded weight map (moo)
         cow    = np.zeros((H,W), np.float32)
@@ -408,7 +429,7 @@ def make_coadds(tims, bands, targetwcs,
             flatcow = np.zeros((H,W), np.float32)
             kwargs.update(psfsize=psfsizemap)
 
-        if max:
+        if get_max:
             maximg = np.zeros((H,W), np.float32)
             C.maximgs.append(maximg)
 
@@ -547,7 +568,7 @@ def make_coadds(tims, bands, targetwcs,
                 del bmo
             del goodpix
 
-            if max:
+            if get_max:
                 maximg[Yo,Xo] = np.maximum(maximg[Yo,Xo], im * (iv>0))
 
             del Yo,Xo,im,iv
@@ -632,6 +653,7 @@ def make_coadds(tims, bands, targetwcs,
                 imsigma = 1.0/np.sqrt(cow)
             imsigma[mask] = 0.
 
+            apargs = []
             for irad,rad in enumerate(apertures):
                 apargs.append((irad, band, rad, cowimg, imsigma, mask,
                                True, apxy))
@@ -641,12 +663,33 @@ def make_coadds(tims, bands, targetwcs,
                 if blobmods is not None:
                     apargs.append((irad, band, rad, coblobresid, None, None,
                                    False, apxy))
+            # Aperture phot, in parallel
+            if mp is not None:
+                apresults = mp.map(_apphot_one, apargs)
+            else:
+                apresults = map(_apphot_one, apargs)
+            del apargs, imsigma, mask
+            _set_apphot_results(C.AP, band, apertures, apresults,
+                                mods is not None, blobmods is not None)
+            del apresults
 
         if not coweights:
             del cow
 
         if callback is not None:
             callback(band, *callback_args, **kwargs)
+        del kwargs
+
+        if spill_dir is not None:
+            for key in band_products:
+                prods = getattr(C, key, None)
+                if prods is not None and len(prods) == iband+1:
+                    prods[iband] = _spill_array(prods[iband], spill_dir)
+        # Drop our references to this band's maps before allocating the next band's.
+        R = cowimg = cow = coimg = cowmod = cochi2 = cowblobmod = None
+        coresid = coblobresid = psfdetiv = galdetiv = congood = None
+        ormask = andmask = nobs = satmap = psfsizemap = flatcow = maximg = None
+        timiter = nextiter
         # END of loop over bands
 
     t2 = Time()
@@ -661,74 +704,79 @@ def make_coadds(tims, bands, targetwcs,
         del mjd_argmins
         del mjd_argmaxs
 
-    if apertures is not None:
-        # Aperture phot, in parallel
-        if mp is not None:
-            apresults = mp.map(_apphot_one, apargs)
-        else:
-            apresults = map(_apphot_one, apargs)
-        del apargs
-        apresults = iter(apresults)
-
-        for iband,band in enumerate(bands):
-            apimg = []
-            apimgerr = []
-            apmask = []
-            if mods is not None:
-                apres = []
-            if blobmods is not None:
-                apblobres = []
-            for irad,rad in enumerate(apertures):
-                (airad, aband, isimg, ap_img, ap_err, ap_mask) = next(apresults)
-                assert(airad == irad)
-                assert(aband == band)
-                assert(isimg)
-                apimg.append(ap_img)
-                apimgerr.append(ap_err)
-                apmask.append(ap_mask)
-
-                if mods is not None:
-                    (airad, aband, isimg, ap_img, ap_err, ap_mask) = next(apresults)
-                    assert(airad == irad)
-                    assert(aband == band)
-                    assert(not isimg)
-                    apres.append(ap_img)
-                    assert(ap_err is None)
-                    assert(ap_mask is None)
-
-                if blobmods is not None:
-                    (airad, aband, isimg, ap_img, ap_err, ap_mask) = next(apresults)
-                    assert(airad == irad)
-                    assert(aband == band)
-                    assert(not isimg)
-                    apblobres.append(ap_img)
-                    assert(ap_err is None)
-                    assert(ap_mask is None)
-
-            ap = np.vstack(apimg).T
-            ap[np.logical_not(np.isfinite(ap))] = 0.
-            C.AP.set('apflux_img_%s' % band, ap)
-            with np.errstate(divide='ignore'):
-                ap = 1./(np.vstack(apimgerr).T)**2
-            ap[np.logical_not(np.isfinite(ap))] = 0.
-            C.AP.set('apflux_img_ivar_%s' % band, ap)
-            ap = np.vstack(apmask).T
-            ap[np.logical_not(np.isfinite(ap))] = 0.
-            C.AP.set('apflux_masked_%s' % band, ap)
-            if mods is not None:
-                ap = np.vstack(apres).T
-                ap[np.logical_not(np.isfinite(ap))] = 0.
-                C.AP.set('apflux_resid_%s' % band, ap)
-            if blobmods is not None:
-                ap = np.vstack(apblobres).T
-                ap[np.logical_not(np.isfinite(ap))] = 0.
-                C.AP.set('apflux_blobresid_%s' % band, ap)
-
-        t3 = Time()
-        debug('coadds apphot:', t3-t2)
 
     return C
 
+def _set_apphot_results(AP, band, apertures, apresults, mods, blobmods):
+    '''
+    Unpacks the results of _apphot_one for one band into table *AP*.
+    '''
+    apresults = iter(apresults)
+    apimg = []
+    apimgerr = []
+    apmask = []
+    if mods:
+        apres = []
+    if blobmods:
+        apblobres = []
+    for irad,rad in enumerate(apertures):
+        (airad, aband, isimg, ap_img, ap_err, ap_mask) = next(apresults)
+        assert(airad == irad)
+        assert(aband == band)
+        assert(isimg)
+        apimg.append(ap_img)
+        apimgerr.append(ap_err)
+        apmask.append(ap_mask)
+
+        if mods:
+            (airad, aband, isimg, ap_img, ap_err, ap_mask) = next(apresults)
+            assert(airad == irad)
+            assert(aband == band)
+            assert(not isimg)
+            apres.append(ap_img)
+            assert(ap_err is None)
+            assert(ap_mask is None)
+
+        if blobmods:
+            (airad, aband, isimg, ap_img, ap_err, ap_mask) = next(apresults)
+            assert(airad == irad)
+            assert(aband == band)
+            assert(not isimg)
+            apblobres.append(ap_img)
+            assert(ap_err is None)
+            assert(ap_mask is None)
+
+    ap = np.vstack(apimg).T
+    ap[np.logical_not(np.isfinite(ap))] = 0.
+    AP.set('apflux_img_%s' % band, ap)
+    with np.errstate(divide='ignore'):
+        ap = 1./(np.vstack(apimgerr).T)**2
+    ap[np.logical_not(np.isfinite(ap))] = 0.
+    AP.set('apflux_img_ivar_%s' % band, ap)
+    ap = np.vstack(apmask).T
+    ap[np.logical_not(np.isfinite(ap))] = 0.
+    AP.set('apflux_masked_%s' % band, ap)
+    if mods:
+        ap = np.vstack(apres).T
+        ap[np.logical_not(np.isfinite(ap))] = 0.
+        AP.set('apflux_resid_%s' % band, ap)
+    if blobmods:
+        ap = np.vstack(apblobres).T
+        ap[np.logical_not(np.isfinite(ap))] = 0.
+        AP.set('apflux_blobresid_%s' % band, ap)
+
+def _spill_array(arr, dirname):
+    '''
+    Copies *arr* into a memory-mapped, already-deleted temporary file in
+    directory *dirname*, so that its pages can be written out to disk
+    rather than staying resident.
+    '''
+    import tempfile
+    with tempfile.TemporaryFile(dir=dirname, prefix='coadd-') as f:
+        mm = np.memmap(f, dtype=arr.dtype, mode='w+', shape=arr.shape)
+    mm[:] = arr
+    return mm
+
 def _make_coadds_plots_4(allresids, mods, ps):
     import pylab as plt
     I = np.argsort([a[0] for a in allresids])
@@ -916,11 +964,19 @@ def _resample_one(args):
     else:
         imgs = []
 
-    try:
-        Yo,Xo,Yi,Xi,rimgs = resample_with_wcs(
-            targetwcs, tim.subwcs, imgs, 3, intType=np.int16)
-    except OverlapError:
-        return None
+    cached = cached_resampling(tim, targetwcs)
+    if cached is not None:
+        R = cached.nearest()
+        if R is None:
+            return None
+        Yo,Xo,Yi,Xi = R
+        rimgs = cached.lanczos(imgs) if lanczos else None
+    else:
+        try:
+            Yo,Xo,Yi,Xi,rimgs = resample_with_wcs(
+                targetwcs, tim.subwcs, imgs, 3, intType=np.int16)
+        except OverlapError:
+            return None
     if len(Yo) == 0:
         return None
     mo = None
@@ -1095,7 +1151,7 @@ def write_coadd_images(band,
             hdr2.add_record(dict(name='BUNIT', value='arcsec',
                                  comment='Effective PSF size'))
         with survey.write_output(name, brick=brickname, band=band,
-                                 shape=img.shape) as out:
+                                 shape=img.shape, direct=True) as out:
             out.fits.write(img, header=hdr2)
 
 # Pretty much only used for plots; the real deal is make_coadds()
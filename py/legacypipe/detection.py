@@ -10,26 +10,41 @@ def debug(*args):
     log_debug(logger, args)
 
 def _detmap(X):
-    from scipy.ndimage.filters import gaussian_filter
     from legacypipe.survey import tim_get_resamp
     (tim, targetwcs, apodize) = X
     R = tim_get_resamp(tim, targetwcs)
     if R is None:
         return None,None,None,None,None,None
+    detim,detiv,sat = _filtered_detmap(tim, R, apodize)
+    (Yo,Xo,Yi,Xi) = R
+    return tim.band, Yo, Xo, detim[Yi,Xi], detiv[Yi,Xi], sat
+
+def _filtered_detmap(tim, R, apodize):
+    '''
+    Computes the PSF-filtered detection map and its inverse-variance
+    map, in the pixel space of *tim*, plus the saturation flags for the
+    resampled pixels *R* = (Yo,Xo,Yi,Xi).
+    '''
+    from scipy.ndimage import gaussian_filter
     assert(tim.psf_sigma > 0)
     psfnorm = 1./(2. * np.sqrt(np.pi) * tim.psf_sigma)
     ie = tim.getInvError()
-    detim = tim.getImage().copy()
+    subh,subw = tim.shape
+    # The image and inverse-variance planes get filtered together, as a
+    # float32 stack, with a single Gaussian filter call.
+    stack = np.empty((2, subh, subw), np.float32)
+    detim = stack[0]
+    detiv = stack[1]
+    detim[:,:] = tim.getImage()
     # Zero out all masked pixels
     detim[ie == 0] = 0.
     tim.getSky().addTo(detim, scale=-1.)
 
-    subh,subw = tim.shape
     detsig1 = tim.sig1 / psfnorm
-    detiv = np.zeros((subh,subw), np.float32) + (1. / detsig1**2)
+    detiv[:,:] = (1. / detsig1**2)
     detiv[ie == 0] = 0.
 
-    (Yo,Xo,Yi,Xi) = R
+    (_,_,Yi,Xi) = R
     if tim.dq is None:
         sat = None
     else:
@@ -42,8 +57,10 @@ def _detmap(X):
             # detection is based on S/N, so plug in values > 0 for iv
             detiv[Yi[I],Xi[I]] = 1./detsig1**2
 
-    detim = gaussian_filter(detim, tim.psf_sigma) / psfnorm**2
-    detiv = gaussian_filter(detiv, tim.psf_sigma)
+    # (sigma = 0 along the stack axis: don't mix the planes)
+    stack = gaussian_filter(stack, (0., tim.psf_sigma, tim.psf_sigma))
+    detim = stack[0] / psfnorm**2
+    detiv = stack[1]
 
     if apodize:
         apodize = int(apodize)
@@ -56,12 +73,68 @@ def _detmap(X):
         detiv[-len(ramp):,:] *= ramp[::-1][:,np.newaxis]
         detiv[:,-len(ramp):] *= ramp[::-1][np.newaxis,:]
 
-    return tim.band, Yo, Xo, detim[Yi,Xi], detiv[Yi,Xi], sat
+    return detim, detiv, sat
+
+def _detmap_block(X):
+    '''
+    Renders the detection maps for a block of tims.  Rather than
+    returning the (Yo,Xo) index arrays and resampled values for each
+    tim, each tim's contribution is scattered into a dense image
+    covering its bounding box in the target WCS, so that the caller
+    can accumulate it with a simple slice addition.
 
-def detection_maps(tims, targetwcs, bands, mp, apodize=None, nsatur=None):
+    Returns a list of (band, y0, x0, detmap*detiv, detiv, sat) tuples.
+    '''
+    from legacypipe.survey import tim_get_resamp
+    (tims, targetwcs, apodize) = X
+    rtn = []
+    for tim in tims:
+        R = tim_get_resamp(tim, targetwcs)
+        if R is None:
+            continue
+        detim,detiv,sat = _filtered_detmap(tim, R, apodize)
+        (Yo,Xo,Yi,Xi) = R
+        y0,y1 = int(Yo.min()), int(Yo.max())+1
+        x0,x1 = int(Xo.min()), int(Xo.max())+1
+        Yo = Yo - y0
+        Xo = Xo - x0
+        inciv = np.zeros((y1-y0, x1-x0), np.float32)
+        incmap = np.zeros((y1-y0, x1-x0), np.float32)
+        iv = detiv[Yi,Xi]
+        inciv [Yo,Xo] = iv
+        incmap[Yo,Xo] = detim[Yi,Xi] * iv
+        del detim, detiv, iv
+        if sat is not None:
+            incsat = np.zeros((y1-y0, x1-x0), bool)
+            incsat[Yo,Xo] = sat
+            sat = incsat
+        rtn.append((tim.band, y0, x0, incmap, inciv, sat))
+    return rtn
+
+def _detmap_blocks(tims, nworkers):
+    '''
+    Splits *tims* into blocks of tims (of the same band, and similar PSF
+    size), to reduce the per-tim multiprocessing overheads, while
+    keeping enough blocks to occupy *nworkers* worker processes.
+    '''
+    blocksize = int(np.clip(len(tims) // (4 * nworkers), 1, detmap_max_block_size))
+    blocks = []
+    bands = np.array([tim.band for tim in tims])
+    for band in np.unique(bands):
+        I = np.flatnonzero(bands == band)
+        I = I[np.argsort([tims[i].psf_sigma for i in I], kind='stable')]
+        for j in range(0, len(I), blocksize):
+            blocks.append([tims[i] for i in I[j:j+blocksize]])
+    return blocks
+
+# Maximum number of tims to render per multiprocessing job in detection_maps
+detmap_max_block_size = 8
+
+def detection_maps(tims, targetwcs, bands, mp, apodize=None, nsatur=None,
+                   nworkers=1):
     # Render the detection maps
     H,W = targetwcs.shape
-    H,W = np.int(H), np.int(W)
+    H,W = int(H), int(W)
     ibands = dict([(b,i) for i,b in enumerate(bands)])
 
     detmaps = [np.zeros((H,W), np.float32) for b in bands]
@@ -77,19 +150,21 @@ def detection_maps(tims, targetwcs, bands, mp, apodize=None, nsatur=None):
             satmax = 65534
         satmaps = [np.zeros((H,W), sattype) for b in bands]
 
-    for band,Yo,Xo,incmap,inciv,sat in mp.imap_unordered(
-            _detmap, [(tim, targetwcs, apodize) for tim in tims]):
-        if Yo is None:
-            continue
-        ib = ibands[band]
-        detmaps[ib][Yo,Xo] += incmap * inciv
-        detivs [ib][Yo,Xo] += inciv
-        if sat is not None:
-            if nsatur is None:
-                satmaps[ib][Yo,Xo] |= sat
-            else:
-                satmaps[ib][Yo,Xo] = np.minimum(satmax, satmaps[ib][Yo,Xo] + (1*sat))
-        del Yo,Xo,incmap,inciv,sat
+    blocks = _detmap_blocks(tims, nworkers)
+    for R in mp.imap_unordered(
+            _detmap_block, [(block, targetwcs, apodize) for block in blocks]):
+        for band,y0,x0,incmap,inciv,sat in R:
+            ib = ibands[band]
+            h,w = inciv.shape
+            slc = slice(y0, y0+h), slice(x0, x0+w)
+            detmaps[ib][slc] += incmap
+            detivs [ib][slc] += inciv
+            if sat is not None:
+                if nsatur is None:
+                    satmaps[ib][slc] |= sat
+                else:
+                    satmaps[ib][slc] = np.minimum(satmax, satmaps[ib][slc] + sat.astype(sattype))
+        del R
     for i,(detmap,detiv,satmap) in enumerate(zip(detmaps, detivs, satmaps)):
         detmap /= np.maximum(1e-16, detiv)
         if nsatur is not None:
@@ -45,8 +45,10 @@ Farm.py is itself a multi-process application:
 These processes communicate with each other over multiprocessing.Queue
 objects:
 
-- "inqueue" goes from input_threads to network_thread and contains
-  "work packets" that will be sent to the workers.
+- "inqueues" go from input_threads to network_thread and contain
+  "work packets" that will be sent to the workers.  Each input_thread
+  has its own queue, and the network_thread reads from them in
+  round-robin order.
 - "outqueue" goes from network_thread to output_thread and contains
   results received from workers.
 - "checkpointqueue" goes from input_threads to output_thread, and is
@@ -82,18 +84,28 @@ The overall data flow is:
   the output_thread.
 
 - a worker.py client sends a message to the farm.py socket.  The first
-  time it calls, it sends an empty message.
+  time it calls, it sends an empty message.  Each message carries a
+  "credit": the number of work packets the worker has received so far,
+  and the number it has room for (worker.py keeps --prefetch packets
+  queued or in flight).
 
-- the network_thread receives the message, and replies with a work
-  packet (that it has pulled off the input_queue).
+- the network_thread receives the message, subtracts the packets it has
+  sent that the worker has not yet received, and sends the worker up to
+  that many more work packets (that it has pulled off the input_queues),
+  as they become available.  Since the credit is absolute, a repeated
+  message does not add to it.
 
 - the worker.py calls the one_blob() function to perform the work in
-  its work packet.  It sends the result to the farm.py socket.  (And
-  receives in reply its next work assignment.)
+  its work packets.  It sends each result to the farm.py socket as soon
+  as it is done, along with more credit; it does not wait for a reply.
 
-- the network_thread receives the message containing the results (and
-  replies with the next work packet for the worker).  It puts the
-  result on the output_queue.
+- the network_thread receives the message containing the results, and
+  puts the result on the output_queue.
+
+(Older, synchronous worker.py clients, which send a request and wait for
+exactly one reply, are still supported: they are treated as having a
+credit of one per request, and get a "no work" reply if none is
+available.)
 
 - the output_thread pops a result off the output_queue, and if it
   determines that this is the final result for this brick, then it
@@ -126,15 +138,12 @@ Bottlenecks in the current setup (as I understand them) are:
   Haswell node with input_threads.
 - last I profiled, it seemed like the network_thread was spending a
   significant fraction of its time popping items from the input_queue
-  -- perhaps due to contention for the lock.  It could be that we want
-  to use one input_queue per input_thread, rather than having all of
-  them share a single queue.  There is no particular reason they need
-  to share a queue; we would then have to implement a simple
-  round-robin scheme to pull work from the different input_queues.
-- currently, the worker.py processes are synchronous: they ask for
-  work, wait for the reply, do the work, and send in the result.  We
-  could keep a short queue (per worker or even for the set of workers
-  sharing a node) to reduce this latency.
+  -- perhaps due to contention for the lock.  We now use one
+  input_queue per input_thread, read in round-robin order.
+- the worker.py processes used to be synchronous: they asked for
+  work, waited for the reply, did the work, and sent in the result.
+  Now the set of workers sharing a node keeps a short queue of work
+  packets, and the network round trip overlaps with computation.
 
 Last I checked, I could keep up with about 64 KNL nodes x 68 worker.py
 processes with 8 input_thread processes, but efficiency was starting
@@ -150,8 +159,9 @@ from collections import Counter, OrderedDict
 import multiprocessing as mp
 import queue
 import zmq
+import numpy as np
 
-from legacypipe.runbrick import _blob_iter, _write_checkpoint
+from legacypipe.runbrick import _blob_iter, _write_checkpoint, _read_checkpoint
 
 import logging
 logger = logging.getLogger('farm')
@@ -162,6 +172,23 @@ def debug(*args):
     from legacypipe.utils import log_debug
     log_debug(logger, args)
 
+def set_worker_credit(credits, nsent, ident, nreceived, room):
+    '''
+    Sets the credit of asynchronous worker *ident* (in OrderedDict
+    *credits*), given that it has received *nreceived* work packets and
+    has room for *room* more, while we have sent it *nsent[ident]*.
+    If we know of fewer packets sent than it has received (eg, after a
+    restart), we assume none are in flight.  Returns the credit.
+    '''
+    n = max(nsent.get(ident, 0), nreceived)
+    nsent[ident] = n
+    credit = room - (n - nreceived)
+    if credit > 0:
+        credits[ident] = credit
+    else:
+        credits.pop(ident, None)
+    return credit
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(
@@ -184,6 +211,10 @@ def main():
                         help='What to do with big blobs: "keep", "drop", "queue"')
     parser.add_argument('--big-pix', type=int, default=250000,
                         help='Define how many pixels are in a "big" blob')
+    parser.add_argument('--big-cost', type=float, default=None,
+                        help='Define "big" blobs by predicted CPU time (seconds) rather than --big-pix; requires --blob-cost-model')
+    parser.add_argument('--blob-cost-model', default=None,
+                        help='Fitted blob CPU-time model file (from legacypipe/blobcost.py)')
     parser.add_argument('--big-port', default=5556, type=int,
                         help='Network port (TCP) for big blobs, if --big=queue')
     parser.add_argument('--big-command-port', default=5566, type=int,
@@ -201,6 +232,9 @@ def main():
     # Make quieter
     logging.getLogger('legacypipe.runbrick').setLevel(lvl+10)
 
+    if opt.big_cost is not None and opt.blob_cost_model is None:
+        parser.error('--big-cost requires --blob-cost-model')
+
     queuename = opt.queue
 
     # inqueue: for holding blob-work-packets
@@ -285,7 +319,11 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
     me = socket.gethostname()
     if ctx is None:
         ctx = zmq.Context()
-    sock = ctx.socket(zmq.REP)
+    # We use a ROUTER socket, so that we can send work to a worker
+    # whenever it has credit, rather than only in reply to a request.
+    # This also accepts requests from old-style synchronous (REQ) workers.
+    sock = ctx.socket(zmq.ROUTER)
+    sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
     addr = 'tcp://*:' + str(port)
     sock.bind(addr)
     info('Listening on tcp://%s:%i for work (queue: %s)' % (me, port, qname))
@@ -308,6 +346,17 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
 
     outstanding_work = {}
 
+    # Workers waiting for work, in the order they asked for it:
+    # socket identity -> number of work packets they will accept (credit)
+    credits = OrderedDict()
+    # socket identity -> number of work packets sent to it
+    nsent = {}
+    # Identities of synchronous workers, which must get exactly one reply
+    # (work or "nowork") per request.
+    sync_workers = set()
+    # socket identity -> worker-reported job id
+    worker_names = {}
+
     next_inqueue = 0
 
     # Worker-reported cpu time in oneblob(), wall time in oneblob(), and overhead.
@@ -349,10 +398,39 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
     n_block = 0
     t_block = 0.
     n_nowork = 0
-    
+
+    def get_work():
+        # Retrieve the next work assignment from my input_threads.
+        nonlocal next_inqueue, n_noblock, t_noblock, n_block, t_block, n_nowork
+        # Round robin, non-blocking
+        for i in range(len(inqueues)):
+            try:
+                t_x = time.time()
+                inq = inqueues[(i + next_inqueue) % len(inqueues)]
+                arg = inq.get(block=False)
+                next_inqueue += (i+1)
+                t_y = time.time()
+                n_noblock += 1
+                t_noblock += (t_y - t_x)
+                return arg
+            except queue.Empty:
+                pass
+        # Round robin, blocking
+        try:
+            t_x = time.time()
+            inq = inqueues[next_inqueue % len(inqueues)]
+            next_inqueue += 1
+            arg = inq.get(block=True, timeout=1)
+            t_y = time.time()
+            n_block += 1
+            t_block += (t_y - t_x)
+            return arg
+        except queue.Empty:
+            n_nowork += 1
+            return None
+
     while True:
         tnow = time.time()
-        t1 = tnow
 
         if command_sock is not None and (tnow - last_check_command) > 1:
             # Check for any messages on the command socket
@@ -382,69 +460,6 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
 
         #debug(qname, 'Network thread: work queues:', inqueue.qsize(), 'out queue:', outqueue.qsize(), 'work sent:', worksent, ', received:', resultsreceived, 'outstanding:', worksent-resultsreceived)
 
-        # Retrieve the next work assignment from my input_threads.
-        if not havework:
-
-            arg = None
-            # Round robin, non-blocking
-            for i in range(len(inqueues)):
-                try:
-                    t_x = time.time()
-                    inq = inqueues[(i + next_inqueue) % len(inqueues)]
-                    arg = inq.get(block=False)
-                    next_inqueue += (i+1)
-                    t_y = time.time()
-                    n_noblock += 1
-                    t_noblock += (t_y - t_x)
-                    break
-                except queue.Empty:
-                    pass
-
-            if arg is None:
-                # Round robin, blocking
-                try:
-                    t_x = time.time()
-                    inq = inqueues[next_inqueue % len(inqueues)]
-                    next_inqueue += 1
-                    arg = inq.get(block=True, timeout=1)
-                    t_y = time.time()
-                    n_block += 1
-                    t_block += (t_y - t_x)
-                except queue.Empty:
-                    n_nowork += 1
-                    work = nowork
-                    havework = False
-
-            if arg is not None:
-                (work_brick,work_iblob,work) = arg.item
-                havework = True
-
-            # try:
-            #     t_x = time.time()
-            #     arg = inqueue.get(block=False)
-            #     (work_brick,work_iblob,work) = arg.item
-            #     havework = True
-            #     t_y = time.time()
-            #     n_noblock += 1
-            #     t_noblock += (t_y - t_x)
-            # except queue.Empty:
-            #     try:
-            #         t_x = time.time()
-            #         arg = inqueue.get(block=True, timeout=1)
-            #         t_y = time.time()
-            #         (work_brick,work_iblob,work) = arg.item
-            #         havework = True
-            #         n_block += 1
-            #         t_block += (t_y - t_x)
-            #         #debug('Next work packet:', len(work), 'bytes')
-            #     except queue.Empty:
-            #         n_nowork += 1
-            #         work = nowork
-            #         havework = False
-            #         info('Network thread: Work queue is empty (or timed out).  qsize=', inqueue.qsize())
-
-        t1a = time.time()
-
         if tnow - last_print_workqueue > 2:
             #print(qname, 'Work queue:', inqueue.qsize(), 'Work packets sent:', nworkpackets, 'bytes:', nworkbytes)
             nw = list(nwaitingCounter.keys())
@@ -550,84 +565,119 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
 
             last_printout = tnow
 
-        debug('Waiting for request')
-
-        #if not havework or command_sock is not None:
-        #     events = sock.poll(5000)
-        #     if events == 0:
-        #         # recv timed out; check work queue again
-        #         continue
-
+        t1a = time.time()
+        debug('Waiting for requests')
 
+        # Receive all waiting requests and results.  If no worker
+        # is waiting for work, block here (for a while) until one
+        # shows up; otherwise go straight on to handing out work.
         events = sock.poll(timeout=0)
         nwaitingCounter[events] += 1
-
-        events = sock.poll(timeout=5000)
-        #print('Messages waiting:', events)
-        if events == 0:
-            # recv timed out; check work queue again
-            continue
-
+        if events == 0 and len(credits) == 0:
+            events = sock.poll(timeout=5000)
         t1b = time.time()
+        t_poll += (t1b - t1a)
 
-        parts = sock.recv_multipart()
-
-        t2 = time.time()
-
-        assert(len(parts) == 3)
-        worker = parts[0]
-        meta   = parts[1]
-        result = parts[2]
-        debug('Request: from', worker, ':', len(result), 'bytes')
-        try:
-            sock.send(work) #, flags=zmq.NOBLOCK)
-            if havework:
-                nworkpackets += 1
-                nworkbytes += len(work)
-
-                worksent += 1
-                tnow = time.time()
-                havework = False
-                outstanding_work[(work_brick,work_iblob)] = (worker, tnow)
-                if not work_brick in brick_starttime:
-                    brick_starttime[work_brick] = tnow
-        except:
-            info('Network thread: sock.send(work) failed:')
-            import traceback
-            traceback.print_exc()
-
-        t3 = time.time()
-
-        if result == nowork:
-            debug('Empty result')
-            continue
-        else:
+        while events:
+            t2a = time.time()
+            parts = sock.recv_multipart()
+            t2 = time.time()
+            t_recv += (t2 - t2a)
+            events = sock.poll(timeout=0)
+
+            # [identity, (empty delimiter), jobid, meta, result, (credit)]
+            ident = parts[0]
+            if len(parts) == 5:
+                # Synchronous (REQ socket) worker: one request, one reply.
+                (_, _, jobid, meta, result) = parts
+                ncredit = 1
+                sync_workers.add(ident)
+                credits[ident] = credits.get(ident, 0) + ncredit
+            else:
+                assert(len(parts) == 6)
+                (_, _, jobid, meta, result, credit) = parts
+                nreceived,room = [int(x) for x in credit.split(b':')]
+                ncredit = set_worker_credit(credits, nsent, ident, nreceived, room)
+            worker_names[ident] = jobid
+            debug('Request: from', jobid, ':', len(result), 'bytes, credit', ncredit)
+
+            if result == nowork:
+                debug('Empty result')
+                continue
             debug('Non-empty result')
             resultsreceived += 1
-        # Parse metadata of the result.
-        (brick,iblob,cpu,wall,overhead) = pickle.loads(meta)
-
-        brick_cputime[brick] += cpu
-        brick_nblobs [brick] += 1
-        status_cputime  += cpu
-        status_walltime += wall
-        status_overhead += overhead
-        status_nblobs   += 1
-        try:
-            del outstanding_work[(brick, iblob)]
-        except KeyError:
-            info('Failed to remove brick', brick, 'blob', iblob, 'from outstanding_work ?!')
-            pass
-        t4 = time.time()
-        outqueue.put((brick, iblob, result))
-        t5 = time.time()
-
-        t_in += (t1a - t1)
-        t_poll += (t1b - t1a)
-        t_recv += (t2 - t1b)
-        t_send += (t3 - t2)
-        t_decode += (t4 - t3)
-        t_out += (t5 - t4)
+            # Parse metadata of the result.
+            (brick,iblob,cpu,wall,overhead) = pickle.loads(meta)
+
+            brick_cputime[brick] += cpu
+            brick_nblobs [brick] += 1
+            status_cputime  += cpu
+            status_walltime += wall
+            status_overhead += overhead
+            status_nblobs   += 1
+            try:
+                del outstanding_work[(brick, iblob)]
+            except KeyError:
+                info('Failed to remove brick', brick, 'blob', iblob, 'from outstanding_work ?!')
+                pass
+            t4 = time.time()
+            outqueue.put((brick, iblob, result))
+            t5 = time.time()
+            t_decode += (t4 - t2)
+            t_out += (t5 - t4)
+
+        # Hand out work to the workers that have credit, one packet at
+        # a time in turn, starting with the one that asked first.
+        while len(credits):
+            t3a = time.time()
+            if not havework:
+                arg = get_work()
+                if arg is None:
+                    # Synchronous workers must get a reply -- tell them
+                    # there is no work; asynchronous workers keep their
+                    # credit until there is.
+                    for ident in list(credits.keys()):
+                        if ident in sync_workers:
+                            del credits[ident]
+                            try:
+                                sock.send_multipart([ident, b'', nowork])
+                            except zmq.ZMQError:
+                                pass
+                    t_in += (time.time() - t3a)
+                    break
+                (work_brick,work_iblob,work) = arg.item
+                havework = True
+            t3b = time.time()
+            t_in += (t3b - t3a)
+
+            ident = next(iter(credits))
+            try:
+                sock.send_multipart([ident, b'', work])
+            except zmq.ZMQError:
+                # (with ROUTER_MANDATORY set, we get an error rather than
+                # silently dropping messages to disconnected workers)
+                info('Network thread: failed to send work to', worker_names.get(ident),
+                     '-- dropping its credit')
+                del credits[ident]
+                sync_workers.discard(ident)
+                continue
+            t_send += (time.time() - t3b)
+            nsent[ident] = nsent.get(ident, 0) + 1
+            credits[ident] -= 1
+            if credits[ident] == 0:
+                del credits[ident]
+            else:
+                credits.move_to_end(ident)
+
+            nworkpackets += 1
+            nworkbytes += len(work)
+            worksent += 1
+            tnow = time.time()
+            havework = False
+            outstanding_work[(work_brick,work_iblob)] = (worker_names.get(ident), tnow)
+            if not work_brick in brick_starttime:
+                brick_starttime[work_brick] = tnow
+
 
 def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
                   finished_bricks, opt):
@@ -817,6 +867,7 @@ def get_blob_iter(skipblobs=None,
                   T=None,
                   T_clusters=None,
                   custom_brick=False,
+                  cost_model=None,
                   **kwargs):
     from legacypipe.runbrick import get_frozen_galaxies, get_blobiter_ref_map
     if skipblobs is None:
@@ -839,7 +890,7 @@ def get_blob_iter(skipblobs=None,
                           brick,
                           frozen_galaxies,
                           max_blobsize=max_blobsize, custom_brick=custom_brick,
-                          skipblobs=skipblobs)
+                          skipblobs=skipblobs, cost_model=cost_model)
     return blobiter
 
 class PrioritizedItem(object):
@@ -877,14 +928,21 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
     '''
     Called from the input thread to generate work packets for the given *brickname*.
     '''
-    from astrometry.util.file import unpickle_from_file
+    import inspect
+    from legacypipe.blobcost import get_blob_cost_model, blob_features
+    from legacypipe.stagestore import read_stage_outputs
 
     pickle_fn = opt.pickle % dict(brick=brickname, brickpre=brickname[:3])
     info('Looking for', pickle_fn)
-    if not os.path.exists(pickle_fn):
+    # (either the pickle file or a runbrick --stage-store directory)
+    R = read_stage_outputs(pickle_fn)
+    if R is None:
         raise RuntimeError('Input pickle does not exist: ' + pickle_fn)
-    kwargs = unpickle_from_file(pickle_fn)
-    debug('Unpickled:', kwargs.keys())
+    debug('Unpickled:', R.keys())
+    # Only read the stage outputs that get_blob_iter uses.
+    params = inspect.signature(get_blob_iter).parameters
+    kwargs = dict([(k, R[k]) for k in R.keys() if k in params])
+    del R
 
     # Total blobs includes checkpointed ones.
     nchk = 0
@@ -893,11 +951,8 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
     checkpoint_fn = opt.checkpoint % dict(brick=brickname, brickpre=brickname[:3])
     if os.path.exists(checkpoint_fn):
         debug('Reading checkpoint file', checkpoint_fn)
-        R = unpickle_from_file(checkpoint_fn)
-        info('Brick', brickname, ': Read', len(R), 'from checkpoint file')
-
         skipblobs = []
-        for r in R:
+        for r in _read_checkpoint(checkpoint_fn):
             br = r['brickname']
             assert(br == brickname)
             iblob = r['iblob']
@@ -905,13 +960,16 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
             checkpointqueue.put((brickname, iblob, result))
             skipblobs.append(iblob)
             nchk += 1
+        info('Brick', brickname, ': Read', nchk, 'from checkpoint file')
         #print('Sent', nchk, 'over checkpointqueue')
         #print('checkpointqueue approx size:', checkpointqueue.qsize())
         kwargs.update(skipblobs=skipblobs)
 
     # (brickname is in the kwargs read from the pickle!)
     assert(kwargs['brickname'] == brickname)
-    blobiter = get_blob_iter(**kwargs)
+    cost_model = get_blob_cost_model(opt.blob_cost_model)
+    ref_cat = kwargs['T'].ref_cat
+    blobiter = get_blob_iter(cost_model=cost_model, **kwargs)
 
     big_npix = opt.big_pix
     if opt.big == 'keep':
@@ -929,19 +987,35 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
         if args is None:
             continue
 
-        # HACK -- reach into args to get blob size, for priority ordering
+        # HACK -- reach into args to get blob size (or predicted CPU time,
+        # with --blob-cost-model), for priority ordering
         blobw = args[6]
         blobh = args[7]
-        priority = -(blobw*blobh)
+        if cost_model is None:
+            cost = None
+            priority = -(blobw*blobh)
+        else:
+            Isrcs = args[2]
+            cost = cost_model.predict(*blob_features(
+                np.zeros(len(Isrcs), int), ref_cat[Isrcs],
+                np.sum(args[8]), len(args[9])))[0]
+            priority = -cost
+        coststr = '' if cost is None else 'predicted CPU time %.0f s' % cost
+
+        if opt.big_cost is not None:
+            isbig = (cost > opt.big_cost)
+        else:
+            isbig = (blobw*blobh > big_npix)
 
-        if opt.big == 'drop' and blobw*blobh > big_npix:
-            info('Brick', brickname, ': Dropping a blob of size', blobw, 'x', blobh)
+        if opt.big == 'drop' and isbig:
+            info('Brick', brickname, ': Dropping a blob of size', blobw, 'x', blobh,
+                 coststr)
             continue
 
         dest_queue = inqueue
 
-        if opt.big == 'queue' and blobw*blobh > big_npix:
-            info('Blob of size', blobw, 'x', blobh, 'goes on big queue')
+        if opt.big == 'queue' and isbig:
+            info('Blob of size', blobw, 'x', blobh, coststr, 'goes on big queue')
             dest_queue = bigqueue
 
         picl = pickle.dumps(arg, -1)
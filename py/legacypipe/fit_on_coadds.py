@@ -44,13 +44,142 @@ def _build_objmask(img, ivar, skypix, boxcar=5, boxsize=1024):
 
     return np.logical_and(~objmask, skypix) # True = sky pixels
 
+def overlapping_boxes(x0, x1, y0, y1):
+    """
+    Returns (I, J), I < J, the pairs of (inclusive) boxes that overlap,
+    by sweeping over the boxes sorted by x0.
+
+    """
+    x0, x1, y0, y1 = [np.asarray(a) for a in (x0, x1, y0, y1)]
+    order = np.argsort(x0, kind='stable')
+    sx0 = x0[order]
+    I, J = [], []
+    for k, i in enumerate(order):
+        # boxes starting (in x) within box i
+        cand = order[k+1:np.searchsorted(sx0, x1[i], side='right')]
+        cand = cand[(y0[cand] <= y1[i]) * (y1[cand] >= y0[i])]
+        I.append(np.minimum(i, cand))
+        J.append(np.maximum(i, cand))
+    if len(I) == 0:
+        return np.zeros(0, int), np.zeros(0, int)
+    return np.hstack(I).astype(int), np.hstack(J).astype(int)
+
+def ubercal_grid_wcs(tims, binning):
+    """
+    Returns a TAN WCS, at the pixel scale of the tims, covering all the
+    *tims*, with dimensions a multiple of *binning*.
+
+    """
+    from astrometry.util.util import Tan
+    from astrometry.util.starutil_numpy import radectoxyz, xyztoradec
+    rr, dd = [], []
+    for tim in tims:
+        h, w = tim.shape
+        r, d = tim.subwcs.pixelxy2radec(np.array([0.5, w+0.5, w+0.5, 0.5]),
+                                        np.array([0.5, 0.5, h+0.5, h+0.5]))[-2:]
+        rr.append(r)
+        dd.append(d)
+    rr = np.hstack(rr)
+    dd = np.hstack(dd)
+    rc, dc = xyztoradec(np.mean(radectoxyz(rr, dd), axis=0))
+    pixscale = tims[0].subwcs.pixel_scale() / 3600.
+    wcs = Tan(rc, dc, 0., 0., -pixscale, 0., 0., pixscale, 1., 1.)
+    _, xx, yy = wcs.radec2pixelxy(rr, dd)
+    x0 = int(np.floor(xx.min())) - 1
+    y0 = int(np.floor(yy.min())) - 1
+    W = binning * int(np.ceil((np.ceil(xx.max()) + 1 - x0) / binning))
+    H = binning * int(np.ceil((np.ceil(yy.max()) + 1 - y0) / binning))
+    return Tan(rc, dc, 1.-x0, 1.-y0, -pixscale, 0., 0., pixscale,
+               float(W), float(H))
+
+def binned_on_grid(tim, gridwcs, binning):
+    """
+    Resamples (nearest-neighbour) a tim onto the common grid and bins it
+    by *binning* x *binning*.
+
+    Returns (x0, y0, mean, ivar): the offset of the binned image's
+    bounding box in binned grid pixels, and the inverse-variance weighted
+    mean and total inverse-variance of the tim's pixels in each bin; or
+    None if the tim does not overlap the grid.
+
+    """
+    from astrometry.util.resample import resample_with_wcs, OverlapError
+    try:
+        Yo, Xo, Yi, Xi, _ = resample_with_wcs(gridwcs, tim.subwcs)
+    except OverlapError:
+        return None
+    iv = tim.getInvvar()[Yi, Xi]
+    good = (iv > 0)
+    if not np.any(good):
+        return None
+    iv = iv[good]
+    img = tim.getImage()[Yi[good], Xi[good]]
+    cy = Yo[good] // binning
+    cx = Xo[good] // binning
+    x0, y0 = cx.min(), cy.min()
+    nx = cx.max() - x0 + 1
+    ny = cy.max() - y0 + 1
+    cell = (cy - y0) * nx + (cx - x0)
+    ivar = np.bincount(cell, weights=iv, minlength=nx*ny)
+    mean = np.bincount(cell, weights=iv * img, minlength=nx*ny)
+    mean[ivar > 0] /= ivar[ivar > 0]
+    return (x0, y0, mean.reshape(ny, nx).astype(np.float32),
+            ivar.reshape(ny, nx).astype(np.float32))
+
+def ubercal_overlaps(fulltims, binning=4):
+    """
+    Measures the (weighted) differences between the overlapping pairs of
+    *fulltims*.
+
+    Each tim is resampled once onto a common grid, binned by *binning*;
+    the pairs of tims whose footprints overlap are then found with
+    overlapping_boxes, and compared on the grid.
+
+    Returns (I, J, delta, weight) for the pairs (I < J) with overlapping
+    pixels: *delta* is the inverse-variance weighted sum of (image I -
+    image J) and *weight* the sum of the weights.
+
+    """
+    gridwcs = ubercal_grid_wcs(fulltims, binning)
+    binned = [binned_on_grid(tim, gridwcs, binning) for tim in fulltims]
+    K = np.array([b is not None for b in binned])
+    x0 = np.array([b[0] if b is not None else 0 for b in binned])
+    y0 = np.array([b[1] if b is not None else 0 for b in binned])
+    x1 = np.array([b[0] + b[2].shape[1] - 1 if b is not None else -1 for b in binned])
+    y1 = np.array([b[1] + b[2].shape[0] - 1 if b is not None else -1 for b in binned])
+    cand_I, cand_J = overlapping_boxes(x0, x1, y0, y1)
+
+    I, J, delta, weight = [], [], [], []
+    for ii, jj in zip(cand_I, cand_J):
+        if not (K[ii] and K[jj]):
+            continue
+        xlo, xhi = max(x0[ii], x0[jj]), min(x1[ii], x1[jj])
+        ylo, yhi = max(y0[ii], y0[jj]), min(y1[ii], y1[jj])
+        slcI = (slice(ylo - y0[ii], yhi - y0[ii] + 1), slice(xlo - x0[ii], xhi - x0[ii] + 1))
+        slcJ = (slice(ylo - y0[jj], yhi - y0[jj] + 1), slice(xlo - x0[jj], xhi - x0[jj] + 1))
+        imgI, invI = binned[ii][2][slcI], binned[ii][3][slcI]
+        imgJ, invJ = binned[jj][2][slcJ], binned[jj][3][slcJ]
+        good = (invI > 0) * (invJ > 0)
+        if not np.any(good):
+            continue
+        invI = invI[good].astype(np.float64)
+        invJ = invJ[good].astype(np.float64)
+        diff = (imgI - imgJ)[good]
+        iv = invI * invJ / (invI + invJ)
+        I.append(ii)
+        J.append(jj)
+        delta.append(np.sum(diff * iv))
+        weight.append(np.sum(iv))
+    return np.array(I, int), np.array(J, int), np.array(delta), np.array(weight)
+
 def coadds_ubercal(fulltims, coaddtims=None, plots=False, plots2=False,
-                   ps=None, verbose=False):
+                   ps=None, verbose=False, binning=4):
     """
     Bring individual CCDs onto a common flux scale based on overlapping pixels.
 
     fulltims - full-CCD tims, used to derive the corrections
     coaddtims - tims sliced to just the pixels contributing to the output coadd
+    binning - binning of the common grid on which overlaps are measured
 
     Some notes on the procedure:
 
@@ -67,55 +196,28 @@ def coadds_ubercal(fulltims, coaddtims=None, plots=False, plots2=False,
     b: length -- "noverlap" number of overlapping pairs of images -- filled-in elements in your array
     - units of weighted image pixels
 
+    A is sparse (two entries per row), and only the overlapping pairs
+    are measured (see ubercal_overlaps); the minimum-norm least-squares
+    solution is found with LSQR.
+
     """
-    from astrometry.util.resample import resample_with_wcs, OverlapError
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.linalg import lsqr
 
     band = fulltims[0].band
     nimg = len(fulltims)
-    indx = np.arange(nimg)
-
-    ## initialize A bigger than we will need, cut later
-    A = np.zeros((nimg*nimg, nimg), np.float32)
-    b = np.zeros((nimg*nimg), np.float32)
-    ioverlap = 0
-
-    for ii in indx:
-        for jj in indx[ii+1:]:
-            try:
-                Yi, Xi, Yj, Xj, _ = resample_with_wcs(
-                    fulltims[ii].subwcs, fulltims[jj].subwcs)
-            except OverlapError:
-                continue
-
-            imgI = fulltims[ii].getImage() [Yi, Xi]
-            imgJ = fulltims[jj].getImage() [Yj, Xj]
-            invI = fulltims[ii].getInvvar()[Yi, Xi]
-            invJ = fulltims[jj].getInvvar()[Yj, Xj]
-            good = (invI > 0) * (invJ > 0)
-            diff = (imgI - imgJ)[good]
-            iv = 1. / (1. / invI[good] + 1. / invJ[good])
-            delta = np.sum(diff * iv)
-            weight = np.sum(iv)
-
-            A[ioverlap, ii] = -weight
-            A[ioverlap, jj] =  weight
-
-            b[ioverlap] = delta
-
-            ioverlap += 1
-
-    noverlap = ioverlap
-    A = A[:noverlap, :]
-    b = b[:noverlap]
-    #if verbose:
-    #    print('A:')
-    #    print(A)
-    #    print('b:')
-    #    print(b)
-
-    R = np.linalg.lstsq(A, b, rcond=None)
-
-    x = R[0]
+
+    I, J, delta, weight = ubercal_overlaps(fulltims, binning=binning)
+    noverlap = len(I)
+    if verbose:
+        print('Band', band, ':', noverlap, 'overlapping pairs of', nimg, 'images')
+    rows = np.repeat(np.arange(noverlap), 2)
+    cols = np.vstack((I, J)).T.ravel()
+    vals = np.vstack((-weight, weight)).T.ravel()
+    A = csr_matrix((vals, (rows, cols)), shape=(noverlap, nimg))
+    b = delta
+
+    x = lsqr(A, b, atol=1e-12, btol=1e-12, iter_lim=100*nimg)[0]
     print('Delta offsets to each image:')
     print(x)
 
@@ -19,6 +19,7 @@ from tractor.galaxy import disable_galaxy_cache
 from legacypipe.survey import LegacySurveyData, bricks_touching_wcs, get_version_header, apertures_arcsec, radec_at_mjd
 from legacypipe.catalog import read_fits_catalog
 from legacypipe.outliers import read_outlier_mask_file
+from legacypipe.catalog_cache import get_brick_catalog_cache
 
 def get_parser():
     '''
@@ -91,6 +92,8 @@ def get_parser():
     parser.add_argument('--out', help='Output catalog filename (default: use --out-dir)')
     parser.add_argument('--out-dir', help='Output base directory')
 
+    parser.add_argument('--whole-exposure', default=False, action='store_true',
+                        help='Read the Gaia stars, catalogs and outlier-mask bricks once for the whole exposure and share them between its CCDs')
     parser.add_argument('--outlier-mask', nargs='?', const='default',
                         help='Write the reassembled outlier mask?  Optionally include output filename; default use --out-dir')
     parser.add_argument('-v', '--verbose', dest='verbose', action='count',
@@ -145,6 +148,10 @@ def main(survey=None, opt=None, args=None):
         print('If no --expnum is given, must supply --out filename')
         return -1
 
+    if opt.whole_exposure and opt.expnum is None:
+        print('--whole-exposure requires --expnum')
+        return -1
+
     if not opt.forced:
         opt.apphot = True
 
@@ -213,6 +220,19 @@ def main(survey=None, opt=None, args=None):
                 fnset.add(fn)
         copy_files_to_cache(fnset)
 
+    bounce = bounce_one_ccd
+    pool_init = dict()
+    if opt.whole_exposure and len(ccds):
+        tm = Time()
+        exposure = ExposureInputs(survey, ccds, catsurvey_north, catsurvey_south,
+                                  opt.catalog_resolve_dec_ngc, read_catalog=not(opt.catalog))
+        print('Read exposure-wide inputs:', Time()-tm)
+        # The workers get the exposure inputs once, rather than with each CCD.
+        set_exposure_inputs(exposure)
+        bounce = bounce_one_ccd_in_exposure
+        pool_init = dict(initializer=set_exposure_inputs, initargs=(exposure,))
+        del exposure
+
     args = []
     for ccd in ccds:
         args.append((survey,
@@ -222,12 +242,12 @@ def main(survey=None, opt=None, args=None):
     if opt.threads:
         from astrometry.util.multiproc import multiproc
         from astrometry.util.timingpool import TimingPool, TimingPoolMeas
-        pool = TimingPool(opt.threads)
+        pool = TimingPool(opt.threads, **pool_init)
         poolmeas = TimingPoolMeas(pool, pickleTraffic=False)
         Time.add_measurement(poolmeas)
         mp = multiproc(None, pool=pool)
         tm = Time()
-        FF = mp.map(bounce_one_ccd, args)
+        FF = mp.map(bounce, args)
         print('Multi-processing forced-phot:', Time()-tm)
         del mp
         Time.measurements.remove(poolmeas)
@@ -236,7 +256,7 @@ def main(survey=None, opt=None, args=None):
         pool.join()
         del pool
     else:
-        FF = map(bounce_one_ccd, args)
+        FF = map(bounce, args)
 
     FF = [F for F in FF if F is not None]
     if len(FF) == 0:
@@ -335,6 +355,141 @@ def bounce_one_ccd(X):
     # for multiprocessing
     return forced_photom_one_ccd(*X)
 
+# The ExposureInputs of a --whole-exposure run, set in each worker process
+# by the pool initializer.
+_exposure_inputs = None
+def set_exposure_inputs(exposure):
+    global _exposure_inputs
+    _exposure_inputs = exposure
+
+def bounce_one_ccd_in_exposure(X):
+    return forced_photom_one_ccd(*X, exposure=_exposure_inputs)
+
+def exposure_wcs(ccds, margin):
+    '''
+    Returns a TAN WCS, at the pixel scale of the CCDs, covering all the
+    *ccds* (rows of the CCDs table, with their header WCS) plus a
+    margin of *margin* pixels.
+    '''
+    from astrometry.util.util import Tan
+    from astrometry.util.starutil_numpy import radectoxyz, xyztoradec
+    rr,dd = [],[]
+    for ccd in ccds:
+        W,H = float(ccd.width), float(ccd.height)
+        wcs = Tan(*[float(x) for x in
+                    [ccd.crval1, ccd.crval2, ccd.crpix1, ccd.crpix2,
+                     ccd.cd1_1, ccd.cd1_2, ccd.cd2_1, ccd.cd2_2, W, H]])
+        r,d = wcs.pixelxy2radec(np.array([0.5, W+0.5, W+0.5, 0.5]),
+                                np.array([0.5, 0.5, H+0.5, H+0.5]))
+        rr.append(r)
+        dd.append(d)
+    rr = np.hstack(rr)
+    dd = np.hstack(dd)
+    rc,dc = xyztoradec(np.mean(radectoxyz(rr, dd), axis=0))
+    pixscale = np.sqrt(np.abs(ccds.cd1_1[0] * ccds.cd2_2[0] -
+                              ccds.cd1_2[0] * ccds.cd2_1[0]))
+    wcs = Tan(rc, dc, 0., 0., -pixscale, 0., 0., pixscale, 1., 1.)
+    _,xx,yy = wcs.radec2pixelxy(rr, dd)
+    x0 = int(np.floor(xx.min())) - margin
+    y0 = int(np.floor(yy.min())) - margin
+    W = int(np.ceil(xx.max())) + margin - x0
+    H = int(np.ceil(yy.max())) + margin - y0
+    return Tan(rc, dc, 1.-x0, 1.-y0, -pixscale, 0., 0., pixscale,
+               float(W), float(H))
+
+class ExposureInputs(object):
+    '''
+    The inputs to forced photometry that overlap between the CCDs of an
+    exposure -- the Gaia stars for halo subtraction, the catalog, the
+    frozen SGA galaxies, and the bricks with outlier masks -- read once
+    for the whole exposure; the methods cut them to a CCD.
+    '''
+    def __init__(self, survey, ccds, catsurvey_north, catsurvey_south,
+                 resolve_dec, read_catalog=True):
+        from legacypipe.reference import mask_radius_for_mag, read_gaia
+        # Margin to allow for the CCDs' astrometric calibrations, beyond
+        # their header WCSes.
+        margin = 200
+        self.wcs = exposure_wcs(ccds, margin)
+        W,H = self.wcs.get_width(), self.wcs.get_height()
+        print('Exposure WCS: %i x %i pixels' % (W, H))
+
+        self.halostars = None
+        if np.any(ccds.camera == 'decam'):
+            ref_margin = mask_radius_for_mag(0.)
+            mpix = int(np.ceil(ref_margin * 3600. / self.wcs.pixel_scale()))
+            marginwcs = self.wcs.get_subimage(-mpix, -mpix, W+2*mpix, H+2*mpix)
+            gaia = read_gaia(marginwcs, None)
+            gaia.cut(gaia.isgaia * gaia.pointsource)
+            self.halostars = gaia
+            print('Got', len(gaia), 'Gaia stars for halo subtraction in the exposure')
+
+        self.outlier_bricks = bricks_touching_wcs(self.wcs, survey=survey)
+
+        self.catalog = None
+        self.sga = None
+        if read_catalog:
+            set_catalog_bricks(survey, catsurvey_north, catsurvey_south)
+            self.catalog = get_catalog_in_wcs(self.wcs, survey, catsurvey_north,
+                                              catsurvey_south=catsurvey_south,
+                                              resolve_dec=resolve_dec)
+            self.sga = read_frozen_sga(survey, self.wcs)
+
+    def get_halo_stars(self, chipwcs):
+        return cut_to_keep_radius(self.halostars, chipwcs)
+
+    def get_outlier_bricks(self, chipwcs):
+        return bricks_touching_wcs(chipwcs, B=self.outlier_bricks)
+
+    def get_catalog(self, chipwcs, margin=20):
+        '''
+        Returns the catalog sources within *margin* pixels of the chip,
+        plus any frozen SGA galaxies touching it (as get_catalog_in_wcs
+        would), or None.
+        '''
+        T = self.catalog
+        if T is None:
+            return None
+        _,xx,yy = chipwcs.radec2pixelxy(T.ra, T.dec)
+        W,H = chipwcs.get_width(), chipwcs.get_height()
+        keep = ((xx >= -margin) * (xx <= (W+margin)) *
+                (yy >= -margin) * (yy <= (H+margin)))
+        if not np.any(keep):
+            return None
+        if self.sga is not None:
+            sga = cut_to_keep_radius(self.sga, chipwcs)
+            keep |= (T.ref_cat == 'L3') * np.isin(T.ref_id, sga.ref_id)
+        R = T[np.flatnonzero(keep)]
+        R._header = T._header
+        print('Total of', len(R), 'catalog sources')
+        return R
+
+def cut_to_keep_radius(T, wcs):
+    '''
+    Returns the reference objects in *T* whose "keep_radius" touches the
+    image described by *wcs*.
+    '''
+    H,W = wcs.shape
+    keeprad = np.ceil(T.keep_radius * 3600. / wcs.pixel_scale()).astype(int)
+    _,xx,yy = wcs.radec2pixelxy(T.ra, T.dec)
+    return T[(xx > -keeprad) * (xx < W+keeprad) *
+             (yy > -keeprad) * (yy < H+keeprad)]
+
+def set_catalog_bricks(survey, catsurvey_north, catsurvey_south):
+    # The "north" and "south" directories often don't have
+    # 'survey-bricks" files of their own -- use the 'survey' one
+    # instead.
+    if catsurvey_south is not None:
+        try:
+            catsurvey_south.get_bricks_readonly()
+        except:
+            catsurvey_south.bricks = survey.get_bricks_readonly()
+    if catsurvey_north is not None:
+        try:
+            catsurvey_north.get_bricks_readonly()
+        except:
+            catsurvey_north.bricks = survey.get_bricks_readonly()
+
 def get_catalog_in_wcs(chipwcs, survey, catsurvey_north, catsurvey_south=None,
                        resolve_dec=None, margin=20):
     TT = []
@@ -346,6 +501,7 @@ def get_catalog_in_wcs(chipwcs, survey, catsurvey_north, catsurvey_south=None,
                'brickid', 'brickname', 'objid',
                'sersic', 'shape_r', 'shape_e1', 'shape_e2',
                'ref_epoch', 'pmra', 'pmdec', 'parallax', 'ref_cat', 'ref_id',]
+    catcache = get_brick_catalog_cache(columns)
 
     for catsurvey,north in surveys:
         bricks = bricks_touching_wcs(chipwcs, survey=catsurvey)
@@ -368,8 +524,8 @@ def get_catalog_in_wcs(chipwcs, survey, catsurvey_north, catsurvey_south=None,
             if not os.path.exists(fn):
                 print('WARNING: catalog', fn, 'does not exist.  Skipping!')
                 continue
-            print('Reading', fn)
-            T = fits_table(fn, columns=columns)
+            # (primary, non-DUP sources near the chip, from the cache)
+            T = catcache.read_in_wcs(fn, chipwcs, margin=margin)
             if resolve_dec is not None:
                 if north:
                     T.cut(T.dec >= resolve_dec)
@@ -378,17 +534,6 @@ def get_catalog_in_wcs(chipwcs, survey, catsurvey_north, catsurvey_south=None,
                     # Northern galactic cap only: cut Southern survey
                     T.cut(T.dec <  resolve_dec)
                     print('Cut to', len(T), 'south of the resolve line')
-            _,xx,yy = chipwcs.radec2pixelxy(T.ra, T.dec)
-            W,H = chipwcs.get_width(), chipwcs.get_height()
-            # Cut to sources that are inside the image+margin
-            T.cut((xx >= -margin) * (xx <= (W+margin)) *
-                  (yy >= -margin) * (yy <= (H+margin)))
-            T.cut(T.brick_primary)
-            #print('Cut to', len(T), 'on brick_primary')
-            # drop DUP sources
-            I, = np.nonzero([t.strip() != 'DUP' for t in T.type])
-            T.cut(I)
-            #print('Cut to', len(T), 'after removing DUP')
             if len(T):
                 TT.append(T)
     if len(TT) == 0:
@@ -404,12 +549,9 @@ def get_catalog_in_wcs(chipwcs, survey, catsurvey_north, catsurvey_south=None,
     print('Total of', len(T), 'catalog sources')
     return T
 
-def find_missing_sga(T, chipwcs, survey, surveys, columns):
-    # Look up SGA large galaxies touching this chip.
-    # The ones inside this chip(+margin) will already exist in the catalog;
-    # we'll find the ones we're missing and read those extra brick catalogs.
+def read_frozen_sga(survey, chipwcs):
+    # Look up the frozen SGA large galaxies touching this chip.
     from legacypipe.reference import read_large_galaxies
-    # Find all the SGA sources we need
     sga = read_large_galaxies(survey, chipwcs, bands=None, extra_columns=['brickname'])
     if sga is None:
         print('No SGA galaxies found')
@@ -418,17 +560,22 @@ def find_missing_sga(T, chipwcs, survey, surveys, columns):
     if len(sga) == 0:
         print('No frozen SGA galaxies found')
         return None
-    # keep_radius to pix
-    keeprad = np.ceil(sga.keep_radius * 3600. / chipwcs.pixel_scale()).astype(int)
-    _,xx,yy = chipwcs.radec2pixelxy(sga.ra, sga.dec)
-    H,W = chipwcs.shape
     # cut to those touching the chip
-    sga.cut((xx > -keeprad) * (xx < W+keeprad) *
-            (yy > -keeprad) * (yy < H+keeprad))
+    sga = cut_to_keep_radius(sga, chipwcs)
     #print('Read', len(sga), 'SGA galaxies touching the chip.')
     if len(sga) == 0:
         print('No SGA galaxies touch this chip')
         return None
+    return sga
+
+def find_missing_sga(T, chipwcs, survey, surveys, columns):
+    # Look up SGA large galaxies touching this chip.
+    # The ones inside this chip(+margin) will already exist in the catalog;
+    # we'll find the ones we're missing and read those extra brick catalogs.
+    # Find all the SGA sources we need
+    sga = read_frozen_sga(survey, chipwcs)
+    if sga is None:
+        return None
     Tsga = T[T.ref_cat == 'L3']
     #print(len(Tsga), 'SGA entries already exist in catalog')
     Isga = np.array([i for i,sga_id in enumerate(sga.ref_id) if not sga_id in set(Tsga.ref_id)])
@@ -471,13 +618,12 @@ def find_missing_sga(T, chipwcs, survey, surveys, columns):
         for catsurvey,_ in surveys:
             fn = catsurvey.find_file('tractor', brick=brick)
             if os.path.exists(fn):
-                t = fits_table(fn, columns=['ref_cat', 'ref_id'])
+                t = get_brick_catalog_cache(columns).get(fn)
                 I = np.flatnonzero(t.ref_cat == 'L3')
                 #print('Read', len(I), 'SGA entries from', brick)
-                SGA.append(fits_table(fn, columns=columns, rows=I))
+                SGA.append(t[I])
                 break
     SGA = merge_tables(SGA)
-    SGA.cut(SGA.brick_primary)
     #print('Total of', len(SGA), 'sources')
     I = np.array([i for i,ref_id in enumerate(SGA.ref_id) if ref_id in set(sga.ref_id)])
     SGA.cut(I)
@@ -487,7 +633,8 @@ def find_missing_sga(T, chipwcs, survey, surveys, columns):
     return SGA
 
 def forced_photom_one_ccd(survey, catsurvey_north, catsurvey_south, resolve_dec,
-                          ccd, opt, zoomslice, radecpoly, outlier_bricks, ps):
+                          ccd, opt, zoomslice, radecpoly, outlier_bricks, ps,
+                          exposure=None):
     from functools import reduce
     from legacypipe.bits import DQ_BITS
 
@@ -525,35 +672,24 @@ def forced_photom_one_ccd(survey, catsurvey_north, catsurvey_south, resolve_dec,
         # Halo subtraction
         from legacypipe.halos import subtract_one
         from legacypipe.reference import mask_radius_for_mag, read_gaia
-        ref_margin = mask_radius_for_mag(0.)
-        mpix = int(np.ceil(ref_margin * 3600. / chipwcs.pixel_scale()))
-        marginwcs = chipwcs.get_subimage(-mpix, -mpix, W+2*mpix, H+2*mpix)
-        gaia = read_gaia(marginwcs, None)
-        keeprad = np.ceil(gaia.keep_radius * 3600. / chipwcs.pixel_scale()).astype(int)
-        _,xx,yy = chipwcs.radec2pixelxy(gaia.ra, gaia.dec)
-        # cut to those touching the chip
-        gaia.cut((xx > -keeprad) * (xx < W+keeprad) *
-                 (yy > -keeprad) * (yy < H+keeprad))
-        Igaia, = np.nonzero(gaia.isgaia * gaia.pointsource)
-        halostars = gaia[Igaia]
-        print('Got', len(gaia), 'Gaia stars,', len(halostars), 'for halo subtraction')
+        if exposure is not None:
+            halostars = exposure.get_halo_stars(chipwcs)
+            print('Got', len(halostars), 'Gaia stars for halo subtraction')
+        else:
+            ref_margin = mask_radius_for_mag(0.)
+            mpix = int(np.ceil(ref_margin * 3600. / chipwcs.pixel_scale()))
+            marginwcs = chipwcs.get_subimage(-mpix, -mpix, W+2*mpix, H+2*mpix)
+            gaia = read_gaia(marginwcs, None)
+            # cut to those touching the chip
+            gaia = cut_to_keep_radius(gaia, chipwcs)
+            Igaia, = np.nonzero(gaia.isgaia * gaia.pointsource)
+            halostars = gaia[Igaia]
+            print('Got', len(gaia), 'Gaia stars,', len(halostars), 'for halo subtraction')
         moffat = True
         _,halos = subtract_one((0, tim, halostars, moffat, old_calibs_ok))
         tim.data -= halos
 
-    # The "north" and "south" directories often don't have
-    # 'survey-bricks" files of their own -- use the 'survey' one
-    # instead.
-    if catsurvey_south is not None:
-        try:
-            catsurvey_south.get_bricks_readonly()
-        except:
-            catsurvey_south.bricks = survey.get_bricks_readonly()
-    if catsurvey_north is not None:
-        try:
-            catsurvey_north.get_bricks_readonly()
-        except:
-            catsurvey_north.bricks = survey.get_bricks_readonly()
+    set_catalog_bricks(survey, catsurvey_north, catsurvey_south)
 
     # Apply outlier masks
     outlier_header = None
@@ -566,7 +702,10 @@ def forced_photom_one_ccd(survey, catsurvey_north, catsurvey_south, resolve_dec,
     # # for dr9), and are stored in a brick-oriented way, in the
     # # results directories.
     if outlier_bricks is None:
-        outlier_bricks = bricks_touching_wcs(chipwcs, survey=survey)
+        if exposure is not None:
+            outlier_bricks = exposure.get_outlier_bricks(chipwcs)
+        else:
+            outlier_bricks = bricks_touching_wcs(chipwcs, survey=survey)
 
     for b in outlier_bricks:
         print('Reading outlier mask for brick', b.brickname,
@@ -593,8 +732,12 @@ def forced_photom_one_ccd(survey, catsurvey_north, catsurvey_south, resolve_dec,
         T = fits_table(opt.catalog)
     else:
         chipwcs = tim.subwcs
-        T = get_catalog_in_wcs(chipwcs, survey, catsurvey_north, catsurvey_south=catsurvey_south,
-                               resolve_dec=resolve_dec)
+        if exposure is not None:
+            T = exposure.get_catalog(chipwcs)
+        else:
+            T = get_catalog_in_wcs(chipwcs, survey, catsurvey_north,
+                                   catsurvey_south=catsurvey_south,
+                                   resolve_dec=resolve_dec)
         if T is None:
             print('No sources to photometer.')
             return None
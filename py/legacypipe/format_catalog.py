@@ -303,7 +303,7 @@ def format_all_models(T, newcat, BB, bands, allbands, force_keep=None):
 
     TT = fits_table()
     # Copy only desired columns...
-    for k in ['blob', 'brickid', 'brickname', 'dchisq', 'objid',
+    for k in ['blob', 'brickid', 'brickname', 'dchisq', 'dchisq_pruned', 'objid',
               'ra','dec',
               'cpu_arch', 'cpu_source', 'cpu_blob', 'ninblob',
               'blob_width', 'blob_height', 'blob_npix', 'blob_nimages',
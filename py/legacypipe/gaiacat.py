@@ -28,11 +28,9 @@ class GaiaCatalog(HealpixedCatalog):
         # Prepare RA,Dec grid to pick up overlapping healpixes
         rr,dd = np.meshgrid(np.linspace(ralo,  rahi,  2+int(( rahi- ralo)/0.1)),
                             np.linspace(declo, dechi, 2+int((dechi-declo)/0.1)))
-        healpixes = set()
-        for r,d in zip(rr.ravel(), dd.ravel()):
-            healpixes.add(self.healpix_for_radec(r, d))
+        healpixes = self.healpixes_for_radec(rr.ravel(), dd.ravel())
         # Read catalog in those healpixes
-        cat = self.get_healpix_catalogs(healpixes)
+        cat = self.get_healpix_catalogs(healpixes, dec_range=(declo, dechi))
         #print('Read', len(cat), 'Gaia catalog entries.  RA range', cat.ra.min(), cat.ra.max(),
         #      'Dec range', cat.dec.min(), cat.dec.max())
         cat.cut((cat.dec >= declo) * (cat.dec <= dechi))
@@ -32,8 +32,79 @@ def subtract_one(X):
 def moffat(rr, alpha, beta):
     return (beta-1.)/(np.pi * alpha**2)*(1. + (rr/alpha)**2)**(-beta)
 
+# Number of samples of the tabulated halo profiles across the inner
+# apodization ramp (about 4 pixels for DECam); the same spacing is used
+# out to the largest halo radius.
+HALO_PROFILE_RAMP_SAMPLES = 64
+
+def decam_halo_profile(band, ccdname, pixscale, rmax, inner_moffat=None,
+                       outer_weight=1.):
+    '''
+    Tabulates the unit-flux halo profile for a DECam CCD, including the
+    inner apodization, in nanomaggies per pixel, out to radius *rmax*
+    pixels.
+
+    The profile is sampled at radii r0 + k * dr, where the inner
+    apodization ramp starts at r0 (inside which the profile is zero)
+    and ends exactly on a sample, so that linear interpolation is exact
+    for the ramp and very accurate for the smooth profiles.
+
+    *outer_weight* scales the outer profile (but not the inner Moffat,
+    included if *inner_moffat* = (alpha, beta) is given).
+
+    Returns (r0, dr, profile).
+    '''
+    # Inner apodization: ramp from 0 up to 1 between Rongpu's "R3"
+    # and "R4" radii
+    apr_i0 = 7. / pixscale
+    apr_i1 = 8. / pixscale
+    dr = (apr_i1 - apr_i0) / HALO_PROFILE_RAMP_SAMPLES
+    rads = apr_i0 + np.arange(int(np.ceil(max(rmax - apr_i0, 0.) / dr)) + 2) * dr
+    apodize = np.clip((rads - apr_i0) / (apr_i1 - apr_i0), 0., 1.)
+    r = rads * pixscale
+
+    if band == 'z':
+        '''
+        For z band, the outer PSF is a weighted Moffat profile. For most
+        CCDs, the Moffat parameters (with radius in arcsec and SB in nmgy per
+        sq arcsec) and the weight are (for a 22.5 magnitude star):
+            alpha, beta, weight = 17.650, 1.7, 0.0145
+
+        However, a small subset of DECam CCDs (which are N20, S8,
+        S10, S18, S21 and S27) have a more compact outer PSF in z
+        band, which can still be characterized by a weigthed
+        Moffat with the following parameters:
+            alpha, beta, weight = 16, 2.3, 0.0095
+        '''
+        if ccdname.strip() in ['N20', 'S8', 'S10', 'S18', 'S21', 'S27']:
+            alpha, beta, weight = 16, 2.3, 0.0095
+        else:
+            alpha, beta, weight = 17.650, 1.7, 0.0145
+        prof = outer_weight * weight * moffat(r, alpha, beta)
+    else:
+        fd = dict(g=0.00045,
+                  r=0.00033,
+                  i=0.00033)
+        prof = outer_weight * fd[band] * r**-2
+
+    if inner_moffat is not None:
+        inner_alpha, inner_beta = inner_moffat
+        prof += moffat(r, inner_alpha, inner_beta)
+
+    # The 'pixscale**2' is because Rongpu's formula is in nanomaggies/arcsec^2
+    prof *= apodize * pixscale**2
+    return apr_i0, dr, prof.astype(np.float32)
+
 def decam_halo_model(refs, mjd, wcs, pixscale, band, imobj, include_moffat,
                      old_calibs_ok=False):
+    '''
+    Renders the halos of reference stars *refs* into an image with the
+    given *wcs*.
+
+    The radial profile (which is the same for all stars on a CCD, up to
+    the outer apodization) is tabulated once, with
+    decam_halo_profile, and interpolated for each star, in float32.
+    '''
     from legacypipe.survey import radec_at_mjd
     assert(np.all(refs.ref_epoch > 0))
     rr,dd = radec_at_mjd(refs.ra, refs.dec, refs.ref_epoch.astype(float),
@@ -46,32 +117,37 @@ def decam_halo_model(refs, mjd, wcs, pixscale, band, imobj, include_moffat,
     good = np.flatnonzero(mag != 0.)
     fluxes = 10.**((mag - 22.5) / -2.5)
 
-    have_inner_moffat = False
+    inner_moffat = None
     if include_moffat:
         psf = imobj.read_psf_model(0,0, pixPsf=True,
                                    old_calibs_ok=old_calibs_ok)
         if hasattr(psf, 'moffat'):
-            have_inner_moffat = True
-            inner_alpha, inner_beta = psf.moffat
-            debug('Read inner Moffat parameters', (inner_alpha, inner_beta),
+            inner_moffat = psf.moffat
+            debug('Read inner Moffat parameters', inner_moffat,
                   'from PsfEx file')
 
     H,W = wcs.shape
     H = int(H)
     W = int(W)
     halo = np.zeros((H,W), np.float32)
-    for ref,flux,ra,dec in zip(refs[good], fluxes[good], rr[good], dd[good]):
-        _,x,y = wcs.radec2pixelxy(ra, dec)
-        x -= 1.
-        y -= 1.
-
-        rad_arcsec = ref.radius * 3600.
-        # We subtract halos out to N x their masking radii.
-        rad_arcsec *= 4.0
-        # Rongpu says only apply within:
-        rad_arcsec = np.minimum(rad_arcsec, 400.)
-        pixrad = int(np.ceil(rad_arcsec / pixscale))
-
+    if len(good) == 0:
+        return halo
+
+    _,xx,yy = wcs.radec2pixelxy(rr[good], dd[good])
+    xx = np.atleast_1d(xx) - 1.
+    yy = np.atleast_1d(yy) - 1.
+
+    rad_arcsec = refs.radius[good] * 3600.
+    # We subtract halos out to N x their masking radii.
+    rad_arcsec *= 4.0
+    # Rongpu says only apply within:
+    rad_arcsec = np.minimum(rad_arcsec, 400.)
+    pixrads = np.ceil(rad_arcsec / pixscale).astype(int)
+
+    # (the box around a star reaches out to (pixrad+1)*sqrt(2))
+    rmax = (np.max(pixrads) + 1) * np.sqrt(2.)
+    profiles = {}
+    for flux,x,y,pixrad in zip(fluxes[good], xx, yy, pixrads):
         xlo = int(np.clip(np.floor(x - pixrad), 0, W-1))
         xhi = int(np.clip(np.ceil (x + pixrad), 0, W-1))
         ylo = int(np.clip(np.floor(y - pixrad), 0, H-1))
@@ -79,57 +155,30 @@ def decam_halo_model(refs, mjd, wcs, pixscale, band, imobj, include_moffat,
         if xlo == xhi or ylo == yhi:
             continue
 
-        rads = np.hypot(np.arange(ylo, yhi+1)[:,np.newaxis] - y,
-                        np.arange(xlo, xhi+1)[np.newaxis,:] - x)
-        maxr = pixrad
+        outer_weight = 1.
+        if band == 'z' and (x < 0 or y < 0 or x > W-1 or y > H-1):
+            # Reduce the weight by half for z-band halos that are off the chip.
+            outer_weight = 0.5
+        if not outer_weight in profiles:
+            profiles[outer_weight] = decam_halo_profile(
+                band, imobj.ccdname, pixscale, rmax, inner_moffat=inner_moffat,
+                outer_weight=outer_weight)
+        r0,dr,prof = profiles[outer_weight]
+
+        dy = np.arange(ylo, yhi+1, dtype=np.float32) - np.float32(y)
+        dx = np.arange(xlo, xhi+1, dtype=np.float32) - np.float32(x)
+        rads = np.sqrt(dy[:,np.newaxis]**2 + dx[np.newaxis,:]**2)
+        # Interpolate the tabulated profile (zero inside r0)
+        t = np.maximum((rads - np.float32(r0)) * np.float32(1./dr), np.float32(0.))
+        k = t.astype(np.int32)
+        t -= k
+        mod = prof[k]
+        mod += t * (prof[k+1] - mod)
+
         # Outer apodization
+        maxr = pixrad
         apr = maxr*0.5
-        apodize = np.clip((rads - maxr) / (apr - maxr), 0., 1.)
-
-        # Inner apodization: ramp from 0 up to 1 between Rongpu's "R3"
-        # and "R4" radii
-        apr_i0 = 7. / pixscale
-        apr_i1 = 8. / pixscale
-        apodize *= np.clip((rads - apr_i0) / (apr_i1 - apr_i0), 0., 1.)
-
-        if band == 'z':
-            '''
-            For z band, the outer PSF is a weighted Moffat profile. For most
-            CCDs, the Moffat parameters (with radius in arcsec and SB in nmgy per
-            sq arcsec) and the weight are (for a 22.5 magnitude star):
-                alpha, beta, weight = 17.650, 1.7, 0.0145
-
-            However, a small subset of DECam CCDs (which are N20, S8,
-            S10, S18, S21 and S27) have a more compact outer PSF in z
-            band, which can still be characterized by a weigthed
-            Moffat with the following parameters:
-                alpha, beta, weight = 16, 2.3, 0.0095
-            '''
-            if imobj.ccdname.strip() in ['N20', 'S8', 'S10', 'S18', 'S21', 'S27']:
-                alpha, beta, weight = 16, 2.3, 0.0095
-            else:
-                alpha, beta, weight = 17.650, 1.7, 0.0145
-
-            if x < 0 or y < 0 or x > W-1 or y > H-1:
-                # Reduce the weight by half for z-band halos that are off the chip.
-                weight *= 0.5
-
-            # The 'pixscale**2' is because Rongpu's formula is in nanomaggies/arcsec^2
-            halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * weight *
-                                           moffat(rads*pixscale, alpha, beta) * pixscale**2)
-
-        else:
-             fd = dict(g=0.00045,
-                       r=0.00033,
-                       i=0.00033)
-             f = fd[band]
-
-             halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * f * (rads*pixscale)**-2
-                                            * pixscale**2)
-
-        if have_inner_moffat:
-            weight = 1.
-            halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * weight *
-                                           moffat(rads*pixscale, inner_alpha, inner_beta) * pixscale**2)
-
+        mod *= np.float32(flux) * np.clip((rads - np.float32(maxr)) * np.float32(1./(apr - maxr)),
+                                          np.float32(0.), np.float32(1.))
+        halo[ylo:yhi+1, xlo:xhi+1] += mod
     return halo
@@ -1059,6 +1059,25 @@ class LegacySurveyImage(object):
         return galnorm
 
     def _read_fits(self, fn, hdu, slc=None, header=None, fitsobj=None, **kwargs):
+        key = None
+        if pixel_cache is not None and len(kwargs) == 0:
+            key = _pixel_cache_key(fn, hdu, slc, header)
+        if key is not None:
+            r = pixel_cache.get(key)
+            if r is None:
+                r = self._read_fits_uncached(fn, hdu, slc=slc, header=header,
+                                             fitsobj=fitsobj)
+                pixel_cache.put(key, r)
+            # Callers modify the pixels in place, so hand out copies.
+            if header:
+                img,hdr = r
+                return img.copy(), hdr
+            return r.copy()
+        return self._read_fits_uncached(fn, hdu, slc=slc, header=header,
+                                        fitsobj=fitsobj, **kwargs)
+
+    def _read_fits_uncached(self, fn, hdu, slc=None, header=None, fitsobj=None,
+                            **kwargs):
         if slc is not None:
             if fitsobj is None:
                 fitsobj = fitsio.FITS(fn)
@@ -1246,18 +1265,16 @@ class LegacySurveyImage(object):
         for fn,skytype in tryfns:
             if not os.path.exists(fn):
                 continue
-            T = fits_table(fn)
-            I, = np.nonzero((T.expnum == self.expnum) *
-                            np.array([c.strip() == self.ccdname
-                                      for c in T.ccdname]))
+            index = get_calib_index(fn)
+            I = index.find(self.expnum, self.ccdname)
             debug('Found', len(I), 'matching CCDs (expnum %i, ccdname %s) in sky file (%s) %s' % (self.expnum, self.ccdname, skytype, fn))
             if len(I) != 1:
                 continue
             if not self.validate_version(
                     fn, 'table', self.expnum, self.plver, self.plprocid,
-                    data=T, old_calibs_ok=old_calibs_ok):
+                    data=index.T, old_calibs_ok=old_calibs_ok):
                 raise RuntimeError('Sky file %s did not pass consistency validation (PLVER, PLPROCID, EXPNUM)' % fn)
-            Ti = T[I[0]]
+            Ti = index.read_row(I[0])
             break
         if Ti is None:
             raise RuntimeError('Failed to find sky model in files: %s'
@@ -1339,19 +1356,17 @@ class LegacySurveyImage(object):
         for fn in tryfns:
             if not os.path.exists(fn):
                 continue
-            T = fits_table(fn)
-            header = T.get_header()
-            I, = np.nonzero((T.expnum == self.expnum) *
-                            np.array([c.strip() == self.ccdname
-                                      for c in T.ccdname]))
+            index = get_calib_index(fn)
+            header = index.header
+            I = index.find(self.expnum, self.ccdname)
             debug('Found', len(I), 'matching CCDs')
             if len(I) != 1:
                 continue
             if not self.validate_version(
                     fn, 'table', self.expnum, self.plver, self.plprocid,
-                    data=T, old_calibs_ok=old_calibs_ok):
+                    data=index.T, old_calibs_ok=old_calibs_ok):
                 raise RuntimeError('Merged PSFEx file %s did not pass consistency validation (PLVER, PLPROCID, EXPNUM)' % fn)
-            Ti = T[I[0]]
+            Ti = index.read_row(I[0])
             break
         if Ti is None:
             raise RuntimeError('Failed to find PsfEx model in files: %s' % ', '.join(tryfns))
@@ -2195,6 +2210,85 @@ def _read_one_ext(args):
     fn,ext = args
     fitsio.read(fn, ext=ext)
 
+class CalibIndex(object):
+    '''
+    An index of a (merged or single-CCD) PsfEx or sky calibration
+    table: maps (expnum, ccdname) to row numbers, and holds the small
+    columns needed for validation (EXPNUM, CCDNAME, PLVER, PLPROCID)
+    plus the table header.  Full rows are read on demand with *rows=*.
+    '''
+    index_columns = ['expnum', 'ccdname', 'plver', 'plprocid']
+
+    def __init__(self, fn):
+        self.fn = fn
+        F = fitsio.FITS(fn)
+        allcols = [c.lower() for c in F[1].get_colnames()]
+        F.close()
+        cols = [c for c in self.index_columns if c in allcols]
+        self.T = fits_table(fn, columns=cols)
+        self.header = self.T.get_header()
+        self.rows = {}
+        for i,(e,c) in enumerate(zip(self.T.expnum, self.T.ccdname)):
+            self.rows.setdefault((int(e), c.strip()), []).append(i)
+
+    def find(self, expnum, ccdname):
+        '''
+        Returns the list of row numbers matching *expnum*, *ccdname*.
+        '''
+        return self.rows.get((int(expnum), ccdname.strip()), [])
+
+    def read_row(self, row):
+        T = fits_table(self.fn, rows=np.array([row]))
+        return T[0]
+
+# Optional process-wide cache of the decompressed pixels read by
+# LegacySurveyImage._read_fits (image, weight and DQ maps), enabled by
+# legacy_zeropoints.py so that the calibration and zeropoint steps for a
+# CCD, run in the same process, only decompress each extension once.
+pixel_cache = None
+def set_pixel_cache(maxsize):
+    '''
+    Enables caching of image pixels, keeping up to *maxsize* bytes; or,
+    with *maxsize* None, disables (and empties) the cache.
+    '''
+    global pixel_cache
+    from legacypipe.utils import LRUCache
+    if maxsize is None:
+        pixel_cache = None
+    else:
+        pixel_cache = LRUCache(maxsize=maxsize)
+
+def _pixel_cache_key(fn, hdu, slc, header):
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    if slc is not None:
+        slc = tuple((s.start, s.stop, s.step) for s in slc)
+    return (fn, st.st_mtime_ns, st.st_size, hdu, slc, bool(header))
+
+# Process-wide cache of CalibIndex objects, so that the CCDs of one
+# exposure (and of later bricks touching it) do not re-read the merged
+# calibration tables.
+calib_index_cache = None
+def get_calib_index(fn):
+    '''
+    Returns the (cached) CalibIndex for calibration file *fn*.  Cache
+    entries are invalidated if the file's modification time or size
+    changes, eg, when calibrations are re-run.
+    '''
+    global calib_index_cache
+    from legacypipe.utils import LRUCache
+    if calib_index_cache is None:
+        calib_index_cache = LRUCache(maxitems=1000)
+    st = os.stat(fn)
+    key = (fn, st.st_mtime_ns, st.st_size)
+    index = calib_index_cache.get(key)
+    if index is None:
+        index = CalibIndex(fn)
+        calib_index_cache.put(key, index)
+    return index
+
 def psfex_single_to_merged(infn, expnum, ccdname):
     # returns table T
     T = fits_table(infn)
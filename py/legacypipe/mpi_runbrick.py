@@ -176,7 +176,7 @@ def main(args=None):
     pool.bootup()
     print('Booted up MPI pool.')
     pool._processes = u
-    kwargs.update(pool=pool)
+    kwargs.update(pool=pool, nworkers=u)
 
     rtn = -1
     try:
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import time
 
@@ -67,6 +68,11 @@ def get_cpu_arch():
     cpu_arch = codenames.get((family, model), '')
     return cpu_arch
 
+# When pruning, a model is abandoned if its chi-squared improvement after
+# the first optimizer steps, plus this margin, plus the improvement
+# achieved in those steps, is still less than it needs to be selected.
+PRUNE_MARGIN = 9.
+
 def one_blob(X):
     '''
     Fits sources contained within a "blob" of pixels.
@@ -75,7 +81,9 @@ def one_blob(X):
         return None
     (nblob, iblob, Isrcs, brickwcs, bx0, by0, blobw, blobh, blobmask, timargs,
      srcs, bands, plots, ps, reoptimize, iterative, use_ceres, refmap,
-     large_galaxies_force_pointsource, less_masking, frozen_galaxies) = X
+     large_galaxies_force_pointsource, less_masking, frozen_galaxies) = X[:21]
+    # Options for OneBlob (eg, model_threads), from runbrick's _blob_iter
+    fit_opts = X[21] if len(X) > 21 else {}
 
     debug('Fitting blob %s: blobid %i, nsources %i, size %i x %i, %i images, %i frozen galaxies' %
           (nblob, iblob, len(Isrcs), blobw, blobh, len(timargs), len(frozen_galaxies)))
@@ -85,6 +93,10 @@ def one_blob(X):
     if len(Isrcs) == 0:
         return None
 
+    # With runbrick --shared-tims, the pixels arrive as shared-memory descriptors.
+    from legacypipe.shared_tims import resolve_timargs
+    timargs = resolve_timargs(timargs)
+
     assert(blobmask.shape == (blobh,blobw))
     assert(refmap.shape == (blobh,blobw))
 
@@ -123,7 +135,7 @@ def one_blob(X):
     ob = OneBlob(nblob, blobwcs, blobmask, timargs, srcs, bands,
                  plots, ps, use_ceres, refmap,
                  large_galaxies_force_pointsource,
-                 less_masking, frozen_galaxies)
+                 less_masking, frozen_galaxies, **fit_opts)
     B = ob.run(B, reoptimize=reoptimize, iterative_detection=iterative)
 
     _,x1,y1 = blobwcs.radec2pixelxy(
@@ -164,7 +176,18 @@ class OneBlob(object):
     def __init__(self, name, blobwcs, blobmask, timargs, srcs, bands,
                  plots, ps, use_ceres, refmap,
                  large_galaxies_force_pointsource,
-                 less_masking, frozen_galaxies):
+                 less_masking, frozen_galaxies, model_threads=0,
+                 prune_models=0, crop_detmaps=False):
+        '''
+        *model_threads*: fit each source's candidate models concurrently
+         in this many threads; 0 means serially.
+        *prune_models*: abandon hopeless galaxy model fits after this
+         many optimizer steps (runbrick --prune-models); 0 means never.
+        *crop_detmaps*: build each source's symmetric mask from a crop
+         of the blob's detection maps (with all sources present), rather
+         than from detection maps of its residual images (runbrick
+         --crop-detmaps).
+        '''
         self.name = name
         self.blobwcs = blobwcs
         self.pixscale = self.blobwcs.pixel_scale()
@@ -195,6 +218,13 @@ class OneBlob(object):
             debug('Big blob:', name)
         self.trargs = dict()
         self.frozen_galaxy_mods = []
+        self.model_threads = model_threads or 0
+        self.model_pool = None
+        self.model_prune = prune_models or 0
+        self.crop_detmaps = crop_detmaps
+        # per-band detection S/N maps, set in compute_segmentation_map()
+        # if crop_detmaps
+        self.detsns = None
 
         if len(frozen_galaxies):
             debug('Subtracting frozen galaxy models...')
@@ -397,8 +427,17 @@ class OneBlob(object):
         self.compute_segmentation_map()
 
         # Next, model selections: point source vs dev/exp vs ser.
-        B = self.run_model_selection(cat, Ibright, B,
-                                     iterative_detection=iterative_detection)
+        if self.model_threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self.model_pool = ThreadPoolExecutor(self.model_threads)
+        try:
+            B = self.run_model_selection(cat, Ibright, B,
+                                         iterative_detection=iterative_detection)
+        finally:
+            if self.model_pool is not None:
+                self.model_pool.shutdown()
+                self.model_pool = None
+            self.detsns = None
 
         debug('Blob', self.name, 'finished model selection:', Time()-tlast)
         tlast = Time()
@@ -530,8 +569,14 @@ class OneBlob(object):
         del satmaps
 
         maxsn = 0
+        if self.crop_detmaps:
+            # Per-band S/N maps, kept to be cropped for each source's
+            # symmetric mask in model_selection_one_source.
+            self.detsns = []
         for i,(detmap,detiv) in enumerate(zip(detmaps,detivs)):
             sn = detmap * np.sqrt(detiv)
+            if self.crop_detmaps:
+                self.detsns.append(sn)
 
             if self.plots and False:
                 import pylab as plt
@@ -686,6 +731,9 @@ class OneBlob(object):
 
         N = len(cat)
         B.dchisq = np.zeros((N, 5), np.float32)
+        # Bitmask (in MODEL_NAMES order) of the models whose fits were
+        # abandoned by pruning; their DCHISQ values are zero.
+        B.dchisq_pruned = np.zeros(N, np.uint8)
         B.all_models    = np.array([{} for i in range(N)])
         B.all_model_ivs = np.array([{} for i in range(N)])
         B.all_model_cpu = np.array([{} for i in range(N)])
@@ -1058,14 +1106,24 @@ class OneBlob(object):
         # finding symmetrized blobs of significant pixels
         mask_others = True
         if mask_others:
-            from legacypipe.detection import detection_maps
-            from astrometry.util.multiproc import multiproc
             from scipy.ndimage.morphology import binary_dilation, binary_fill_holes
             from scipy.ndimage.measurements import label
-            # Compute per-band detection maps
-            mp = multiproc()
-            detmaps,detivs,_ = detection_maps(
-                srctims, srcwcs, self.bands, mp)
+            if self.crop_detmaps:
+                # Crop the per-band detection S/N maps (computed for the
+                # whole blob in compute_segmentation_map) to this source
+                sx0,sy0 = srcwcs_x0y0
+                sh,sw = srcwcs.shape
+                detsns = [sn[sy0:sy0+sh, sx0:sx0+sw] for sn in self.detsns]
+            else:
+                from legacypipe.detection import detection_maps
+                from astrometry.util.multiproc import multiproc
+                # Compute per-band detection maps
+                mp = multiproc()
+                detmaps,detivs,_ = detection_maps(
+                    srctims, srcwcs, self.bands, mp)
+                detsns = [detmap * np.sqrt(detiv)
+                          for detmap,detiv in zip(detmaps,detivs)]
+                del detmaps,detivs
             # Compute the symmetric area that fits in this 'srcblobmask' region
             pos = src.getPosition()
             _,xx,yy = srcwcs.radec2pixelxy(pos.ra, pos.dec)
@@ -1079,8 +1137,9 @@ class OneBlob(object):
             slc = (slice(iy-fliph, iy+fliph+1),
                    slice(ix-flipw, ix+flipw+1))
             # Go through the per-band detection maps, marking significant pixels
-            for i,(detmap,detiv) in enumerate(zip(detmaps,detivs)):
-                sn = detmap * np.sqrt(detiv)
+            for sn in detsns:
+                if self.crop_detmaps:
+                    sn = sn.copy()
                 # flipsn = np.zeros_like(sn)
                 # # Symmetrize
                 # flipsn[slc] = np.minimum(sn[slc],
@@ -1417,36 +1476,12 @@ class OneBlob(object):
             trymodels.extend([('rex', rex), ('dev', dev), ('exp', exp),
                               ('ser', None)])
 
-        cputimes = {}
-        for name,newsrc in trymodels:
-            cpum0 = time.process_time()
-
-            if name == 'gals':
-                # If 'rex' was better than 'psf', or the source is
-                # bright, try the galaxy models.
-                chi_rex = chisqs.get('rex', 0)
-                chi_psf = chisqs.get('psf', 0)
-                margin = 1. # 1 parameter
-                if chi_rex > (chi_psf+margin) or max(chi_psf, chi_rex) > 400:
-                    trymodels.extend([
-                        ('dev', dev), ('exp', exp), ('ser', None)])
-                continue
-
-            if name == 'ser' and newsrc is None:
-                # Start at the better of exp or dev.
-                smod = _select_model(chisqs, nparams, galaxy_margin)
-                if smod not in ['dev', 'exp']:
-                    continue
-                if smod == 'dev':
-                    newsrc = ser = SersicGalaxy(
-                        dev.getPosition().copy(), dev.getBrightness().copy(),
-                        dev.getShape().copy(), LegacySersicIndex(4.))
-                elif smod == 'exp':
-                    newsrc = ser = SersicGalaxy(
-                        exp.getPosition().copy(), exp.getBrightness().copy(),
-                        exp.getShape().copy(), LegacySersicIndex(1.))
-                #print('Initialized SER model:', newsrc)
-
+        def fit_model(name, newsrc, srctractor, clock, cache, target=None):
+            # Fits model *newsrc* and returns the results (to be recorded
+            # by record_model), or None if it exited the blob.  With a
+            # *target* chisq (when pruning), the fit may be abandoned.
+            cpum0 = clock()
+            srccat = srctractor.getCatalog()
             srccat[0] = newsrc
 
             # Set maximum galaxy model sizes
@@ -1468,15 +1503,43 @@ class OneBlob(object):
             # Need to create newsrc->mask mappings though:
             mm = remap_modelmask(modelMasks, src, newsrc)
             srctractor.setModelMasks(mm)
-            enable_galaxy_cache()
+            if cache:
+                enable_galaxy_cache()
 
             if fit_background:
                 # Reset sky params
                 srctractor.images.setParams(skyparams)
                 srctractor.thawParam('images')
 
+            if target is not None:
+                # Take the first few optimizer steps, and give up on
+                # this model if its chisq is still so far below what it
+                # needs to be selected that it will not get there.
+                ch = _per_band_chisqs(srctractor, self.bands)
+                chisq0 = _chisq_improvement(newsrc, ch, chisqs_none)
+                optargs = self.optargs.copy()
+                optargs.update(steps=self.model_prune)
+                R0 = srctractor.optimize_loop(**optargs)
+                ch = _per_band_chisqs(srctractor, self.bands)
+                chisq1 = _chisq_improvement(newsrc, ch, chisqs_none)
+                if chisq1 + max(chisq1 - chisq0, 0.) + PRUNE_MARGIN < target:
+                    debug('Pruning model', name, ': chisq', chisq1, 'after',
+                          R0.get('steps', -1)+1, 'steps; needs', target)
+                    if cache:
+                        disable_galaxy_cache()
+                    return dict(pruned=True, chisq=chisq1, cpu=clock() - cpum0,
+                                opt_steps=R0.get('steps', -1))
+
             # First-round optimization (during model selection)
-            R = srctractor.optimize_loop(**self.optargs)
+            if target is not None and R0.get('steps', -1) < self.model_prune-1:
+                # (converged during the probe)
+                R = R0
+            else:
+                R = srctractor.optimize_loop(**self.optargs)
+                if target is not None:
+                    R.update(steps=R0.get('steps', -1) + 1 + R.get('steps', -1),
+                             hit_limit=R0.get('hit_limit', False) or
+                             R.get('hit_limit', False))
             #print('Fit result:', newsrc)
             #print('Steps:', R['steps'])
             hit_limit = R.get('hit_limit', False)
@@ -1516,12 +1579,10 @@ class OneBlob(object):
             elif ix < 0 or iy < 0 or ix >= sw or iy >= sh or not srcblobmask[iy,ix]:
                 # Exited blob!
                 debug('Source exited sub-blob!')
-                if mask_others:
-                    for ie,tim in zip(saved_srctim_ies, srctims):
-                        tim.inverr = ie
-                continue
+                return None
 
-            disable_galaxy_cache()
+            if cache:
+                disable_galaxy_cache()
 
             if self.plots_per_source:
                 # save RGB images for the model
@@ -1589,9 +1650,8 @@ class OneBlob(object):
                 ivars = _compute_invvars(allderivs)
                 assert(len(ivars) == nsrcparams)
 
-            B.all_model_ivs[srci][name] = np.array(ivars).astype(np.float32)
-            B.all_models[srci][name] = newsrc.copy()
-            assert(B.all_models[srci][name].numberOfParams() == nsrcparams)
+            model = newsrc.copy()
+            assert(model.numberOfParams() == nsrcparams)
 
             # Now revert the ellipses!
             if isinstance(newsrc, (DevGalaxy, ExpGalaxy, SersicGalaxy)):
@@ -1600,15 +1660,119 @@ class OneBlob(object):
             # Use the original 'srctractor' here so that the different
             # models are evaluated on the same pixels.
             ch = _per_band_chisqs(srctractor, self.bands)
-            chisqs[name] = _chisq_improvement(newsrc, ch, chisqs_none)
-            cpum1 = time.process_time()
-            B.all_model_cpu[srci][name] = cpum1 - cpum0
-            cputimes[name] = cpum1 - cpum0
-            B.all_model_hit_limit  [srci][name] = hit_limit
-            B.all_model_hit_r_limit[srci][name] = hit_r_limit
-            B.all_model_opt_steps  [srci][name] = opt_steps
+            chisq = _chisq_improvement(newsrc, ch, chisqs_none)
+            cpum1 = clock()
+            return dict(ivs=np.array(ivars).astype(np.float32), model=model,
+                        chisq=chisq, cpu=cpum1 - cpum0, hit_limit=hit_limit,
+                        hit_r_limit=hit_r_limit, opt_steps=opt_steps,
+                        hit_ser_limit=hit_ser_limit)
+
+        def record_model(name, r):
+            B.all_model_ivs[srci][name] = r['ivs']
+            B.all_models[srci][name] = r['model']
+            chisqs[name] = r['chisq']
+            B.all_model_cpu[srci][name] = r['cpu']
+            B.all_model_hit_limit  [srci][name] = r['hit_limit']
+            B.all_model_hit_r_limit[srci][name] = r['hit_r_limit']
+            B.all_model_opt_steps  [srci][name] = r['opt_steps']
             if name == 'ser':
-                B.hit_ser_limit[srci] = hit_ser_limit
+                B.hit_ser_limit[srci] = r['hit_ser_limit']
+
+        # With a model pool, trials whose starting points are known
+        # (eg, psf and rex; then dev and exp) are fit concurrently,
+        # each with its own Tractor, while the results are still
+        # recorded in the serial order below, so they are identical
+        # to a serial run.  Fitting the sky, or plotting, changes
+        # shared state, so is done serially.
+        parallel = (self.model_pool is not None and not fit_background and
+                    not self.plots_per_source)
+
+        def prune_target(name):
+            # Returns the chisq that galaxy model *name* needs to be
+            # selected, if pruning.  For dev and exp this only considers
+            # psf and rex, so it is the same when dev and exp are fit
+            # concurrently.
+            if (not self.model_prune or is_galaxy or fit_background or
+                not name in ['dev', 'exp', 'ser']):
+                return None
+            prev = chisqs
+            if name in ['dev', 'exp']:
+                prev = dict([(k,v) for k,v in chisqs.items()
+                             if not k in ['dev', 'exp']])
+            return _selection_threshold(name, prev, nparams, galaxy_margin)
+
+        pending = {}
+        if parallel:
+            # (the galaxy cache is not thread-safe)
+            disable_galaxy_cache()
+
+        for itry,(name,newsrc) in enumerate(trymodels):
+            if name == 'gals':
+                # If 'rex' was better than 'psf', or the source is
+                # bright, try the galaxy models.
+                chi_rex = chisqs.get('rex', 0)
+                chi_psf = chisqs.get('psf', 0)
+                margin = 1. # 1 parameter
+                if chi_rex > (chi_psf+margin) or max(chi_psf, chi_rex) > 400:
+                    trymodels.extend([
+                        ('dev', dev), ('exp', exp), ('ser', None)])
+                continue
+
+            if name == 'ser' and newsrc is None:
+                # Start at the better of exp or dev.
+                smod = _select_model(chisqs, nparams, galaxy_margin)
+                if smod not in ['dev', 'exp']:
+                    continue
+                if smod == 'dev':
+                    newsrc = ser = SersicGalaxy(
+                        dev.getPosition().copy(), dev.getBrightness().copy(),
+                        dev.getShape().copy(), LegacySersicIndex(4.))
+                elif smod == 'exp':
+                    newsrc = ser = SersicGalaxy(
+                        exp.getPosition().copy(), exp.getBrightness().copy(),
+                        exp.getShape().copy(), LegacySersicIndex(1.))
+                #print('Initialized SER model:', newsrc)
+
+            if parallel:
+                # Start this trial, and the following ones that are
+                # already determined.
+                for nm,ns in [(name,newsrc)] + trymodels[itry+1:]:
+                    if nm == 'gals' or ns is None:
+                        break
+                    if not nm in pending:
+                        pending[nm] = (self.model_pool.submit(
+                            fit_model, nm, ns, self._trial_tractor(srctims, ns),
+                            time.thread_time, False, prune_target(nm)),
+                                       ns, ns.getAllParams())
+                r = pending.pop(name)[0].result()
+            else:
+                r = fit_model(name, newsrc, srctractor, time.process_time, True,
+                              prune_target(name))
+
+            if r is None:
+                # Exited blob!
+                if mask_others:
+                    if parallel:
+                        # The following trials were started with the
+                        # other sources masked; they have to be re-run
+                        # (serially) without, from their initial values.
+                        from concurrent.futures import wait
+                        wait([f for f,_,_ in pending.values()])
+                        for _,ns,params in pending.values():
+                            ns.setAllParams(params)
+                        pending = {}
+                        parallel = False
+                    for ie,tim in zip(saved_srctim_ies, srctims):
+                        tim.inverr = ie
+                continue
+
+            if r.get('pruned', False):
+                B.dchisq_pruned[srci] |= (1 << MODEL_NAMES.index(name))
+                B.all_model_cpu[srci][name] = r['cpu']
+                B.all_model_opt_steps[srci][name] = r['opt_steps']
+                continue
+
+            record_model(name, r)
 
         if mask_others:
             for tim,ie in zip(srctims, saved_srctim_ies):
@@ -1716,6 +1880,14 @@ class OneBlob(object):
         tr.freezeParams('images')
         return tr
 
+    def _trial_tractor(self, tims, src):
+        # A Tractor with its own optimizer, for fitting in a model-pool thread
+        trargs = self.trargs.copy()
+        trargs.update(optimizer=type(self.trargs['optimizer'])())
+        tr = Tractor(tims, [src], **trargs)
+        tr.freezeParams('images')
+        return tr
+
     def _optimize_individual_sources_subtract(self, cat, Ibright,
                                               cputime):
         # -Remember the original images
@@ -2490,6 +2662,31 @@ def _select_model(chisqs, nparams, galaxy_margin):
     keepmod = 'ser'
     return keepmod
 
+def _selection_threshold(name, chisqs, nparams, galaxy_margin):
+    '''
+    Returns the smallest chi-squared improvement with which model
+    *name* would be chosen by _select_model, given the *chisqs* of the
+    other models, or None if it would be chosen even with none.
+    '''
+    def chosen(chisq):
+        c = chisqs.copy()
+        c[name] = chisq
+        return _select_model(c, nparams, galaxy_margin) == name
+    lo = min(list(chisqs.values()) + [0.])
+    hi = 2. * max(list(chisqs.values()) + [0.]) + 100.
+    if chosen(lo):
+        return None
+    if not chosen(hi):
+        return hi
+    # _select_model is monotonic in each model's chisq; bisect.
+    while hi - lo > 0.01:
+        mid = 0.5 * (lo + hi)
+        if chosen(mid):
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
 def _chisq_improvement(src, chisqs, chisqs_none):
     '''
     chisqs, chisqs_none: dict of band->chisq
@@ -185,88 +185,109 @@ def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_heade
             cow   = np.zeros((H,W), np.float32)
             masks = np.zeros((H,W), np.int16)
 
-            results = mp.imap_unordered(
-                blur_resample_one, [(i_btim,tim,sig,targetwcs)
-                                    for i_btim,(tim,sig) in enumerate(zip(btims,addsigs))])
-            for i_btim,r in results:
-                if r is None:
-                    continue
-                Yo,Xo,iacc,wacc,macc = r
-                coimg[Yo,Xo] += iacc
-                cow  [Yo,Xo] += wacc
-                masks[Yo,Xo] |= macc
-                del Yo,Xo,iacc,wacc,macc
-                del r
-            del results
-
-            #
-            veto = np.logical_or(star_veto,
-                                 np.logical_or(
-                binary_dilation(masks & DQ_BITS['bleed'], iterations=3),
-                binary_dilation(masks & DQ_BITS['satur'], iterations=10)))
-            del masks
-
-            # if plots:
-            #     plt.clf()
-            #     plt.imshow(veto, interpolation='nearest', origin='lower', cmap='gray')
-            #     plt.title('SATUR, BLEED veto (%s band)' % band)
-            #     ps.savefig()
-
-            R = mp.imap_unordered(
-                compare_one, [(i_btim, tim, sig, targetwcs, coimg, cow, veto, make_badcoadds, plots,ps)
-                              for i_btim,(tim,sig) in enumerate(zip(btims,addsigs))])
-            del coimg, cow, veto
-
-            badcoadd_pos = None
-            badcoadd_neg = None
-            if make_badcoadds:
-                badcoadd_pos = np.zeros((H,W), np.float32)
-                badcon_pos   = np.zeros((H,W), np.int16)
-                badcoadd_neg = np.zeros((H,W), np.float32)
-                badcon_neg   = np.zeros((H,W), np.int16)
-
-            for i_btim,r in R:
-                tim = btims[i_btim]
-                if r is None:
-                    # none masked
-                    mask = np.zeros(tim.shape, np.uint8)
-                else:
-                    mask,badco = r
-                    if make_badcoadds:
-                        badhot, badcold = badco
-                        yo,xo,bimg = badhot
-                        badcoadd_pos[yo, xo] += bimg
-                        badcon_pos  [yo, xo] += 1
-                        yo,xo,bimg = badcold
-                        badcoadd_neg[yo, xo] += bimg
-                        badcon_neg  [yo, xo] += 1
-                        del yo,xo,bimg, badhot,badcold
-                    del badco
-                del r
-
-                # Apply the mask!
-                maskbits = get_bits_to_mask()
-                tim.inverr[(mask & maskbits) > 0] = 0.
-                tim.dq[(mask & maskbits) > 0] |= tim.dq_type(DQ_BITS['outlier'])
-
-                # Write output!
-                from legacypipe.utils import copy_header_with_wcs
-                hdr = copy_header_with_wcs(None, tim.subwcs)
-                hdr.add_record(dict(name='IMTYPE', value='outlier_mask',
-                                    comment='LegacySurvey image type'))
-                hdr.add_record(dict(name='CAMERA',  value=tim.imobj.camera))
-                hdr.add_record(dict(name='EXPNUM',  value=tim.imobj.expnum))
-                hdr.add_record(dict(name='CCDNAME', value=tim.imobj.ccdname))
-                hdr.add_record(dict(name='X0', value=tim.x0))
-                hdr.add_record(dict(name='Y0', value=tim.y0))
-
-                # HCOMPRESS;: 943k
-                # GZIP_1: 4.4M
-                # GZIP: 4.4M
-                # RICE: 2.8M
-                extname = '%s-%s-%s' % (tim.imobj.camera, tim.imobj.expnum, tim.imobj.ccdname)
-                out.fits.write(mask, header=hdr, extname=extname, compress='HCOMPRESS')
-            del R
+            # Each tim is blurred and resampled once.  If the tims have a
+            # resampling cache, the resampled images and weights are kept
+            # in a memory-mapped stack beside it for the comparisons below
+            # (the pixel mappings are read back from the cache); otherwise
+            # compare_one recomputes them.
+            stack = None
+            stackdir = outlier_stack_dir(btims)
+            if stackdir is not None:
+                stack = ResampledStack(stackdir)
+            resampled = [None] * len(btims)
+            try:
+                results = mp.imap_unordered(
+                    blur_resample_stack_one, [(i_btim,tim,sig,targetwcs)
+                                              for i_btim,(tim,sig) in enumerate(zip(btims,addsigs))])
+                for i_btim,r in results:
+                    if r is None:
+                        if stack is not None:
+                            resampled[i_btim] = stack.append(None)
+                        continue
+                    Yo,Xo,rimg,wt,macc,cached = r
+                    coimg[Yo,Xo] += rimg*wt
+                    cow  [Yo,Xo] += wt
+                    masks[Yo,Xo] |= macc
+                    if stack is not None and cached is not None:
+                        resampled[i_btim] = stack.append(cached, rimg, wt)
+                    del Yo,Xo,rimg,wt,macc,cached
+                    del r
+                del results
+                if stack is not None:
+                    stack.close()
+
+                #
+                veto = np.logical_or(star_veto,
+                                     np.logical_or(
+                    binary_dilation(masks & DQ_BITS['bleed'], iterations=3),
+                    binary_dilation(masks & DQ_BITS['satur'], iterations=10)))
+                del masks
+
+                # if plots:
+                #     plt.clf()
+                #     plt.imshow(veto, interpolation='nearest', origin='lower', cmap='gray')
+                #     plt.title('SATUR, BLEED veto (%s band)' % band)
+                #     ps.savefig()
+
+                R = mp.imap_unordered(
+                    compare_one, [(i_btim, tim, sig, targetwcs, coimg, cow, veto, make_badcoadds, plots,ps,
+                                   resampled[i_btim])
+                                  for i_btim,(tim,sig) in enumerate(zip(btims,addsigs))])
+                del coimg, cow, veto
+
+                badcoadd_pos = None
+                badcoadd_neg = None
+                if make_badcoadds:
+                    badcoadd_pos = np.zeros((H,W), np.float32)
+                    badcon_pos   = np.zeros((H,W), np.int16)
+                    badcoadd_neg = np.zeros((H,W), np.float32)
+                    badcon_neg   = np.zeros((H,W), np.int16)
+
+                for i_btim,r in R:
+                    tim = btims[i_btim]
+                    if r is None:
+                        # none masked
+                        mask = np.zeros(tim.shape, np.uint8)
+                    else:
+                        mask,badco = r
+                        if make_badcoadds:
+                            badhot, badcold = badco
+                            yo,xo,bimg = badhot
+                            badcoadd_pos[yo, xo] += bimg
+                            badcon_pos  [yo, xo] += 1
+                            yo,xo,bimg = badcold
+                            badcoadd_neg[yo, xo] += bimg
+                            badcon_neg  [yo, xo] += 1
+                            del yo,xo,bimg, badhot,badcold
+                        del badco
+                    del r
+
+                    # Apply the mask!
+                    maskbits = get_bits_to_mask()
+                    tim.inverr[(mask & maskbits) > 0] = 0.
+                    tim.dq[(mask & maskbits) > 0] |= tim.dq_type(DQ_BITS['outlier'])
+
+                    # Write output!
+                    from legacypipe.utils import copy_header_with_wcs
+                    hdr = copy_header_with_wcs(None, tim.subwcs)
+                    hdr.add_record(dict(name='IMTYPE', value='outlier_mask',
+                                        comment='LegacySurvey image type'))
+                    hdr.add_record(dict(name='CAMERA',  value=tim.imobj.camera))
+                    hdr.add_record(dict(name='EXPNUM',  value=tim.imobj.expnum))
+                    hdr.add_record(dict(name='CCDNAME', value=tim.imobj.ccdname))
+                    hdr.add_record(dict(name='X0', value=tim.x0))
+                    hdr.add_record(dict(name='Y0', value=tim.y0))
+
+                    # HCOMPRESS;: 943k
+                    # GZIP_1: 4.4M
+                    # GZIP: 4.4M
+                    # RICE: 2.8M
+                    extname = '%s-%s-%s' % (tim.imobj.camera, tim.imobj.expnum, tim.imobj.ccdname)
+                    out.fits.write(mask, header=hdr, extname=extname, compress='HCOMPRESS')
+                del R
+            finally:
+                if stack is not None:
+                    stack.remove()
 
             if make_badcoadds:
                 badcoadd_pos /= np.maximum(badcon_pos, 1)
@@ -278,29 +299,30 @@ def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_heade
     return badcoadds_pos,badcoadds_neg
 
 def compare_one(X):
-    from scipy.ndimage.filters import gaussian_filter
     from scipy.ndimage.morphology import binary_dilation
     from astrometry.util.resample import resample_with_wcs,OverlapError
+    from legacypipe.resampling import cached_resampling
 
-    (i_tim,tim,sig,targetwcs, coimg,cow, veto, make_badcoadds, plots,ps) = X
+    (i_tim,tim,sig,targetwcs, coimg,cow, veto, make_badcoadds, plots,ps,
+     resampled) = X
 
     if plots:
         import pylab as plt
 
     H,W = targetwcs.shape
 
-    img = gaussian_filter(tim.getImage(), sig)
-    try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
-            targetwcs, tim.subwcs, [img], intType=np.int16)
-    except OverlapError:
-        return i_tim,None
-    del img
-    blurnorm = 1./(2. * np.sqrt(np.pi) * sig)
-    wt = tim.getInvvar()[Yi,Xi] / np.float32(blurnorm**2)
-    if Xi.dtype != np.int16:
-        Yi = Yi.astype(np.int16)
-        Xi = Xi.astype(np.int16)
+    # The blurred, resampled image from the first pass, if available
+    R = None
+    if resampled is not None:
+        if resampled.n == 0:
+            return i_tim,None
+        R = resampled.read()
+    if R is None:
+        R = blur_resample(tim, sig, targetwcs)
+        if R is None:
+            return i_tim,None
+    Yo,Xo,Yi,Xi,rimg,wt = R
+    del R
 
     # Compare against reference image...
     maskedpix = np.zeros(tim.shape, np.uint8)
@@ -433,11 +455,18 @@ def compare_one(X):
 
     # Actually do the masking!
     # Resample "hot" (in brick coords) back to tim coords.
-    try:
-        mYo,mXo,mYi,mXi,_ = resample_with_wcs(
-            tim.subwcs, targetwcs, intType=np.int16)
-    except OverlapError:
-        return i_tim,None
+    cached = cached_resampling(tim, targetwcs)
+    if cached is not None:
+        R = cached.reverse()
+        if R is None:
+            return i_tim,None
+        mYo,mXo,mYi,mXi = R
+    else:
+        try:
+            mYo,mXo,mYi,mXi,_ = resample_with_wcs(
+                tim.subwcs, targetwcs, intType=np.int16)
+        except OverlapError:
+            return i_tim,None
     Ibad, = np.nonzero(hot[mYi,mXi])
     Ibad2, = np.nonzero(cold[mYi,mXi])
     info(tim, ': masking', len(Ibad), 'positive outlier pixels and', len(Ibad2), 'negative outlier pixels')
@@ -447,23 +476,144 @@ def compare_one(X):
     return i_tim, (maskedpix,badco)
 
 
-def blur_resample_one(X):
+def blur_resample(tim, sig, targetwcs):
+    '''
+    Blurs *tim* by *sig* pixels and resamples it to *targetwcs*.
+
+    Returns (Yo,Xo,Yi,Xi,rimg,wt) -- the int16 pixel mappings, the
+    resampled image, and its (blurred) inverse-variance -- or None if
+    the tim does not overlap.
+    '''
     from scipy.ndimage.filters import gaussian_filter
     from astrometry.util.resample import resample_with_wcs,OverlapError
-
-    i_tim,tim,sig,targetwcs = X
+    from legacypipe.resampling import cached_resampling
 
     img = gaussian_filter(tim.getImage(), sig)
-    try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
-            targetwcs, tim.subwcs, [img], intType=np.int16)
-    except OverlapError:
-        return i_tim, None
+    cached = cached_resampling(tim, targetwcs)
+    if cached is not None:
+        R = cached.nearest()
+        if R is None:
+            return None
+        Yo,Xo,Yi,Xi = R
+        [rimg] = cached.lanczos([img])
+    else:
+        try:
+            Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
+                targetwcs, tim.subwcs, [img], intType=np.int16)
+        except OverlapError:
+            return None
     del img
     blurnorm = 1./(2. * np.sqrt(np.pi) * sig)
-    wt = tim.getInvvar()[Yi,Xi] / (blurnorm**2)
+    wt = tim.getInvvar()[Yi,Xi] / np.float32(blurnorm**2)
+    if Xi.dtype != np.int16:
+        Yi = Yi.astype(np.int16)
+        Xi = Xi.astype(np.int16)
+    return Yo,Xo,Yi,Xi,rimg,wt
+
+def blur_resample_one(X):
+    i_tim,tim,sig,targetwcs = X
+    R = blur_resample(tim, sig, targetwcs)
+    if R is None:
+        return i_tim, None
+    Yo,Xo,Yi,Xi,rimg,wt = R
     return i_tim, (Yo, Xo, rimg*wt, wt, tim.dq[Yi,Xi])
 
+def blur_resample_stack_one(X):
+    from legacypipe.resampling import cached_resampling
+    i_tim,tim,sig,targetwcs = X
+    R = blur_resample(tim, sig, targetwcs)
+    if R is None:
+        return i_tim, None
+    Yo,Xo,Yi,Xi,rimg,wt = R
+    # The cached pixel mappings that blur_resample used, if any
+    cached = cached_resampling(tim, targetwcs)
+    return i_tim, (Yo, Xo, rimg, wt, tim.dq[Yi,Xi], cached)
+
+def outlier_stack_dir(tims):
+    '''
+    Returns the directory in which to keep the resampled stack: that of
+    the tims' resampling cache, or None if they have none.
+    '''
+    for tim in tims:
+        R = getattr(tim, 'resamp_cache', None)
+        if R is not None:
+            return os.path.dirname(R.fn)
+    return None
+
+class ResampledTim(object):
+    '''
+    A (picklable) descriptor of one tim's blurred, resampled image in a
+    ResampledStack file: float32 rimg,wt, each of length *n*, starting
+    at *offset*.  The pixel mappings come from the tim's resampling
+    cache, *resamp* (a TimResampling).
+    '''
+    __slots__ = ['fn', 'offset', 'n', 'resamp']
+    def __init__(self, fn, offset, n, resamp):
+        self.fn = fn
+        self.offset = offset
+        self.n = n
+        self.resamp = resamp
+
+    def __getstate__(self):
+        return (self.fn, self.offset, self.n, self.resamp)
+
+    def __setstate__(self, state):
+        (self.fn, self.offset, self.n, self.resamp) = state
+
+    @staticmethod
+    def nbytes(n):
+        return 8 * n
+
+    def read(self):
+        '''
+        Returns (Yo,Xo,Yi,Xi,rimg,wt), or None if the stack file or the
+        resampling cache is gone.
+        '''
+        if not os.path.exists(self.fn) or self.resamp._arrays() is None:
+            return None
+        iw = np.memmap(self.fn, dtype=np.float32, mode='r', offset=self.offset,
+                       shape=(2, self.n))
+        return self.resamp.nearest() + tuple(np.array(a) for a in iw)
+
+class ResampledStack(object):
+    '''
+    The blurred, resampled images of a band's tims, written sequentially
+    to a temporary file in *dirname* (beside the resampling cache) and
+    read back (memory-mapped) by compare_one.
+    '''
+    def __init__(self, dirname):
+        import tempfile
+        fd,self.fn = tempfile.mkstemp(dir=dirname, prefix='outliers-', suffix='.dat')
+        self.f = os.fdopen(fd, 'wb')
+        self.offset = 0
+
+    def append(self, resamp, rimg=None, wt=None):
+        '''
+        Appends a tim's resampled image *rimg* and weights *wt*, whose
+        pixel mappings are given by its TimResampling *resamp* (or None,
+        for a tim that does not overlap), and returns its ResampledTim
+        descriptor.
+        '''
+        if resamp is None:
+            return ResampledTim(self.fn, self.offset, 0, None)
+        n = len(rimg)
+        assert(n == resamp.n)
+        for a in [rimg,wt]:
+            self.f.write(a.astype(np.float32).tobytes())
+        desc = ResampledTim(self.fn, self.offset, n, resamp)
+        self.offset += ResampledTim.nbytes(n)
+        return desc
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+        debug('Resampled stack', self.fn, ': %.1f MB' % (self.offset / 1e6))
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.fn):
+            os.remove(self.fn)
+
 def patch_from_coadd(coimgs, targetwcs, bands, tims, mp=None):
     H,W = targetwcs.shape
     ibands = dict([(b,i) for i,b in enumerate(bands)])
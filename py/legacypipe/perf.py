@@ -0,0 +1,241 @@
+'''
+Summarizes the runbrick --telemetry (JSON-lines) event files of many
+bricks: per-stage wall-clock and CPU time, peak memory and I/O, the
+slowest blobs, and the hottest functions (with --profile-stages).
+
+With --baseline, compares the per-stage medians against those of
+another set of runs (eg, before a software upgrade) and flags the
+stages that got slower.
+
+eg,
+    python legacypipe/perf.py telemetry/ --baseline telemetry-old/
+'''
+import os
+import sys
+import json
+
+import numpy as np
+
+def find_event_files(paths):
+    '''
+    Expands directories in *paths* into the *.jsonl files they contain.
+    '''
+    fns = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath,_,filenames in os.walk(path):
+                fns.extend(os.path.join(dirpath, fn) for fn in sorted(filenames)
+                           if fn.endswith('.jsonl'))
+        else:
+            fns.append(path)
+    return fns
+
+def read_events(paths):
+    '''
+    Reads the telemetry events from files (or directories) *paths*.
+    Lines that cannot be parsed (eg, from a killed job) are skipped.
+    '''
+    events = []
+    for fn in find_event_files(paths):
+        with open(fn) as f:
+            for line in f:
+                try:
+                    ev = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(ev, dict) and 'kind' in ev:
+                    events.append(ev)
+    return events
+
+def latest_events(events, kind, key):
+    '''
+    Returns the events of type *kind*, keeping only the last one
+    for each value of *key*(event) -- eg, for re-run stages.
+    '''
+    last = {}
+    for ev in events:
+        if ev['kind'] != kind:
+            continue
+        last[key(ev)] = ev
+    return list(last.values())
+
+def _total_cpu(ev):
+    return ev.get('main', {}).get('cpu', 0.) + ev.get('workers', {}).get('cpu', 0.)
+
+def _peak_rss(ev):
+    return max(ev.get('main', {}).get('peak_rss_mb', 0.),
+               ev.get('workers', {}).get('peak_rss_mb', 0.))
+
+def _total(ev, k):
+    return ev.get('main', {}).get(k, 0) + ev.get('workers', {}).get(k, 0)
+
+def stage_summary(events):
+    '''
+    Returns a dict, stage name -> dict of statistics over bricks.
+    '''
+    stages = {}
+    for ev in latest_events(events, 'stage', lambda e: (e['brick'], e['stage'])):
+        if not ev.get('ok', True):
+            continue
+        stages.setdefault(ev['stage'], []).append(ev)
+    summary = {}
+    for stage,evs in stages.items():
+        wall = np.array([e['wall'] for e in evs])
+        cpu = np.array([_total_cpu(e) for e in evs])
+        rss = np.array([_peak_rss(e) for e in evs])
+        rd = np.array([_total(e, 'rchar') for e in evs], float)
+        wr = np.array([_total(e, 'wchar') for e in evs], float)
+        summary[stage] = dict(
+            nbricks=len(evs),
+            wall_total=float(np.sum(wall)),
+            wall_median=float(np.median(wall)),
+            wall_p90=float(np.percentile(wall, 90)),
+            wall_max=float(np.max(wall)),
+            cpu_total=float(np.sum(cpu)),
+            cpu_median=float(np.median(cpu)),
+            rss_median=float(np.median(rss)),
+            rss_max=float(np.max(rss)),
+            read_median=float(np.median(rd)),
+            write_median=float(np.median(wr)),
+            slowest=evs[int(np.argmax(wall))]['brick'])
+    return summary
+
+def slowest_blobs(events, n=20):
+    '''
+    Returns the *n* blob events with the most CPU time.
+    '''
+    blobs = latest_events(events, 'blob', lambda e: (e['brick'], e['blob']))
+    blobs.sort(key=lambda e: -e.get('cpu', 0.))
+    return blobs[:n]
+
+def hot_functions(events, n=20):
+    '''
+    Sums the profile summaries of the stage events over bricks.
+    Returns a dict, stage -> list of [function, self seconds,
+    cumulative seconds], for the top *n* functions by cumulative time.
+    '''
+    funcs = {}
+    for ev in latest_events(events, 'stage', lambda e: (e['brick'], e['stage'])):
+        prof = ev.get('profile')
+        if not prof:
+            continue
+        F = funcs.setdefault(ev['stage'], {})
+        for name,tself,tcum in prof:
+            a,b = F.get(name, (0., 0.))
+            F[name] = (a + tself, b + tcum)
+    top = {}
+    for stage,F in funcs.items():
+        names = sorted(F.keys(), key=lambda k: -F[k][1])[:n]
+        top[stage] = [[k, F[k][0], F[k][1]] for k in names]
+    return top
+
+def stage_order(summary, events):
+    '''
+    Orders the stages in *summary* in the order they first appear in
+    *events* (ie, in runbrick order).
+    '''
+    order = []
+    for ev in events:
+        s = ev.get('stage')
+        if ev['kind'] == 'stage' and s in summary and not s in order:
+            order.append(s)
+    return order
+
+def compare_stages(summary, baseline, threshold=1.2):
+    '''
+    Compares per-stage median wall and CPU times against *baseline*.
+    Returns a list of (stage, wall ratio, cpu ratio, regressed).
+    '''
+    rows = []
+    for stage,s in summary.items():
+        b = baseline.get(stage)
+        if b is None:
+            continue
+        wr = s['wall_median'] / max(b['wall_median'], 1e-6)
+        cr = s['cpu_median'] / max(b['cpu_median'], 1e-6)
+        rows.append((stage, wr, cr, (wr > threshold or cr > threshold)))
+    return rows
+
+def print_report(events, baseline_events=None, threshold=1.2, nblobs=20,
+                 nfuncs=20, out=sys.stdout):
+    summary = stage_summary(events)
+    bricks = set(ev['brick'] for ev in events)
+    print('%i events from %i bricks' % (len(events), len(bricks)), file=out)
+    print(file=out)
+    print('%-16s %6s %10s %9s %9s %9s %10s %9s %9s %9s' %
+          ('stage', 'bricks', 'wall tot', 'wall med', 'wall p90', 'wall max',
+           'cpu tot', 'cpu med', 'rss max', 'read med'), file=out)
+    order = stage_order(summary, events)
+    for stage in order:
+        s = summary[stage]
+        print('%-16s %6i %10.0f %9.1f %9.1f %9.1f %10.0f %9.1f %7.0fMB %7.0fMB' %
+              (stage, s['nbricks'], s['wall_total'], s['wall_median'], s['wall_p90'],
+               s['wall_max'], s['cpu_total'], s['cpu_median'], s['rss_max'],
+               s['read_median'] / 1e6), file=out)
+
+    if baseline_events is not None:
+        base = stage_summary(baseline_events)
+        print(file=out)
+        print('Median time relative to baseline:', file=out)
+        rows = dict((r[0], r) for r in compare_stages(summary, base, threshold=threshold))
+        for stage in order:
+            if not stage in rows:
+                continue
+            _,wr,cr,bad = rows[stage]
+            print('%-16s wall x %5.2f   cpu x %5.2f %s' %
+                  (stage, wr, cr, '  <-- REGRESSION' if bad else ''), file=out)
+
+    blobs = slowest_blobs(events, n=nblobs)
+    if len(blobs):
+        print(file=out)
+        print('Slowest blobs:', file=out)
+        for b in blobs:
+            print('  %s blob %5i: %8.1f s CPU, %4i sources, %8i pixels, %3i images%s' %
+                  (b['brick'], b['blob'], b.get('cpu', 0.), b.get('nsources', 0),
+                   b.get('npix', 0), b.get('nimages', 0),
+                   ', hit limit' if b.get('hit_limit') else ''), file=out)
+
+    funcs = hot_functions(events, n=nfuncs)
+    for stage in order:
+        if not stage in funcs:
+            continue
+        print(file=out)
+        print('Hottest functions in stage %s (self, cumulative seconds):' % stage, file=out)
+        for name,tself,tcum in funcs[stage]:
+            print('  %10.1f %10.1f  %s' % (tself, tcum, name), file=out)
+    return summary
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Summarize runbrick --telemetry event files.')
+    parser.add_argument('paths', nargs='+',
+                        help='Telemetry (.jsonl) files, or directories containing them')
+    parser.add_argument('--baseline', nargs='+', default=None,
+                        help='Telemetry files (or directories) to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Flag stages whose median time grew by more than this factor (default %(default)s)')
+    parser.add_argument('--blobs', type=int, default=20,
+                        help='Number of slowest blobs to list')
+    parser.add_argument('--functions', type=int, default=20,
+                        help='Number of hottest functions per stage to list')
+    parser.add_argument('--json', default=None,
+                        help='Also write the per-stage summary to this JSON file')
+    opt = parser.parse_args(args=args)
+
+    events = read_events(opt.paths)
+    if len(events) == 0:
+        print('No telemetry events found.')
+        return -1
+    baseline = None
+    if opt.baseline is not None:
+        baseline = read_events(opt.baseline)
+    summary = print_report(events, baseline_events=baseline, threshold=opt.threshold,
+                           nblobs=opt.blobs, nfuncs=opt.functions)
+    if opt.json is not None:
+        with open(opt.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
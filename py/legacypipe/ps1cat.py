@@ -6,15 +6,107 @@ Find all the PS1 stars in a given DECaLS CCD.
 import os
 import numpy as np
 
+# Process-wide cache of decoded healpix catalog tiles (see
+# HealpixedCatalog.get_healpix_tile), so that the Gaia / PS1 tiles read
+# for one brick or CCD are not re-read for the next.  Off by default;
+# see set_healpix_cache_size (and legacy_zeropoints.py
+# --healpix-cache-size).
+healpix_cache = None
+def set_healpix_cache_size(maxsize):
+    '''
+    Sets the size, in bytes, of the healpix tile cache; *maxsize* None
+    (or 0) disables (and empties) the cache.
+    '''
+    global healpix_cache
+    from legacypipe.utils import LRUCache
+    if not maxsize:
+        healpix_cache = None
+    else:
+        healpix_cache = LRUCache(maxsize=maxsize)
+
+def get_healpix_cache():
+    return healpix_cache
+
+def radec_to_healpix(ra, dec, nside, indexing='ring'):
+    '''
+    Returns the healpix numbers (in the "ring" or "nested" scheme) for
+    arrays of RA,Dec (in degrees).
+    '''
+    ra = np.atleast_1d(np.asarray(ra, np.float64))
+    dec = np.atleast_1d(np.asarray(dec, np.float64))
+    z = np.sin(np.deg2rad(dec))
+    za = np.abs(z)
+    # in [0, 4)
+    tt = np.mod(ra, 360.) / 90.
+    tt[tt >= 4.] = 0.
+    eq = (za <= 2./3.)
+    pix = np.zeros(len(ra), np.int64)
+
+    # Equatorial region
+    E = np.flatnonzero(eq)
+    temp1 = nside * (0.5 + tt[E])
+    temp2 = nside * z[E] * 0.75
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    if indexing == 'ring':
+        ir = nside + 1 + jp - jm
+        kshift = 1 - (ir & 1)
+        ip = ((jp + jm - nside + kshift + 1) // 2) % (4 * nside)
+        pix[E] = 2 * nside * (nside - 1) + (ir - 1) * 4 * nside + ip
+    else:
+        ifp = jp // nside
+        ifm = jm // nside
+        face = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+        ix = jm & (nside - 1)
+        iy = nside - (jp & (nside - 1)) - 1
+        pix[E] = _xyf_to_nested(ix, iy, face, nside)
+
+    # Polar caps
+    P = np.flatnonzero(np.logical_not(eq))
+    ntt = np.minimum(tt[P].astype(np.int64), 3)
+    tp = tt[P] - ntt
+    tmp = nside * np.sqrt(3. * (1. - za[P]))
+    jp = (tp * tmp).astype(np.int64)
+    jm = ((1. - tp) * tmp).astype(np.int64)
+    north = (z[P] > 0)
+    if indexing == 'ring':
+        ir = jp + jm + 1
+        ip = (tt[P] * ir).astype(np.int64) % (4 * ir)
+        pix[P] = np.where(north, 2 * ir * (ir - 1) + ip,
+                          12 * nside**2 - 2 * ir * (ir + 1) + ip)
+    else:
+        jp = np.minimum(jp, nside - 1)
+        jm = np.minimum(jm, nside - 1)
+        face = np.where(north, ntt, ntt + 8)
+        ix = np.where(north, nside - jm - 1, jp)
+        iy = np.where(north, nside - jp - 1, jm)
+        pix[P] = _xyf_to_nested(ix, iy, face, nside)
+    return pix
+
+def _xyf_to_nested(ix, iy, face, nside):
+    # interleave the bits of ix (even bits) and iy (odd bits)
+    pix = np.zeros(len(ix), np.int64)
+    for b in range(int(np.log2(nside))):
+        pix |= ((ix >> b) & 1) << (2*b)
+        pix |= ((iy >> b) & 1) << (2*b + 1)
+    return face * nside**2 + pix
+
 class HealpixedCatalog(object):
-    def __init__(self, fnpattern, nside=32, indexing='ring'):
+    def __init__(self, fnpattern, nside=32, indexing='ring', npy_dir=None):
         '''
         fnpattern: string formatter with key "hp", eg
         'dir/fn-%(hp)05i.fits'
+
+        npy_dir: if set, tiles are also stored there as .npy files (by
+        default, in $HEALPIX_NPY_CACHE_DIR, if set), which are
+        memory-mapped rather than decoded on later reads.
         '''
         self.fnpattern = fnpattern
         self.nside = nside
         self.indexing = indexing
+        if npy_dir is None:
+            npy_dir = os.getenv('HEALPIX_NPY_CACHE_DIR')
+        self.npy_dir = npy_dir
 
     def healpix_for_radec(self, ra, dec):
         '''
@@ -31,22 +123,91 @@ class HealpixedCatalog(object):
             hp = hpxy
         return hp
 
-    def get_healpix_catalog(self, healpix):
-        from astrometry.util.fits import fits_table
+    def healpixes_for_radec(self, ra, dec):
+        '''
+        Returns the set of healpix numbers containing any of the given
+        arrays of RA,Dec.
+        '''
+        if self.indexing in ['ring', 'nested']:
+            return set(radec_to_healpix(ra, dec, self.nside, self.indexing).tolist())
+        return set([self.healpix_for_radec(r, d) for r,d in zip(ra, dec)])
+
+    def get_healpix_tile(self, healpix):
+        '''
+        Returns (cat, order, sorted_dec) for the given healpix: the
+        catalog (with read-only columns, possibly memory-mapped, shared
+        through the process-wide cache -- do not modify it), and an
+        index of its rows sorted by Dec.
+        '''
         fname = self.fnpattern % dict(hp=healpix)
-        #print('Reading', fname)
-        return fits_table(fname)
+        cache = get_healpix_cache()
+        key = None
+        if cache is not None:
+            st = os.stat(fname)
+            key = (fname, st.st_mtime_ns, st.st_size)
+            tile = cache.get(key)
+            if tile is not None:
+                return tile
+        cat = self._read_healpix_tile(fname)
+        for c in cat.get_columns():
+            cat.get(c).flags.writeable = False
+        order = np.argsort(cat.dec, kind='stable')
+        tile = (cat, order, cat.dec[order])
+        if cache is not None:
+            cache.put(key, tile)
+        return tile
+
+    def _read_healpix_tile(self, fname):
+        from astrometry.util.fits import fits_table
+        if self.npy_dir is None:
+            return fits_table(fname)
+        base = os.path.basename(fname).replace('.fits', '')
+        npyfn = os.path.join(self.npy_dir, base + '.npy')
+        if (not os.path.exists(npyfn) or
+            os.path.getmtime(npyfn) < os.path.getmtime(fname)):
+            cat = fits_table(fname)
+            cols = cat.get_columns()
+            arrs = [cat.get(c) for c in cols]
+            data = np.empty(len(cat), dtype=[(c, a.dtype, a.shape[1:])
+                                             for c,a in zip(cols, arrs)])
+            for c,a in zip(cols, arrs):
+                data[c] = a
+            os.makedirs(self.npy_dir, exist_ok=True)
+            tmpfn = npyfn + '.tmp-%i.npy' % os.getpid()
+            np.save(tmpfn, data)
+            os.rename(tmpfn, npyfn)
+            return cat
+        data = np.load(npyfn, mmap_mode='r')
+        cat = fits_table()
+        for c in data.dtype.names:
+            cat.set(c, data[c])
+        return cat
+
+    def get_healpix_catalog(self, healpix, dec_range=None):
+        '''
+        Returns (a copy of) the catalog in the given healpix, optionally
+        only the rows with *dec_range* = (declo, dechi).
+        '''
+        cat,order,sorted_dec = self.get_healpix_tile(healpix)
+        if dec_range is None:
+            I = np.arange(len(cat))
+        else:
+            i0,i1 = np.searchsorted(sorted_dec, dec_range)
+            # (keep the file order)
+            I = np.sort(order[i0:i1])
+        return cat[I]
 
-    def get_healpix_catalogs(self, healpixes):
+    def get_healpix_catalogs(self, healpixes, dec_range=None):
         from astrometry.util.fits import merge_tables
         cats = []
         for hp in healpixes:
-            cats.append(self.get_healpix_catalog(hp))
+            cats.append(self.get_healpix_catalog(hp, dec_range=dec_range))
         if len(cats) == 1:
             return cats[0]
         return merge_tables(cats)
 
     def get_catalog_in_wcs(self, wcs, step=100., margin=10):
+        from legacypipe.catalog_cache import wcs_dec_range
         # Grid the CCD in pixel space
         W,H = wcs.get_width(), wcs.get_height()
         xx,yy = np.meshgrid(
@@ -54,11 +215,10 @@ class HealpixedCatalog(object):
             np.linspace(1-margin, H+margin, 2+int((H+2*margin)/step)))
         # Convert to RA,Dec and then to unique healpixes
         ra,dec = wcs.pixelxy2radec(xx.ravel(), yy.ravel())
-        healpixes = set()
-        for r,d in zip(ra,dec):
-            healpixes.add(self.healpix_for_radec(r, d))
-        # Read catalog in those healpixes
-        cat = self.get_healpix_catalogs(healpixes)
+        healpixes = self.healpixes_for_radec(ra, dec)
+        # Read catalog in those healpixes, in the Dec range of the CCD
+        cat = self.get_healpix_catalogs(healpixes,
+                                        dec_range=wcs_dec_range(wcs, margin))
         # Cut to sources actually within the CCD.
         _,xx,yy = wcs.radec2pixelxy(cat.ra, cat.dec)
         cat.x = xx
@@ -0,0 +1,306 @@
+'''
+A per-brick cache of the pixel mappings between each tim and the
+brick's target WCS.
+
+Several stages (outlier masking, image coadds, detection, model
+coadds) each call `resample_with_wcs` for the same tim -> brick
+mapping.  *cache_resamplings* computes, once per tim,
+
+- the nearest-neighbour maps *Yo,Xo,Yi,Xi* (brick pixels <- tim pixels),
+- the sub-pixel offsets *dx,dy* needed for Lanczos interpolation, and
+- the reverse maps (tim pixels <- brick pixels),
+
+and writes them, as int16 and float32, into a single memory-mapped
+file.  Each tim gets a small `TimResampling` descriptor (as
+*tim.resamp_cache*) that pickles as just the file name and offsets, so
+it is cheap to send to worker processes and to save in stage pickles.
+
+The file name and header include a digest of the target WCS and of
+each tim's identity and WCS; an existing file with a matching header
+is reused, and a descriptor whose file has gone away or no longer
+matches (eg, resuming from a pickle on a different node) makes the
+lookup functions return None, so callers fall back to computing the
+mapping themselves.
+'''
+import os
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.resampling')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+# Length of the hex digest at the start of a cache file
+DIGEST_LEN = 40
+
+def wcs_key(wcs):
+    '''
+    Returns a hashable key describing a TAN WCS, or None if *wcs* does
+    not look like a TAN WCS.
+    '''
+    try:
+        return (tuple(wcs.get_crval()), tuple(wcs.get_crpix()),
+                tuple(wcs.get_cd()), wcs.get_width(), wcs.get_height())
+    except AttributeError:
+        return None
+
+class TimResampling(object):
+    '''
+    A (picklable) descriptor of the cached mappings between one tim
+    and a target WCS, stored in a memory-mapped file.
+
+    The file holds, starting at *offset*: int16 arrays Yo,Xo,Yi,Xi of
+    length *n*, float32 arrays dx,dy of length *n*, and int16 arrays
+    rYo,rXo,rYi,rXi (the reverse mapping) of length *nrev*.  If
+    *digest* is given, the file must start with it.
+    '''
+    __slots__ = ['fn', 'offset', 'n', 'nrev', 'key', 'digest', '_mm']
+    def __init__(self, fn, offset, n, nrev, key, digest=None):
+        self.fn = fn
+        self.offset = offset
+        self.n = n
+        self.nrev = nrev
+        self.key = key
+        self.digest = digest
+        self._mm = None
+
+    def __getstate__(self):
+        return (self.fn, self.offset, self.n, self.nrev, self.key, self.digest)
+
+    def __setstate__(self, state):
+        (self.fn, self.offset, self.n, self.nrev, self.key, self.digest) = state
+        self._mm = None
+
+    @staticmethod
+    def nbytes(n, nrev):
+        return 2 * (4 * n + 4 * nrev) + 4 * (2 * n)
+
+    def _mmap(self, dtype, offset, shape):
+        if shape[1] == 0:
+            return np.zeros(shape, dtype)
+        return np.memmap(self.fn, dtype=dtype, mode='r',
+                         offset=self.offset + offset, shape=shape)
+
+    def _arrays(self):
+        if self._mm is None:
+            if not os.path.exists(self.fn):
+                return None
+            if (self.digest is not None and
+                read_cache_digest(self.fn) != self.digest):
+                debug('Resampling cache', self.fn, 'does not match; ignoring')
+                return None
+            n = self.n
+            self._mm = (self._mmap(np.int16,   0,     (4, n)),
+                        self._mmap(np.float32, 8*n,   (2, n)),
+                        self._mmap(np.int16,   16*n,  (4, self.nrev)))
+        return self._mm
+
+    def nearest(self):
+        '''
+        Returns (Yo,Xo,Yi,Xi) as int16 arrays, or None if the tim
+        does not overlap the target.
+        '''
+        if self.n == 0:
+            return None
+        yx,_,_ = self._arrays()
+        return tuple(np.array(a) for a in yx)
+
+    def reverse(self):
+        '''
+        Returns (Yo,Xo,Yi,Xi) for the mapping from target pixels to tim
+        pixels (ie, Yo,Xo are tim pixels), or None.
+        '''
+        if self.nrev == 0:
+            return None
+        _,_,yx = self._arrays()
+        return tuple(np.array(a) for a in yx)
+
+    def lanczos(self, images):
+        '''
+        Lanczos3-interpolates each of the tim-shaped *images* at the
+        (Yo,Xo) target pixels; returns a list of float32 arrays, as
+        `resample_with_wcs` would.
+        '''
+        from astrometry.util.util import lanczos3_interpolate
+        if self.n == 0:
+            return []
+        yx,dxy,_ = self._arrays()
+        ix = yx[3].astype(np.int32)
+        iy = yx[2].astype(np.int32)
+        dx = dxy[0].astype(np.float32)
+        dy = dxy[1].astype(np.float32)
+        rimgs = [np.zeros(self.n, np.float32) for img in images]
+        lanczos3_interpolate(ix, iy, dx, dy, rimgs,
+                             [img.astype(np.float32) for img in images])
+        return rimgs
+
+def cached_resampling(tim, targetwcs):
+    '''
+    Returns the *TimResampling* for *tim* onto *targetwcs*, or None if
+    it has not been cached (or the cache file is gone).
+    '''
+    R = getattr(tim, 'resamp_cache', None)
+    if R is None:
+        return None
+    key = wcs_key(targetwcs)
+    if key is None or key != R.key:
+        return None
+    if R._arrays() is None:
+        return None
+    return R
+
+def read_cache_digest(fn):
+    '''
+    Returns the digest at the start of the cache file *fn*, or None.
+    '''
+    try:
+        with open(fn, 'rb') as f:
+            return f.read(DIGEST_LEN).decode('ascii')
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def resampling_digest(tims, targetwcs):
+    '''
+    Returns a hex digest identifying the resampling maps between *tims*
+    (their names, pixel extents and WCSes) and *targetwcs*.
+    '''
+    import hashlib
+    import pickle
+    sha = hashlib.sha1()
+    sha.update(repr(wcs_key(targetwcs)).encode())
+    for tim in tims:
+        sha.update(repr((str(tim.name), tim.x0, tim.y0, tim.shape)).encode())
+        # (tim WCSes are usually SIP, which wcs_key does not describe)
+        key = wcs_key(tim.subwcs)
+        if key is None:
+            sha.update(pickle.dumps(tim.subwcs))
+        else:
+            sha.update(repr(key).encode())
+    return sha.hexdigest()
+
+def _read_cache_index(fn, digest, ntims):
+    '''
+    Reads the (ntims x 2) array of (n, nrev) sizes from the header of the
+    cache file *fn*, checking its digest and length; returns None if it
+    does not match.
+    '''
+    if read_cache_digest(fn) != digest:
+        return None
+    hdrsize = DIGEST_LEN + 8 * (1 + 2*ntims)
+    try:
+        index = np.fromfile(fn, dtype=np.int64, count=1 + 2*ntims,
+                            offset=DIGEST_LEN)
+    except (OSError, ValueError):
+        return None
+    if len(index) != 1 + 2*ntims or index[0] != ntims:
+        return None
+    sizes = index[1:].reshape(ntims, 2)
+    expected = hdrsize + sum(TimResampling.nbytes(n, nrev) for n,nrev in sizes)
+    if os.path.getsize(fn) != expected:
+        return None
+    return sizes
+
+def _compute_one(X):
+    from astrometry.util.resample import resample_with_wcs, OverlapError
+    (subwcs, targetwcs) = X
+    try:
+        Yo,Xo,Yi,Xi,_ = resample_with_wcs(targetwcs, subwcs,
+                                          intType=np.int16)
+    except OverlapError:
+        return None
+    if len(Yo) == 0:
+        return None
+    # Sub-pixel offsets for Lanczos interpolation, evaluated with the
+    # full WCS (resample_with_wcs uses a spline approximation, which
+    # agrees to well below 1e-3 pixels).
+    r,d = targetwcs.pixelxy2radec(Xo+1., Yo+1.)[-2:]
+    _,fx,fy = subwcs.radec2pixelxy(r, d)
+    del r,d
+    dx = (fx - 1. - Xi).astype(np.float32)
+    dy = (fy - 1. - Yi).astype(np.float32)
+    del fx,fy
+    try:
+        rev = resample_with_wcs(subwcs, targetwcs, intType=np.int16)[:4]
+    except OverlapError:
+        rev = [np.zeros(0, np.int16)] * 4
+    return (np.array([Yo,Xo,Yi,Xi]).astype(np.int16),
+            np.array([dx,dy]),
+            np.array(rev).astype(np.int16))
+
+def cache_resamplings(tims, targetwcs, dirname, brickname, mp=None):
+    '''
+    Computes the resampling maps between each of *tims* and
+    *targetwcs*, writes them to a memory-mapped file in directory
+    *dirname*, and attaches a *TimResampling* descriptor to each tim
+    as *tim.resamp_cache*.  If the file already exists for the same
+    tims and target WCS, it is reused.
+
+    Returns the filename.
+    '''
+    key = wcs_key(targetwcs)
+    if key is None:
+        info('Not caching resampling maps: target WCS is not TAN')
+        return None
+    digest = resampling_digest(tims, targetwcs)
+    fn = os.path.join(dirname, 'resamp-%s-%s.dat' % (brickname, digest[:12]))
+    hdrsize = DIGEST_LEN + 8 * (1 + 2*len(tims))
+
+    sizes = None
+    if os.path.exists(fn):
+        sizes = _read_cache_index(fn, digest, len(tims))
+    if sizes is not None:
+        info('Reusing resampling maps for', len(tims), 'tims in', fn)
+    else:
+        # Only the WCSes are sent to the workers
+        args = [(tim.subwcs, targetwcs) for tim in tims]
+        if mp is None:
+            R = list(map(_compute_one, args))
+        else:
+            R = mp.map(_compute_one, args)
+        sizes = np.array([(0,0) if r is None else (r[0].shape[1], r[2].shape[1])
+                          for r in R], np.int64).reshape(len(tims), 2)
+        os.makedirs(dirname, exist_ok=True)
+        # Write to a temp file and rename, so that a concurrent reader
+        # never sees a partial file.
+        tmpfn = fn + '.tmp-%i' % os.getpid()
+        with open(tmpfn, 'wb') as f:
+            f.write(digest.encode('ascii'))
+            f.write(np.array([len(tims)], np.int64).tobytes())
+            f.write(sizes.tobytes())
+            for r in R:
+                if r is None:
+                    continue
+                for a in r:
+                    f.write(a.tobytes())
+        os.rename(tmpfn, fn)
+        del R
+
+    offset = hdrsize
+    for tim,(n,nrev) in zip(tims, sizes):
+        n,nrev = int(n), int(nrev)
+        tim.resamp_cache = TimResampling(fn, offset, n, nrev, key, digest=digest)
+        offset += TimResampling.nbytes(n, nrev)
+    info('Cached resampling maps for', len(tims), 'tims in', fn,
+         ': %.1f MB' % (offset / 1e6))
+    return fn
+
+def remove_resampling_cache(tims):
+    '''
+    Deletes the cache file (if any) referenced by *tims* and detaches
+    the descriptors.
+    '''
+    fns = set()
+    for tim in tims:
+        R = getattr(tim, 'resamp_cache', None)
+        if R is None:
+            continue
+        fns.add(R.fn)
+        del tim.resamp_cache
+    for fn in fns:
+        if os.path.exists(fn):
+            debug('Removing resampling cache', fn)
+            os.remove(fn)
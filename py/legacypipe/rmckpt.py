@@ -3,6 +3,7 @@ Removes checkpoint for a given brick and output directory
 """
 
 import os, errno
+import shutil
 import argparse
 
 def silentremove(filename):
@@ -11,6 +12,10 @@ def silentremove(filename):
     except OSError as e: # this would be "except OSError, e:" before Python 2.6
         if e.errno != errno.ENOENT: # errno.ENOENT = no such file or directory
             raise # re-raise exception if a different error occurred
+    # runbrick --stage-store directory
+    base,ext = os.path.splitext(filename)
+    if ext == '.pickle':
+        shutil.rmtree(base + '.d', ignore_errors=True)
 
 def removeckpt(brick, rundir):
     subdir = brick[0:3]
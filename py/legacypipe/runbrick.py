@@ -28,7 +28,10 @@ To see the code we run on each "blob" of pixels, see "oneblob.py".
 '''
 import sys
 import os
+import pickle
+import struct
 import warnings
+import zlib
 
 import numpy as np
 
@@ -93,6 +96,7 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
                command_line=None,
                read_parallel=True,
                max_memory_gb=None,
+               resamp_cache_dir=None,
                **kwargs):
     '''
     This is the first stage in the pipeline.  It
@@ -299,6 +303,11 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
     if len(tims) == 0:
         raise NothingToDoError('No photometric CCDs touching brick.')
 
+    if resamp_cache_dir is not None:
+        from legacypipe.resampling import cache_resamplings
+        cache_resamplings(tims, targetwcs, resamp_cache_dir, brickname, mp=mp)
+        record_event and record_event('stage_tims: done resampling cache')
+
     # Check calibration product versions
     for tim in tims:
         for cal,ver in [('sky', tim.skyver), ('psf', tim.psfver)]:
@@ -808,6 +817,7 @@ def stage_srcs(pixscale=None, targetwcs=None,
                large_galaxies=True,
                gaia_stars=True,
                blob_dilate=None,
+               nworkers=1,
                **kwargs):
     '''
     In this stage we run SED-matched detection to find objects in the
@@ -877,7 +887,8 @@ def stage_srcs(pixscale=None, targetwcs=None,
     tnow = Time()
     debug('Rendering detection maps...')
     detmaps, detivs, satmaps = detection_maps(tims, targetwcs, bands, mp,
-                                              apodize=10, nsatur=nsatur)
+                                              apodize=10, nsatur=nsatur,
+                                              nworkers=nworkers)
     tnow = Time()
     debug('Detmaps:', tnow-tlast)
     tlast = tnow
@@ -1059,7 +1070,13 @@ def stage_fitblobs(T=None,
                    refstars=None,
                    bailout=False,
                    record_event=None,
+                   telemetry=None,
                    custom_brick=False,
+                   shared_tims=False,
+                   blob_cost_model=None,
+                   model_threads=None,
+                   prune_models=None,
+                   crop_detmaps=False,
                    **kwargs):
     '''
     This is where the actual source fitting happens.
@@ -1083,6 +1100,12 @@ def stage_fitblobs(T=None,
     version_header.add_record(dict(name='COMMENT', value='DCHISQ array model names'))
     for i,mod in enumerate(MODEL_NAMES):
         version_header.add_record(dict(name='DCHISQ_%i' % i, value=mod.upper()))
+    if prune_models:
+        version_header.add_record(dict(name='PRUNEMOD', value=prune_models,
+                                       comment='Model fits pruned after N steps (DCHISQ_PRUNED)'))
+    if crop_detmaps:
+        version_header.add_record(dict(name='CROPDET', value=True,
+                                       comment='Source masks from cropped blob detection maps?'))
 
     if plots:
         from legacypipe.runbrick_plots import fitblobs_plots
@@ -1158,18 +1181,15 @@ def stage_fitblobs(T=None,
     R = []
     # Check for existing checkpoint file.
     if checkpoint_filename and os.path.exists(checkpoint_filename):
-        from astrometry.util.file import unpickle_from_file
         info('Reading', checkpoint_filename)
         try:
-            R = unpickle_from_file(checkpoint_filename)
-            debug('Read', len(R), 'results from checkpoint file', checkpoint_filename)
+            R = _check_checkpoints(_read_checkpoint(checkpoint_filename),
+                                   blobslices, brickname)
         except:
             import traceback
             print('Failed to read checkpoint file ' + checkpoint_filename)
             traceback.print_exc()
-        keepR = _check_checkpoints(R, blobslices, brickname)
-        info('Keeping', len(keepR), 'of', len(R), 'checkpointed results')
-        R = keepR
+            R = []
         skipblobs = [r['iblob'] for r in R]
 
     bailout_mask = None
@@ -1226,61 +1246,39 @@ def stage_fitblobs(T=None,
     if sub_blobs:
         ran_sub_blobs = []
 
+    single_thread = (mp is None or mp.pool is None)
+    # With --shared-tims, place the tim pixels in shared memory once, and
+    # send the workers descriptors of their cutouts rather than the pixels.
+    arena = None
+    if shared_tims and not single_thread:
+        from legacypipe.shared_tims import SharedTimArena
+        arena = SharedTimArena(tims)
+
+    from legacypipe.blobcost import get_blob_cost_model
+    cost_model = get_blob_cost_model(blob_cost_model)
+
     # Create the iterator over blobs to process
     blobiter = _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims,
                           cat, T, bands, plots, ps, reoptimize, iterative, use_ceres,
                           refmap, large_galaxies_force_pointsource, less_masking, brick,
                           frozen_galaxies,
                           skipblobs=skipblobs,
-                          single_thread=(mp is None or mp.pool is None),
+                          single_thread=single_thread,
                           max_blobsize=max_blobsize, custom_brick=custom_brick,
                           enable_sub_blobs=sub_blobs,
-                          ran_sub_blobs=ran_sub_blobs)
+                          ran_sub_blobs=ran_sub_blobs,
+                          shared_arena=arena,
+                          cost_model=cost_model,
+                          fit_opts=dict(model_threads=model_threads,
+                                        prune_models=prune_models,
+                                        crop_detmaps=crop_detmaps))
 
-    if checkpoint_filename is None:
-        R.extend(mp.map(_bounce_one_blob, blobiter))
-    else:
-        from astrometry.util.ttime import CpuMeas
-        # Begin running one_blob on each blob...
-        Riter = mp.imap_unordered(_bounce_one_blob, blobiter)
-        # measure wall time and write out checkpoint file periodically.
-        last_checkpoint = CpuMeas()
-        n_finished = 0
-        n_finished_total = 0
-        while True:
-            import multiprocessing
-            # Time to write a checkpoint file? (And have something to write?)
-            tnow = CpuMeas()
-            dt = tnow.wall_seconds_since(last_checkpoint)
-            if dt >= checkpoint_period and n_finished > 0:
-                # Write checkpoint!
-                debug('Writing', n_finished, 'new results; total for this run', n_finished_total)
-                try:
-                    _write_checkpoint(R, checkpoint_filename)
-                    last_checkpoint = tnow
-                    dt = 0.
-                    n_finished = 0
-                except:
-                    print('Failed to write checkpoint file', checkpoint_filename)
-                    import traceback
-                    traceback.print_exc()
-            # Wait for results (with timeout)
-            try:
-                if mp.pool is not None:
-                    timeout = max(1, checkpoint_period - dt)
-                    r = Riter.next(timeout)
-                else:
-                    r = next(Riter)
-                R.append(r)
-                n_finished += 1
-                n_finished_total += 1
-            except StopIteration:
-                break
-            except multiprocessing.TimeoutError:
-                continue
-        # Write checkpoint when done!
-        _write_checkpoint(R, checkpoint_filename)
-        debug('Got', n_finished_total, 'results; wrote', len(R), 'to checkpoint')
+
+    try:
+        _run_blobs(mp, blobiter, R, checkpoint_filename, checkpoint_period)
+    finally:
+        if arena is not None:
+            arena.close()
     debug('Fitting sources:', Time()-tlast)
 
     # Repackage the results from one_blob...
@@ -1387,7 +1385,7 @@ def stage_fitblobs(T=None,
                   'blob_symm_width', 'blob_symm_height', 'blob_symm_npix',
                   'blob_symm_nimages', 'bx0', 'by0',
                   'hit_limit', 'hit_ser_limit', 'hit_r_limit',
-                  'dchisq',
+                  'dchisq', 'dchisq_pruned',
                   'force_keep_source', 'fit_background', 'forced_pointsource']:
             T.set(k, BB.get(k))
 
@@ -1490,6 +1488,9 @@ def stage_fitblobs(T=None,
     T.ninblob = np.array([ninblob[b] for b in T.blob]).astype(np.int32)
     del ninblob
 
+    if telemetry is not None:
+        telemetry.blob_events(T)
+
     # write out blob map
     if write_metrics:
         from legacypipe.utils import copy_header_with_wcs
@@ -1530,6 +1531,74 @@ def stage_fitblobs(T=None,
     rtn = dict([(k,L[k]) for k in keys])
     return rtn
 
+def _run_blobs(mp, blobiter, R, checkpoint_filename, checkpoint_period):
+    '''
+    Runs one_blob on each blob from *blobiter*, appending the results
+    to list *R*.  If *checkpoint_filename* is set, the results are
+    also appended to a checkpoint log as they arrive, which is synced
+    to disk every *checkpoint_period* seconds.
+    '''
+    if checkpoint_filename is None:
+        R.extend(mp.map(_bounce_one_blob, blobiter))
+    else:
+        import multiprocessing
+        from astrometry.util.ttime import CpuMeas
+        # Start a new log holding the results we kept from the previous
+        # checkpoint (if any).
+        ckpt = None
+        try:
+            ckpt = CheckpointLog(checkpoint_filename, R)
+        except:
+            print('Failed to write checkpoint file', checkpoint_filename)
+            import traceback
+            traceback.print_exc()
+        # Begin running one_blob on each blob...
+        Riter = mp.imap_unordered(_bounce_one_blob, blobiter)
+        # measure wall time and sync the checkpoint file periodically.
+        last_checkpoint = CpuMeas()
+        n_finished = 0
+        n_finished_total = 0
+        while True:
+            # Time to sync the checkpoint file? (And have something to write?)
+            tnow = CpuMeas()
+            dt = tnow.wall_seconds_since(last_checkpoint)
+            if dt >= checkpoint_period and n_finished > 0 and ckpt is not None:
+                debug('Syncing', n_finished, 'new results; total for this run', n_finished_total)
+                try:
+                    ckpt.sync()
+                    last_checkpoint = tnow
+                    dt = 0.
+                    n_finished = 0
+                except:
+                    print('Failed to write checkpoint file', checkpoint_filename)
+                    import traceback
+                    traceback.print_exc()
+            # Wait for results (with timeout)
+            try:
+                if mp.pool is not None:
+                    timeout = max(1, checkpoint_period - dt)
+                    r = Riter.next(timeout)
+                else:
+                    r = next(Riter)
+                R.append(r)
+                n_finished += 1
+                n_finished_total += 1
+            except StopIteration:
+                break
+            except multiprocessing.TimeoutError:
+                continue
+            if ckpt is not None:
+                try:
+                    ckpt.append(r)
+                except:
+                    print('Failed to write checkpoint file', checkpoint_filename)
+                    import traceback
+                    traceback.print_exc()
+                    ckpt = None
+        if ckpt is not None:
+            ckpt.close()
+        debug('Got', n_finished_total, 'results; checkpoint contains', len(R))
+
 # Also called by farm.py
 def get_blobiter_ref_map(refstars, T_clusters, less_masking, targetwcs):
     if refstars:
@@ -1630,23 +1699,103 @@ def _get_bailout_mask(blobmap, skipblobs, targetwcs, W, H, brick, blobslices):
     bailout_mask = bmap[blobmap+1]
     return bailout_mask
 
+# Checkpoint files are append-only logs: a magic string, followed by one
+# record per blob result, each a little-endian (uint64 length, uint32 CRC32)
+# header followed by the pickled result dict.  Older checkpoint files are a
+# single pickled list of result dicts; _read_checkpoint reads both.
+CHECKPOINT_MAGIC = b'LPCKPT1\n'
+_checkpoint_header = struct.Struct('<QI')
+
+class CheckpointLog(object):
+    '''
+    Appends blob results to a checkpoint log file.  Records are written
+    through a buffered file, and flushed and fsync'd (in batches) by
+    *sync()*.
+    '''
+    def __init__(self, checkpoint_filename, R=None):
+        '''
+        Starts a new log file, containing the results *R* (if any).
+        '''
+        from astrometry.util.file import trymakedirs
+        d = os.path.dirname(checkpoint_filename)
+        if len(d) and not os.path.exists(d):
+            trymakedirs(d)
+        self.filename = checkpoint_filename
+        # Write the initial contents to a temp file and rename it into
+        # place, so that a crash here does not destroy the old checkpoint.
+        fn = checkpoint_filename + '.tmp'
+        self.f = open(fn, 'wb')
+        self.f.write(CHECKPOINT_MAGIC)
+        self.nwritten = 0
+        if R is not None:
+            for r in R:
+                self.append(r)
+        self.sync()
+        os.rename(fn, checkpoint_filename)
+
+    def append(self, r):
+        msg = pickle.dumps(r, -1)
+        self.f.write(_checkpoint_header.pack(len(msg), zlib.crc32(msg)))
+        self.f.write(msg)
+        self.nwritten += 1
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        if self.f is None:
+            return
+        self.sync()
+        self.f.close()
+        self.f = None
+        debug('Wrote', self.nwritten, 'results to checkpoint', self.filename)
+
 def _write_checkpoint(R, checkpoint_filename):
-    from astrometry.util.file import pickle_to_file, trymakedirs
-    d = os.path.dirname(checkpoint_filename)
-    if len(d) and not os.path.exists(d):
-        trymakedirs(d)
-    fn = checkpoint_filename + '.tmp'
-    pickle_to_file(R, fn)
-    os.rename(fn, checkpoint_filename)
-    debug('Wrote checkpoint to', checkpoint_filename)
+    CheckpointLog(checkpoint_filename, R).close()
+
+def _read_checkpoint(checkpoint_filename):
+    '''
+    Generator yielding the blob result dicts in a checkpoint file.  For
+    checkpoint logs, a truncated or corrupted final record (eg, from a
+    job killed while writing) ends the iteration with a warning.
+    '''
+    with open(checkpoint_filename, 'rb') as f:
+        magic = f.read(len(CHECKPOINT_MAGIC))
+        if magic != CHECKPOINT_MAGIC:
+            # Old-style checkpoint: a pickled list.
+            f.seek(0)
+            for r in pickle.load(f):
+                yield r
+            return
+        n = 0
+        while True:
+            hdr = f.read(_checkpoint_header.size)
+            if len(hdr) == 0:
+                break
+            msg = None
+            if len(hdr) == _checkpoint_header.size:
+                nbytes,crc = _checkpoint_header.unpack(hdr)
+                msg = f.read(nbytes)
+                if len(msg) != nbytes or zlib.crc32(msg) != crc:
+                    msg = None
+            if msg is None:
+                info('Checkpoint file', checkpoint_filename, 'is truncated after',
+                     n, 'records; ignoring the rest')
+                break
+            yield pickle.loads(msg)
+            n += 1
 
 def _check_checkpoints(R, blobslices, brickname):
     # Check that checkpointed blobids match our current set of blobs,
     # based on blob bounding-box.  This can fail if the code changes
     # between writing & reading the checkpoint, resulting in a
     # different set of detected sources.
+    # (*R* can be any iterable, eg the _read_checkpoint generator.)
     keepR = []
+    nread = 0
     for ri in R:
+        nread += 1
         brick = ri['brickname']
         iblob = ri['iblob']
         r = ri['result']
@@ -1691,6 +1840,7 @@ def _check_checkpoints(R, blobslices, brickname):
                               'does not match expected', [bx0,bx1,by0,by1], 'for iblob', iblob)
                         continue
         keepR.append(ri)
+    info('Keeping', len(keepR), 'of', nread, 'checkpointed results')
     return keepR
 
 def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, T, bands,
@@ -1699,40 +1849,50 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, T
                brick, frozen_galaxies, single_thread=False,
                skipblobs=None, max_blobsize=None, custom_brick=False,
                enable_sub_blobs=False,
-               ran_sub_blobs=None):
+               ran_sub_blobs=None,
+               shared_arena=None,
+               cost_model=None,
+               fit_opts=None):
     '''
     *blobmap*: integer image map, with -1 indicating no-blob, other values indexing
         into *blobslices*,*blobsrcs*.
     *blobsrcs*: a list of numpy arrays of integers -- indices into *cat* -- of the sources in
         this blob.
     *T*: a fits table parallel to *cat* with some extra info (very little used)
+    *shared_arena*: a shared_tims.SharedTimArena holding the pixels of *tims*; if
+        given, the yielded arguments describe the pixel cutouts rather than
+        containing them.
+    *cost_model*: a blobcost.BlobCostModel used to order the blobs; if None,
+        blobs are ordered by pixel count.
+    *fit_opts*: a dict of keyword arguments for oneblob.OneBlob (eg,
+        model_threads), sent along with each blob.
     '''
-    from legacypipe.bits import IN_BLOB
     from collections import Counter
+    from legacypipe.bits import IN_BLOB
+    from legacypipe.blobcost import blob_schedule, tim_blob_extents
 
-    def get_subtim_args(tims, targetwcs, bx0,bx1, by0,by1, single_thread):
-        rr,dd = targetwcs.pixelxy2radec([bx0,bx0,bx1,bx1],[by0,by1,by1,by0])
+    def get_subtim_args(tims, extents, overlaps, single_thread):
+        # *extents*, *overlaps*: for this blob, from tim_blob_extents
         subtimargs = []
-        for tim in tims:
+        for tim,ext,overlap in zip(tims, extents, overlaps):
             h,w = tim.shape
-            _,x,y = tim.subwcs.radec2pixelxy(rr,dd)
-            sx0,sx1 = x.min(), x.max()
-            sy0,sy1 = y.min(), y.max()
-            #print('blob extent in pixel space of', tim.name, ': x',
-            # (sx0,sx1), 'y', (sy0,sy1), 'tim shape', (h,w))
-            if sx1 < 0 or sy1 < 0 or sx0 > w or sy0 > h:
+            if not overlap:
                 continue
+            sx0,sx1,sy0,sy1 = ext
             sx0 = int(np.clip(int(np.floor(sx0 - 1)), 0, w-1))
             sx1 = int(np.clip(int(np.ceil (sx1 - 1)), 0, w-1)) + 1
             sy0 = int(np.clip(int(np.floor(sy0 - 1)), 0, h-1))
             sy1 = int(np.clip(int(np.ceil (sy1 - 1)), 0, h-1)) + 1
             subslc = slice(sy0,sy1),slice(sx0,sx1)
-            subimg = tim.getImage   ()[subslc]
-            subie  = tim.getInvError()[subslc]
-            if tim.dq is None:
-                subdq = None
+            if shared_arena is not None:
+                subimg, subie, subdq = shared_arena.cutouts(tim, subslc)
             else:
-                subdq  = tim.dq[subslc]
+                subimg = tim.getImage   ()[subslc]
+                subie  = tim.getInvError()[subslc]
+                if tim.dq is None:
+                    subdq = None
+                else:
+                    subdq  = tim.dq[subslc]
             subwcs = tim.getWcs().shifted(sx0, sy0)
             subsky = tim.getSky().shifted(sx0, sy0)
             subpsf = tim.getPsf().getShifted(sx0, sy0)
@@ -1755,11 +1915,24 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, T
 
     if skipblobs is None:
         skipblobs = []
-
-    # sort blobs by size so that larger ones start running first
-    blobvals = Counter(blobmap[blobmap>=0])
-    blob_order = np.array([b for b,npix in blobvals.most_common()])
-    del blobvals
+    if fit_opts is None:
+        fit_opts = {}
+
+    # Where each blob lands in each tim, computed once for all blobs
+    blob_extents, blob_overlaps = tim_blob_extents(
+        tims, targetwcs,
+        [sx.start for sy,sx in blobslices], [sx.stop for sy,sx in blobslices],
+        [sy.start for sy,sx in blobslices], [sy.stop for sy,sx in blobslices])
+
+    if cost_model is None:
+        # sort blobs by size so that larger ones start running first
+        blobvals = Counter(blobmap[blobmap>=0])
+        blob_order = np.array([b for b,npix in blobvals.most_common()])
+    else:
+        # sort blobs by predicted CPU time so that the most expensive ones
+        # start running first
+        blob_order,_ = blob_schedule(blobmap, blobsrcs, T.ref_cat,
+                                     np.sum(blob_overlaps, axis=0), cost_model)
 
     if custom_brick:
         U = None
@@ -1901,8 +2074,9 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, T
                     if len(Isubsrcs) == 0:
                         continue
                     # Here we cut out subimages for the blob...
-                    subtimargs = get_subtim_args(tims, targetwcs, sub_bx0,sub_bx1,
-                                                 sub_by0,sub_by1, single_thread)
+                    ext,over = tim_blob_extents(tims, targetwcs, sub_bx0,sub_bx1,
+                                                sub_by0,sub_by1)
+                    subtimargs = get_subtim_args(tims, ext[:,0], over[:,0], single_thread)
 
                     yield (brickname, (iblob,sub_blob),
                            (uniqx[j], uniqx[j+1], uniqy[i], uniqy[i+1]),
@@ -1914,19 +2088,21 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, T
                             subtimargs, [cat[i] for i in Isubsrcs], bands,
                             plots, ps,
                             reoptimize, iterative, use_ceres, refmap[sub_slc],
-                            large_galaxies_force_pointsource, less_masking, fro_gals))
+                            large_galaxies_force_pointsource, less_masking, fro_gals,
+                            fit_opts))
 
             continue
 
         # Here we cut out subimages for the blob...
-        subtimargs = get_subtim_args(tims, targetwcs, bx0,bx1, by0,by1, single_thread)
+        subtimargs = get_subtim_args(tims, blob_extents[:,iblob], blob_overlaps[:,iblob],
+                                     single_thread)
 
         yield (brickname, iblob, None,
                (nblob+1, iblob, Isrcs, targetwcs, bx0, by0, blobw, blobh,
                 blobmask, subtimargs, [cat[i] for i in Isrcs], bands, plots, ps,
                 reoptimize, iterative, use_ceres, refmap[bslc],
                 large_galaxies_force_pointsource, less_masking,
-                frozen_galaxies.get(iblob, [])))
+                frozen_galaxies.get(iblob, []), fit_opts))
 
 def _bounce_one_blob(X):
     '''This wraps the one_blob function for multiprocessing purposes (and
@@ -1970,15 +2146,23 @@ def _get_mod(X):
 def _get_both_mods(X):
     from astrometry.util.resample import resample_with_wcs, OverlapError
     from astrometry.util.miscutils import get_overlapping_region
+    from legacypipe.resampling import cached_resampling
     (tim, srcs, srcblobs, blobmap, targetwcs, frozen_galaxies, ps, plots) = X
     mod = np.zeros(tim.getModelShape(), np.float32)
     blobmod = np.zeros(tim.getModelShape(), np.float32)
     assert(len(srcs) == len(srcblobs))
     ### modelMasks during fitblobs()....?
-    try:
-        Yo,Xo,Yi,Xi,_ = resample_with_wcs(tim.subwcs, targetwcs)
-    except OverlapError:
-        return None,None
+    cached = cached_resampling(tim, targetwcs)
+    if cached is not None:
+        R = cached.reverse()
+        if R is None:
+            return None,None
+        Yo,Xo,Yi,Xi = R
+    else:
+        try:
+            Yo,Xo,Yi,Xi,_ = resample_with_wcs(tim.subwcs, targetwcs)
+        except OverlapError:
+            return None,None
     timblobmap = np.empty(mod.shape, blobmap.dtype)
     timblobmap[:,:] = -1
     timblobmap[Yo,Xo] = blobmap[Yi,Xi]
@@ -2096,6 +2280,7 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
                  bailout_mask=None,
                  sub_blob_mask=None,
                  coadd_headers={},
+                 coadd_spill_dir=None,
                  mp=None,
                  record_event=None,
                  **kwargs):
@@ -2217,7 +2402,7 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
                     callback=write_coadd_images,
                     callback_args=(survey, brickname, version_header, tims,
                                    targetwcs, co_sky, coadd_headers),
-                    plots=plots, ps=ps, mp=mp)
+                    plots=plots, ps=ps, mp=mp, spill_dir=coadd_spill_dir)
     record_event and record_event('stage_coadds: extras')
 
     # Coadds of galaxy sims only, image only
@@ -2232,6 +2417,10 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
                     lanczos=lanczos, mp=mp)
     ###
 
+    # This is the last stage that uses the tim -> brick resampling maps.
+    from legacypipe.resampling import remove_resampling_cache
+    remove_resampling_cache(tims)
+
     # Save per-source measurements of the maps produced during coadding
     cols = ['nobs', 'ngood', 'anymask', 'allmask', 'psfsize', 'psfdepth', 'galdepth',
             'mjd_min', 'mjd_max']
@@ -2658,10 +2847,12 @@ def stage_wise_forced(
     unwise_tr_dir=None,
     unwise_modelsky_dir=None,
     wise_ceres=True,
+    wise_split=False,
     unwise_coadds=True,
     version_header=None,
     maskbits=None,
     mp=None,
+    nworkers=1,
     record_event=None,
     wise_checkpoint_filename=None,
     wise_checkpoint_period=600,
@@ -2672,7 +2863,9 @@ def stage_wise_forced(
     After the model fits are finished, we can perform forced
     photometry of the unWISE coadds.
     '''
-    from legacypipe.unwise import unwise_phot, collapse_unwise_bitmask, unwise_tiles_touching_wcs
+    from legacypipe.unwise import (unwise_phot, collapse_unwise_bitmask, unwise_tiles_touching_wcs,
+                                   plan_unwise_phot, merge_unwise_phot)
+    from legacypipe.unwise_cache import read_tr_atlas
     from legacypipe.survey import wise_apertures_arcsec
     from tractor import NanoMaggies
 
@@ -2680,6 +2873,8 @@ def stage_wise_forced(
     _add_stage_version(version_header, 'WISE', 'wise_forced')
     version_header.add_record(dict(name='W_CERES', value=wise_ceres,
                                    comment='WISE forced phot: use Ceres optimizer?'))
+    version_header.add_record(dict(name='W_SPLIT', value=wise_split,
+                                   comment='WISE forced phot: split into spatial tiles?'))
     if not plots:
         ps = None
 
@@ -2743,7 +2938,7 @@ def stage_wise_forced(
     eargs = []
     if unwise_tr_dir is not None:
         tdir = unwise_tr_dir
-        TR = fits_table(os.path.join(tdir, 'time_resolved_atlas.fits'))
+        TR = read_tr_atlas(os.path.join(tdir, 'time_resolved_atlas.fits'))
         debug('Read', len(TR), 'time-resolved WISE coadd tiles')
         TR.cut(np.array([t in tiles.coadd_id for t in TR.coadd_id]))
         debug('Cut to', len(TR), 'time-resolved vs', len(tiles), 'full-depth')
@@ -2794,8 +2989,12 @@ def stage_wise_forced(
                                wise_ceres, wpixpsf, False, None, ps, False,
                                unwise_modelsky_dir, 'Epoch %i W%i' % (ie+1, band))))
 
-    runargs = args + eargs
-    info('unWISE forced phot: total of', len(runargs), 'images to photometer')
+    # Run the most expensive jobs first; with --wise-split, split big
+    # jobs into spatial tiles to keep the pool busy.
+    runargs,wsplits = plan_unwise_phot(args + eargs, targetwcs,
+                                       nworkers if wise_split else 1)
+    info('unWISE forced phot: total of', len(args + eargs), 'images to photometer, in',
+         len(runargs), 'jobs')
     photresults = {}
     # Check for existing checkpoint file.
     if wise_checkpoint_filename and os.path.exists(wise_checkpoint_filename):
@@ -2879,6 +3078,9 @@ def stage_wise_forced(
         _write_checkpoint(photresults, wise_checkpoint_filename)
         info('Computed', n_finished_total, 'new results; wrote', len(photresults), 'to checkpoint')
 
+    for key,parts in wsplits.items():
+        photresults[key] = merge_unwise_phot(len(wcat), parts, photresults,
+                                             maskshape=(H,W))
     phots = [photresults[k] for k,a in (args + eargs)]
     record_event and record_event('stage_wise_forced: results')
 
@@ -3224,6 +3426,7 @@ def stage_writecat(
             sims_data.writeto(None, fits_object=out.fits)
 
     # produce per-brick checksum file.
+    survey.wait_for_outputs()
     with survey.write_output('checksums', brick=brickname, hashsum=False) as out:
         f = open(out.fn, 'w')
         # Write our pre-computed hashcodes.
@@ -3309,6 +3512,7 @@ def stage_checksum(
     For debugging / special-case processing, write out the current checksums file.
     '''
     # produce per-brick checksum file.
+    survey.wait_for_outputs()
     with survey.write_output('checksums', brick=brickname, hashsum=False) as out:
         f = open(out.fn, 'w')
         # Write our pre-computed hashcodes.
@@ -3357,6 +3561,14 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               fitoncoadds_reweight_ivar=True,
               less_masking=False,
               sub_blobs=False,
+              shared_tims=False,
+              blob_cost_model=None,
+              coadd_spill_dir=None,
+              resamp_cache_dir=None,
+              output_threads=None,
+              model_threads=None,
+              prune_models=None,
+              crop_detmaps=False,
               nsatur=None,
               fit_on_coadds=False,
               coadd_tiers=None,
@@ -3365,13 +3577,17 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               bail_out=False,
               ceres=True,
               wise_ceres=True,
+              wise_split=False,
               galex_ceres=True,
               unwise_dir=None,
               unwise_tr_dir=None,
               unwise_modelsky_dir=None,
+              unwise_cache_dir=None,
+              unwise_cache_size=None,
               galex=False,
               galex_dir=None,
               threads=None,
+              nworkers=None,
               plots=False, plots2=False, coadd_bw=False,
               plot_base=None, plot_number=0,
               command_line=None,
@@ -3382,6 +3598,10 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               pickle_pat='pickles/runbrick-%(brick)s-%%(stage)s.pickle',
               stages=None,
               force=None, forceall=False, write_pickles=True,
+              stage_store=False,
+              telemetry_file=None,
+              profile_stages=None,
+              profile_dir=None,
               checkpoint_filename=None,
               checkpoint_period=None,
               wise_checkpoint_filename=None,
@@ -3481,6 +3701,12 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     - *wise_ceres*: boolean; use Ceres Solver for unWISE forced photometry?
 
+    - *wise_split*: boolean; with *threads*, split the unWISE forced
+      photometry of crowded bricks into spatial tiles, to keep the
+      worker processes busy.  Sources near tile edges are fit with
+      neighbours up to a margin away, so their fluxes can differ
+      slightly from the unsplit results.
+
     - *galex_ceres*: boolean; use Ceres Solver for GALEX forced photometry?
 
     - *unwise_dir*: string; where to look for unWISE coadd files.
@@ -3495,8 +3721,57 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
       maps.  The default is to look in the "wise/modelsky" subdirectory of the
       calibration directory.
 
+    - *unwise_cache_dir*: string; node-local directory in which to
+      cache the unWISE tile files, sky maps and PSF models, for reuse
+      by later (or concurrent) bricks on the same node.  See
+      unwise_cache.py, which can also order a list of bricks by
+      unWISE tile.
+
+    - *unwise_cache_size*: float; size limit of the *unwise_cache_dir*
+      cache, in GB.
+
     - *threads*: integer; how many CPU cores to use
 
+    - *nworkers*: integer; number of worker processes in *pool*, when
+      a *pool* is passed in.  Default is *threads*.
+
+    - *shared_tims*: boolean; with *threads*, place the tim pixels in
+      shared memory for the fitblobs stage rather than sending pixel
+      cutouts to the worker processes?
+
+    - *blob_cost_model*: string; filename of a fitted blob CPU-time
+      model (see blobcost.py), used to order the blobs in the fitblobs
+      stage.  Default is to order them by pixel count.
+
+    - *coadd_spill_dir*: string; directory for temporary files holding
+      finished per-band coadds in the coadds stage, to reduce peak memory.
+
+    - *resamp_cache_dir*: string; directory in which to cache the
+      pixel mappings between each image and the brick, which are
+      computed once in the tims stage and reused by the outlier,
+      detection and coadd stages.
+
+    - *output_threads*: integer; number of background threads in which
+      to finish writing output files (computing checksums, writing to
+      disk), overlapping with computation.  Each stage waits for its
+      outputs before finishing.
+
+    - *model_threads*: integer; in fitblobs, fit each source's
+      candidate models (psf, rex, ...) concurrently in this many
+      threads (within each worker process).  The results are
+      identical to serial fitting.
+
+    - *prune_models*: integer; in fitblobs, abandon a source's galaxy
+      model (dev, exp, ser) fit if, after this many optimizer steps,
+      its chi-squared is too far below what it needs to be selected.
+      Pruned models are recorded in the DCHISQ_PRUNED column.
+
+    - *crop_detmaps*: boolean; in fitblobs, mask other sources while
+      fitting each source using a crop of the blob's detection maps,
+      rather than computing detection maps of the source's residual
+      images.  This is faster, but the crop includes the other sources'
+      flux, so it masks more pixels and changes the catalog.
+
     Plotting options:
 
     - *coadd_bw*: boolean: if only one band is available, make B&W coadds?
@@ -3514,6 +3789,16 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
       even if pickle files exist.
     - *forceall*: boolean; run all stages, ignoring all pickle files.
     - *write_pickles*: boolean; write pickle files after each stage?
+    - *stage_store*: boolean; instead of a pickle file, save each
+      stage's outputs as a directory with one file per key, and when
+      resuming, only read the keys that the following stages use.
+
+    - *telemetry_file*: string; append JSON-lines resource-usage events
+      (per stage, and per blob) to this file (see telemetry.py).  May
+      contain "%(brick)s".
+    - *profile_stages*: string; "cprofile" or "sample": profile each
+      stage, listing the hottest functions in its telemetry event.
+    - *profile_dir*: string; directory for the cProfile output files.
 
     Raises
     ------
@@ -3567,8 +3852,18 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
                           int(1000*np.abs(dec))))
     initargs.update(brickname=brick, survey=survey)
 
+    stage_params = None
     if stagefunc is None:
         stagefunc = CallGlobalTime('stage_%s', globals())
+        def stage_params(stage):
+            import inspect
+            func = globals().get('stage_%s' % stage)
+            if func is None:
+                return None
+            return set(inspect.signature(func).parameters)
+    if stage_store:
+        from legacypipe.stagestore import runstage
+        kwargs.update(stage_params=stage_params)
 
     plot_base_default = 'brick-%(brick)s'
     if plot_base is None:
@@ -3609,6 +3904,10 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
                   fitoncoadds_reweight_ivar=fitoncoadds_reweight_ivar,
                   less_masking=less_masking,
                   sub_blobs=sub_blobs,
+                  shared_tims=shared_tims,
+                  blob_cost_model=blob_cost_model,
+                  coadd_spill_dir=coadd_spill_dir,
+                  resamp_cache_dir=resamp_cache_dir,
                   min_mjd=min_mjd, max_mjd=max_mjd,
                   coadd_tiers=coadd_tiers,
                   nsatur=nsatur,
@@ -3618,6 +3917,7 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
                   cache_outliers=cache_outliers,
                   use_ceres=ceres,
                   wise_ceres=wise_ceres,
+                  wise_split=wise_split,
                   galex_ceres=galex_ceres,
                   unwise_coadds=unwise_coadds,
                   bailout=bail_out,
@@ -3647,6 +3947,25 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
         if wise_checkpoint_period is not None:
             kwargs.update(wise_checkpoint_period=wise_checkpoint_period)
 
+    if model_threads:
+        kwargs.update(model_threads=model_threads)
+    if prune_models:
+        kwargs.update(prune_models=prune_models)
+    if crop_detmaps:
+        kwargs.update(crop_detmaps=crop_detmaps)
+    # The unWISE cache is configured through the environment, so that
+    # the pool worker processes (started below) inherit it; the
+    # previous values are restored when we return.
+    saved_env = {}
+    if unwise_cache_dir:
+        saved_env = dict((k, os.environ.get(k)) for k in
+                         ['LEGACYPIPE_UNWISE_CACHE_DIR', 'LEGACYPIPE_UNWISE_CACHE_SIZE'])
+        os.environ['LEGACYPIPE_UNWISE_CACHE_DIR'] = unwise_cache_dir
+        if unwise_cache_size:
+            os.environ['LEGACYPIPE_UNWISE_CACHE_SIZE'] = str(unwise_cache_size * 1e9)
+        else:
+            os.environ.pop('LEGACYPIPE_UNWISE_CACHE_SIZE', None)
+
     if pool or (threads and threads > 1):
         from astrometry.util.timingpool import TimingPool, TimingPoolMeas
         from astrometry.util.ttime import MemMeas
@@ -3665,6 +3984,16 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
         StageTime.add_measurement(MemMeas)
         pool = None
     kwargs.update(mp=mp)
+    if nworkers is None:
+        nworkers = threads if (pool is not None and threads) else 1
+    kwargs.update(nworkers=nworkers)
+
+    telemetry = None
+    if telemetry_file is not None:
+        from legacypipe.telemetry import Telemetry
+        telemetry = Telemetry(telemetry_file % dict(brick=brick), brick, pool=pool,
+                              profile=profile_stages, profile_dir=profile_dir)
+        kwargs.update(telemetry=telemetry)
 
     if nblobs is not None:
         kwargs.update(nblobs=nblobs)
@@ -3780,13 +4109,25 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
             picsurvey.output_dir = survey.output_dir
             picsurvey.allbands = survey.allbands
             picsurvey.coadd_bw = survey.coadd_bw
+            if output_threads and picsurvey.output_pool is None:
+                picsurvey.set_output_threads(output_threads)
 
         flush()
         if mp is not None and threads is not None and threads > 1:
             # flush all workers too
             mp.map(flush, [[]] * threads)
         staget0 = StageTime()
-        R = stagefunc(stage, mp=mp, **kwargs)
+        if telemetry is not None:
+            with telemetry.stage(stage) as tel:
+                R = stagefunc(stage, mp=mp, **kwargs)
+                tims = kwargs.get('tims')
+                if isinstance(R, dict):
+                    tims = R.get('tims', tims)
+                tel.set_tims(tims)
+        else:
+            R = stagefunc(stage, mp=mp, **kwargs)
+        if picsurvey is not None:
+            picsurvey.wait_for_outputs()
         flush()
         if mp is not None and threads is not None and threads > 1:
             mp.map(flush, [[]] * threads)
@@ -3795,11 +4136,20 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     t0 = StageTime()
     R = None
-    for stage in stages:
-        R = runstage(stage, pickle_pat, mystagefunc, prereqs=prereqs,
-                     initial_args=initargs, **kwargs)
+    try:
+        for stage in stages:
+            R = runstage(stage, pickle_pat, mystagefunc, prereqs=prereqs,
+                         initial_args=initargs, **kwargs)
+    finally:
+        for k,v in saved_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
 
     info('All done:', StageTime()-t0)
+    if telemetry is not None:
+        telemetry.finish(stages=stages)
 
     if pool is not None:
         pool.close()
@@ -3848,6 +4198,14 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
                         action='store_false')
     parser.add_argument('-w', '--write-stage', action='append', default=None,
                         help='Write a pickle for a given stage: eg "tims", "image_coadds", "srcs"')
+    parser.add_argument('--stage-store', default=False, action='store_true',
+                        help='Save stage outputs as a directory of per-key files (PICKLE.d/) rather than a single pickle, and only read the keys each stage uses when resuming.')
+    parser.add_argument('--telemetry', dest='telemetry_file', default=None,
+                        help='Append JSON-lines per-stage and per-blob resource-usage events to this file (may contain "%%(brick)s"); summarize with legacypipe/perf.py.')
+    parser.add_argument('--profile-stages', default=None, choices=['cprofile', 'sample'],
+                        help='Profile each stage (with cProfile, or a sampling profiler), listing the hottest functions in the --telemetry events.')
+    parser.add_argument('--profile-dir', default=None,
+                        help='Write cProfile statistics files for each stage to this directory.')
     parser.add_argument('-v', '--verbose', dest='verbose', action='count',
                         default=0, help='Make more verbose')
 
@@ -3919,6 +4277,9 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
                         action='store_false',
                         help='Do not use Ceres Solver for unWISE forced phot')
 
+    parser.add_argument('--wise-split', default=False, action='store_true',
+                        help='With --threads, split the unWISE forced phot of crowded bricks into spatial tiles')
+
     parser.add_argument('--no-galex-ceres', dest='galex_ceres', default=True,
                         action='store_false',
                         help='Do not use Ceres Solver for GALEX forced phot')
@@ -3987,6 +4348,12 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
     parser.add_argument(
         '--unwise-tr-dir', default=None,
         help='Base directory for unWISE time-resolved coadds; may be a colon-separated list')
+    parser.add_argument(
+        '--unwise-cache-dir', default=None,
+        help='Node-local directory in which to cache unWISE tiles, sky maps and PSF models between bricks')
+    parser.add_argument(
+        '--unwise-cache-size', type=float, default=None,
+        help='Size limit of the --unwise-cache-dir cache, in GB (default 100)')
 
     parser.add_argument('--galex', dest='galex', default=False,
                         action='store_true',
@@ -4058,6 +4425,22 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
 
     parser.add_argument('--sub-blobs', default=False, action='store_true',
                         help='Split large blobs into sub-blobs that can be processed in parallel.')
+    parser.add_argument('--coadd-spill-dir', default=None,
+                        help='In the coadds stage, move finished per-band coadd images to temporary memory-mapped files in this directory.')
+    parser.add_argument('--resamp-cache-dir', default=None,
+                        help='Compute the image-to-brick resampling maps once, and cache them in a memory-mapped file in this directory for reuse by later stages.')
+    parser.add_argument('--output-threads', type=int, default=None,
+                        help='Finish writing output files (checksums and disk writes) in this many background threads.')
+    parser.add_argument('--model-threads', type=int, default=None,
+                        help='In fitblobs, fit the candidate models of each source concurrently in this many threads per worker process (results are identical to serial fitting).')
+    parser.add_argument('--prune-models', type=int, default=None,
+                        help='In fitblobs, abandon galaxy model fits that cannot be selected, judged after this many optimizer steps (eg, 3); see test/prune_validation.py.')
+    parser.add_argument('--crop-detmaps', default=False, action='store_true',
+                        help='In fitblobs, mask other sources using crops of the blob detection maps rather than per-source residual maps (faster, but changes the catalog).')
+    parser.add_argument('--blob-cost-model', default=None,
+                        help='Fitted blob CPU-time model file (from legacypipe/blobcost.py), used to order blobs so the most expensive start first.')
+    parser.add_argument('--shared-tims', default=False, action='store_true',
+                        help='In fitblobs, place image pixels in shared memory (/dev/shm) rather than sending cutouts to each worker process.')
 
     parser.add_argument('--fit-on-coadds', default=False, action='store_true',
                         help='Fit to coadds rather than individual CCDs (e.g., large galaxies).')
@@ -0,0 +1,179 @@
+'''
+A shared-memory store for the pixels of a brick's tims.
+
+In stage_fitblobs, the `_blob_iter` generator normally slices the
+image, inverse-error and data-quality arrays of every tim for every
+blob, and those cutouts get pickled and sent to the worker processes.
+With a SharedTimArena, the tim pixels are copied once into a single
+named POSIX shared-memory segment, and the workers receive only small
+SharedCutout descriptors, which they resolve by attaching to the
+segment (once per process) and copying out their slice.
+
+The segment lives in /dev/shm, so it is only usable by workers on the
+same node as the process that created it (ie, the multiprocessing pool
+in runbrick.py, not farm.py / worker.py).
+'''
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.shared_tims')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+# Byte alignment of arrays within the arena
+_ALIGN = 64
+
+class SharedCutout(object):
+    '''
+    A (picklable) descriptor of a 2-d slice of an array stored in a
+    SharedTimArena.
+    '''
+    __slots__ = ['name', 'offset', 'shape', 'dtype', 'slc']
+    def __init__(self, name, offset, shape, dtype, slc):
+        self.name = name
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+        # (y0, y1, x0, x1)
+        self.slc = slc
+
+    def __getstate__(self):
+        return (self.name, self.offset, self.shape, self.dtype, self.slc)
+
+    def __setstate__(self, state):
+        (self.name, self.offset, self.shape, self.dtype, self.slc) = state
+
+    def read(self):
+        '''
+        Returns a private copy of the pixels described by this cutout.
+        '''
+        shm = _attach(self.name)
+        arr = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf,
+                         offset=self.offset)
+        y0,y1,x0,x1 = self.slc
+        return arr[y0:y1, x0:x1].copy()
+
+# Per-process cache of attached segments, name -> SharedMemory
+_attached = {}
+
+def _attach(name):
+    from multiprocessing import shared_memory
+    shm = _attached.get(name)
+    if shm is None:
+        # Only one brick's arena is live at a time; drop mappings of
+        # older (already unlinked) segments so their memory is freed.
+        detach_all()
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = shm
+    return shm
+
+def detach_all():
+    '''
+    Releases this process's mappings of any shared-memory segments.
+    '''
+    for shm in _attached.values():
+        try:
+            shm.close()
+        except Exception:
+            pass
+    _attached.clear()
+
+def resolve_timargs(timargs):
+    '''
+    Replaces SharedCutout descriptors in the (img, inverr, dq, ...)
+    tuples created by runbrick._blob_iter with actual pixel arrays.
+    Other entries pass through unchanged.
+    '''
+    out = []
+    for args in timargs:
+        img, inverr, dq = args[:3]
+        if isinstance(img, SharedCutout):
+            img = img.read()
+        if isinstance(inverr, SharedCutout):
+            inverr = inverr.read()
+        if isinstance(dq, SharedCutout):
+            dq = dq.read()
+        out.append((img, inverr, dq) + tuple(args[3:]))
+    return out
+
+class SharedTimArena(object):
+    '''
+    Copies the image, inverse-error and data-quality pixels of a list
+    of tims into one shared-memory segment.
+
+    Use as a context manager, or call *close()* when done, to unlink
+    the segment.
+    '''
+    def __init__(self, tims):
+        from multiprocessing import shared_memory
+        # Compute the layout.
+        layout = []
+        nbytes = 0
+        for tim in tims:
+            arrs = dict(img=tim.getImage(), inverr=tim.getInvError(), dq=tim.dq)
+            entry = {}
+            for key,arr in arrs.items():
+                if arr is None:
+                    entry[key] = None
+                    continue
+                entry[key] = (nbytes, arr.shape, arr.dtype.str)
+                nbytes += arr.nbytes
+                nbytes = (nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
+            layout.append(entry)
+        self.nbytes = nbytes
+        self.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.name = self.shm.name
+        # key on the tim objects themselves, since _blob_iter is
+        # handed a list of tims, not indices.
+        self.layout = {}
+        for tim,entry in zip(tims, layout):
+            arrs = dict(img=tim.getImage(), inverr=tim.getInvError(), dq=tim.dq)
+            for key,arr in arrs.items():
+                if entry[key] is None:
+                    continue
+                offset,shape,dtype = entry[key]
+                dest = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf,
+                                  offset=offset)
+                dest[:] = arr
+                del dest
+            self.layout[id(tim)] = entry
+        info('Placed pixels for', len(tims), 'tims in shared memory segment',
+             self.name, ': %.1f MB' % (nbytes / 1e6))
+
+    def cutouts(self, tim, subslc):
+        '''
+        Returns (img, inverr, dq) SharedCutout descriptors for the
+        given tim and (y slice, x slice) tuple; *dq* may be None.
+        '''
+        entry = self.layout[id(tim)]
+        sy,sx = subslc
+        slc = (sy.start, sy.stop, sx.start, sx.stop)
+        rtn = []
+        for key in ['img', 'inverr', 'dq']:
+            if entry[key] is None:
+                rtn.append(None)
+                continue
+            offset,shape,dtype = entry[key]
+            rtn.append(SharedCutout(self.name, offset, shape, dtype, slc))
+        return rtn
+
+    def close(self):
+        if self.shm is None:
+            return
+        debug('Unlinking shared memory segment', self.name)
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
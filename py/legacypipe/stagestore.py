@@ -0,0 +1,231 @@
+'''
+A store for the outputs of runbrick stages that keeps each key of a
+stage's result dict as a separate file, so that resuming from a stage
+only reads the keys that the following stages actually use.
+
+For a stage whose pickle file would be
+"pickles/runbrick-BRICK-srcs.pickle", the store is the directory
+"pickles/runbrick-BRICK-srcs.d/", containing one file per key --
+"KEY.npy" for numpy arrays (which are memory-mapped, copy-on-write,
+when read), and "KEY.pickle" for everything else -- plus an index.
+
+*runstage* is a drop-in replacement for astrometry.util.stages.runstage
+that reads and writes these stores (and can still read old pickle
+files).  Stage outputs are read lazily: only the keys that appear in a
+stage function's argument list are loaded before it is called, and
+keys that are never touched are carried forward to later stages' stores
+as hard links, without being read at all.
+
+Note that, unlike a single pickle, object identity between different
+keys is not preserved (eg, two keys referring to the same object will
+be read back as two copies).
+'''
+import os
+import pickle
+import shutil
+from collections.abc import MutableMapping
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.stagestore')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+INDEX_FILENAME = 'index.pickle'
+
+def store_dirname(pickle_fn):
+    '''
+    Returns the store directory corresponding to a stage pickle filename.
+    '''
+    base,ext = os.path.splitext(pickle_fn)
+    return base + '.d'
+
+def _stored_as_npy(val):
+    return (isinstance(val, np.ndarray) and type(val) in (np.ndarray, np.memmap)
+            and not val.dtype.hasobject)
+
+class LazyStageOutputs(MutableMapping):
+    '''
+    A dict-like view of a stage store; values are read from disk the
+    first time they are accessed.
+    '''
+    def __init__(self, dirname, paths):
+        self.dirname = dirname
+        # key -> ('npy' or 'pickle', absolute filename), for keys not yet read
+        self._paths = dict(paths)
+        self._values = {}
+
+    def is_loaded(self, key):
+        return key in self._values
+
+    def stored_path(self, key):
+        '''
+        Returns the (kind, filename) a not-yet-loaded *key* is stored in,
+        or None.
+        '''
+        return self._paths.get(key)
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        kind,fn = self._paths[key]
+        debug('Reading', key, 'from', fn)
+        if kind == 'npy':
+            val = np.load(fn, mmap_mode='c')
+        else:
+            with open(fn, 'rb') as f:
+                val = pickle.load(f)
+        del self._paths[key]
+        self._values[key] = val
+        return val
+
+    def __setitem__(self, key, val):
+        self._paths.pop(key, None)
+        self._values[key] = val
+
+    def __delitem__(self, key):
+        if key in self._values:
+            del self._values[key]
+        else:
+            del self._paths[key]
+
+    def __iter__(self):
+        for k in self._values:
+            yield k
+        for k in self._paths:
+            if not k in self._values:
+                yield k
+
+    def __len__(self):
+        return len(self._values) + len(self._paths)
+
+    def copy(self):
+        c = LazyStageOutputs(self.dirname, self._paths)
+        c._values = self._values.copy()
+        return c
+
+    def __repr__(self):
+        return ('LazyStageOutputs(%s: loaded %s, not loaded %s)' %
+                (self.dirname, list(self._values.keys()), list(self._paths.keys())))
+
+def read_stage_store(dirname):
+    '''
+    Returns a LazyStageOutputs for the store in directory *dirname*.
+    '''
+    with open(os.path.join(dirname, INDEX_FILENAME), 'rb') as f:
+        index = pickle.load(f)
+    paths = dict([(k, (kind, os.path.join(dirname, fn)))
+                  for k,(kind,fn) in index.items()])
+    return LazyStageOutputs(dirname, paths)
+
+def write_stage_store(R, dirname):
+    '''
+    Writes the stage result dict (or LazyStageOutputs) *R* to directory
+    *dirname*, replacing any existing store there.
+    '''
+    tmpdir = dirname + '.tmp'
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    index = {}
+    nlinked = 0
+    for key in list(R.keys()):
+        stored = None
+        if isinstance(R, LazyStageOutputs):
+            stored = R.stored_path(key)
+        if stored is not None:
+            # Never read: link (or copy) the previous stage's file.
+            kind,src = stored
+            fn = os.path.basename(src)
+            try:
+                os.link(src, os.path.join(tmpdir, fn))
+            except OSError:
+                shutil.copyfile(src, os.path.join(tmpdir, fn))
+            nlinked += 1
+        else:
+            val = R[key]
+            if _stored_as_npy(val):
+                kind = 'npy'
+                fn = '%s.npy' % key
+                np.save(os.path.join(tmpdir, fn), val)
+            else:
+                kind = 'pickle'
+                fn = '%s.pickle' % key
+                with open(os.path.join(tmpdir, fn), 'wb') as f:
+                    pickle.dump(val, f, -1)
+        index[key] = (kind, fn)
+    with open(os.path.join(tmpdir, INDEX_FILENAME), 'wb') as f:
+        pickle.dump(index, f, -1)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmpdir, dirname)
+    info('Wrote', len(index), 'keys to stage store', dirname,
+         '(%i unchanged)' % nlinked)
+
+def read_stage_outputs(pickle_fn):
+    '''
+    Reads a stage's outputs, from its store directory if it exists,
+    else from the pickle file *pickle_fn*.  Returns None if neither
+    exists.
+    '''
+    dirname = store_dirname(pickle_fn)
+    if os.path.exists(os.path.join(dirname, INDEX_FILENAME)):
+        info('Reading stage store', dirname)
+        return read_stage_store(dirname)
+    if os.path.exists(pickle_fn):
+        from astrometry.util.file import unpickle_from_file
+        info('Reading pickle', pickle_fn)
+        return unpickle_from_file(pickle_fn)
+    return None
+
+def runstage(stage, picklepat, stagefunc, force=[], forceall=False, prereqs={},
+             update=True, write=True, initial_args={}, stage_params=None,
+             **kwargs):
+    '''
+    Runs *stage* (and its prerequisites, recursively), like
+    astrometry.util.stages.runstage, but saving each stage's outputs
+    in a stage store rather than a single pickle.
+
+    *stage_params*: function(stage) returning the set of argument names
+    the stage function takes, or None if it takes everything; only
+    those outputs of previous stages are read and passed in.
+    '''
+    pfn = picklepat % dict(stage=stage)
+    if not (forceall or stage in force):
+        R = read_stage_outputs(pfn)
+        if R is not None:
+            return R
+    else:
+        info('Ignoring saved outputs and forcing stage', stage)
+
+    prereq = prereqs.get(stage)
+    if prereq is None:
+        P = dict(initial_args)
+    else:
+        P = runstage(prereq, picklepat, stagefunc, force=force, forceall=forceall,
+                     prereqs=prereqs, update=update, write=write,
+                     initial_args=initial_args, stage_params=stage_params,
+                     **kwargs)
+
+    names = None
+    if stage_params is not None:
+        names = stage_params(stage)
+    Px = {}
+    for k in P.keys():
+        if names is None or k in names:
+            Px[k] = P[k]
+    Px.update(kwargs)
+    info('Running stage', stage)
+    R = stagefunc(stage, **Px)
+    info('Stage', stage, 'finished')
+    if update:
+        if R is not None:
+            P.update(R)
+        R = P
+    if write is True or (write and stage in write):
+        write_stage_store(R, store_dirname(pfn))
+    return R
@@ -498,8 +498,13 @@ def get_dependency_versions(unwise_dir, unwise_tr_dir, unwise_modelsky_dir, gale
 def tim_get_resamp(tim, targetwcs):
     from astrometry.util.resample import resample_with_wcs,OverlapError
 
+    from legacypipe.resampling import cached_resampling
+
     if hasattr(tim, 'resamp'):
         return tim.resamp
+    cached = cached_resampling(tim, targetwcs)
+    if cached is not None:
+        return cached.nearest()
     try:
         Yo,Xo,Yi,Xi,_ = resample_with_wcs(targetwcs, tim.subwcs, intType=np.int16)
     except OverlapError:
@@ -790,6 +795,73 @@ def imsave_jpeg(jpegfn, img, **kwargs):
         print(cmd, '->', rtn)
         os.unlink(tmpfn)
 
+# Output files are written (and hashed) in chunks of this many bytes.
+OUTPUT_CHUNK_SIZE = 16 * 1024 * 1024
+
+class HashingWriter(object):
+    '''
+    A minimal file-like object that writes to file *f*, updating hash
+    object *sha* (if not None) with the bytes written.
+    '''
+    def __init__(self, f, sha):
+        self.f = f
+        self.sha = sha
+    def write(self, data):
+        if self.sha is not None:
+            self.sha.update(data)
+        return self.f.write(data)
+    def flush(self):
+        self.f.flush()
+
+def write_chunked(f, data, chunksize=OUTPUT_CHUNK_SIZE):
+    '''
+    Writes bytes *data* to file-like *f*, in chunks.
+    '''
+    mv = memoryview(data)
+    for i in range(0, len(mv), chunksize):
+        f.write(mv[i : i+chunksize])
+
+def finish_output_file(tmpfn, real_fn, rawdata=None, hashsum=True, gzip_data=False):
+    '''
+    Finishes writing an output file for *write_output*.
+
+    If *rawdata* is given, it is written (gzipped if *gzip_data*) to
+    *tmpfn*, computing its sha256sum as it goes; otherwise *tmpfn*
+    has already been written, and is read back to compute the sum.
+    Then *tmpfn* is renamed to *real_fn*.
+
+    Returns the hex sha256sum, or None if not *hashsum*.
+    '''
+    sha = None
+    if hashsum:
+        import hashlib
+        sha = hashlib.sha256()
+    if rawdata is not None:
+        with open(tmpfn, 'wb') as f:
+            out = HashingWriter(f, sha)
+            if gzip_data:
+                import gzip
+                gzf = gzip.GzipFile(real_fn, 'wb', 9, out)
+                write_chunked(gzf, rawdata)
+                gzf.close()
+            else:
+                write_chunked(out, rawdata)
+        debug('Wrote', tmpfn)
+        del rawdata
+    elif hashsum:
+        with open(tmpfn, 'rb') as f:
+            while True:
+                data = f.read(OUTPUT_CHUNK_SIZE)
+                if len(data) == 0:
+                    break
+                sha.update(data)
+    os.rename(tmpfn, real_fn)
+    debug('Renamed to', real_fn)
+    info('Wrote', real_fn)
+    if sha is not None:
+        return sha.hexdigest()
+    return None
+
 class LegacySurveyData(object):
     '''
     A class describing the contents of a LEGACY_SURVEY_DIR directory --
@@ -858,6 +930,10 @@ class LegacySurveyData(object):
             self.output_dir = output_dir
 
         self.output_file_hashes = OrderedDict()
+        # Thread pool (and pending jobs) for finishing output files in
+        # the background; see set_output_threads().
+        self.output_pool = None
+        self.output_pending = []
         self.ccds = None
         self.bricks = None
         self.ccds_index = None
@@ -1172,7 +1248,8 @@ class LegacySurveyData(object):
             res = camconf.get((expnum, None), '')
         return res
 
-    def write_output(self, filetype, hashsum=True, filename=None, **kwargs):
+    def write_output(self, filetype, hashsum=True, filename=None, direct=False,
+                     **kwargs):
         '''
         Returns a context manager for writing an output file.
 
@@ -1182,27 +1259,36 @@ class LegacySurveyData(object):
             ccds.writeto(out.fn, primheader=primhdr)
 
         For FITS output, out.fits is a fitsio.FITS object.  The file
-        contents will actually be written in memory, and then a
-        sha256sum computed before the file contents are written out to
-        the real disk file.  The 'out.fn' member variable is NOT set.
+        contents will actually be written in memory, and then written
+        out to the real disk file, computing the sha256sum as it goes.
+        The 'out.fn' member variable is NOT set.
 
         ::
 
         with survey.write_output('ccds', brick=brickname) as out:
             ccds.writeto(None, fits_object=out.fits, primheader=primhdr)
 
+        If *direct* is True, FITS output (other than .gz) is written
+        directly to the (temp) disk file rather than to memory, and the
+        sha256sum computed by reading it back; this avoids holding a
+        copy of large images in memory.
+
         Does the following on entry:
         - calls self.find_file() to determine which filename to write to
         - ensures the output directory exists
         - prepends a "tmp-" to the filename
 
         Does the following on exit:
-        - moves the "tmp-" to the final filename (to make it atomic)
         - computes the sha256sum
+        - moves the "tmp-" to the final filename (to make it atomic)
+
+        If an output thread pool has been set (set_output_threads),
+        the exit steps happen in the background; call
+        wait_for_outputs() to finish them.
         '''
         class OutputFileContext(object):
             def __init__(self, fn, survey, hashsum=True, relative_fn=None,
-                         compression=None):
+                         compression=None, direct=False):
                 '''
                 *compression*: a CFITSIO compression specification, eg:
                     "[compress R 100,100; qz -0.05]"
@@ -1215,9 +1301,13 @@ class LegacySurveyData(object):
                                 fn.endswith('.fits.fz'))
                 self.tmpfn = os.path.join(os.path.dirname(fn),
                                           'tmp-'+os.path.basename(fn))
+                self.compression = compression
+                self.direct = (direct and self.is_fits and
+                               not self.tmpfn.endswith('.gz'))
                 if self.is_fits:
-                    self.fits = fitsio.FITS('mem://' + (compression or ''),
-                                            'rw')
+                    if not self.direct:
+                        self.fits = fitsio.FITS('mem://' + (compression or ''),
+                                                'rw')
                 else:
                     self.fn = self.tmpfn
                 self.hashsum = hashsum
@@ -1225,6 +1315,11 @@ class LegacySurveyData(object):
             def __enter__(self):
                 dirnm = os.path.dirname(self.tmpfn)
                 trymakedirs(dirnm)
+                if self.direct:
+                    if os.path.exists(self.tmpfn):
+                        os.remove(self.tmpfn)
+                    self.fits = fitsio.FITS(self.tmpfn + (self.compression or ''),
+                                            'rw')
                 return self
 
             def __exit__(self, exc_type, exc_value, traceback):
@@ -1232,62 +1327,32 @@ class LegacySurveyData(object):
                 if exc_type is not None:
                     return
 
-                if self.hashsum:
-                    import hashlib
-                    hashfunc = hashlib.sha256
-                    sha = hashfunc()
+                rawdata = None
                 if self.is_fits:
-                    # Read back the data written into memory by the
-                    # fitsio library
-                    rawdata = self.fits.read_raw()
+                    if not self.direct:
+                        # Read back the data written into memory by the
+                        # fitsio library
+                        rawdata = self.fits.read_raw()
                     # close the fitsio file
                     self.fits.close()
-
-                    # If gzip, we now have to actually do the
-                    # compression to gzip format...
-                    if self.tmpfn.endswith('.gz'):
-                        from io import BytesIO
-                        import gzip
-                        #ulength = len(rawdata)
-                        # We gzip to a memory file (BytesIO) so we can compute
-                        # the hashcode before writing to disk for real
-                        gzipped = BytesIO()
-                        gzf = gzip.GzipFile(self.real_fn, 'wb', 9, gzipped)
-                        gzf.write(rawdata)
-                        gzf.close()
-                        rawdata = gzipped.getvalue()
-                        gzipped.close()
-                        del gzipped
-                        #clength = len(rawdata)
-                        #print('Gzipped', ulength, 'to', clength)
-
+                    del self.fits
+
+                # List the relative filename (from output dir) in
+                # shasum file.
+                fn = self.relative_fn or self.real_fn
+                args = (self.tmpfn, self.real_fn, rawdata, self.hashsum,
+                        self.tmpfn.endswith('.gz'))
+                del rawdata
+                if self.survey.output_pool is not None:
+                    job = self.survey.output_pool.submit(finish_output_file, *args)
+                    self.survey.output_pending.append((fn if self.hashsum else None,
+                                                       job))
                     if self.hashsum:
-                        sha.update(rawdata)
-
-                    f = open(self.tmpfn, 'wb')
-                    f.write(rawdata)
-                    f.close()
-                    debug('Wrote', self.tmpfn)
-                    del rawdata
-                else:
-                    # Non-FITS file -- read the temp file and compute the checksum (hash)
-                    if self.hashsum:
-                        f = open(self.tmpfn, 'rb')
-                        sha.update(f.read())
-                        f.close()
-                        del f
-                if self.hashsum:
-                    hashcode = sha.hexdigest()
-                    del sha
-
-                os.rename(self.tmpfn, self.real_fn)
-                debug('Renamed to', self.real_fn)
-                info('Wrote', self.real_fn)
-
+                        # placeholder, to keep the files in order
+                        self.survey.add_hashcode(fn, None)
+                    return
+                hashcode = finish_output_file(*args)
                 if self.hashsum:
-                    # List the relative filename (from output dir) in
-                    # shasum file.
-                    fn = self.relative_fn or self.real_fn
                     self.survey.add_hashcode(fn, hashcode)
             # end of OutputFileContext class
 
@@ -1309,7 +1374,7 @@ class LegacySurveyData(object):
                 relfn = relfn[1:]
 
         out = OutputFileContext(fn, self, hashsum=hashsum, relative_fn=relfn,
-                                compression=compress)
+                                compression=compress, direct=direct)
         return out
 
     def add_hashcode(self, fn, hashcode):
@@ -1318,11 +1383,40 @@ class LegacySurveyData(object):
         '''
         self.output_file_hashes[fn] = hashcode
 
+    def set_output_threads(self, nthreads):
+        '''
+        Finish writing output files (computing checksums, writing and
+        renaming) in a background pool of *nthreads* threads, shared by
+        all outputs.  *nthreads* = 0 or None: write synchronously.
+        '''
+        self.wait_for_outputs()
+        if self.output_pool is not None:
+            self.output_pool.shutdown()
+            self.output_pool = None
+        if nthreads:
+            from concurrent.futures import ThreadPoolExecutor
+            self.output_pool = ThreadPoolExecutor(nthreads)
+
+    def wait_for_outputs(self):
+        '''
+        Waits for any output files being written in the background to
+        be finished, recording their checksums.
+        '''
+        pending = self.output_pending
+        self.output_pending = []
+        for fn,job in pending:
+            hashcode = job.result()
+            if fn is not None:
+                self.add_hashcode(fn, hashcode)
+
     def __getstate__(self):
         '''
         For pickling; we omit cached tables.
         '''
+        # Finish any output files being written in the background.
+        self.wait_for_outputs()
         d = self.__dict__.copy()
+        d['output_pool'] = None
         d['ccds'] = None
         d['bricks'] = None
         d['bricktree'] = None
@@ -1330,6 +1424,12 @@ class LegacySurveyData(object):
         d['ccds_index'] = None
         return d
 
+    def __setstate__(self, d):
+        # (for pickles written before output threads existed)
+        d.setdefault('output_pool', None)
+        d.setdefault('output_pending', [])
+        self.__dict__.update(d)
+
     def drop_cache(self):
         '''
         Clears all cached data contained in this object.  Useful for
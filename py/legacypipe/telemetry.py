@@ -0,0 +1,381 @@
+'''
+Machine-readable resource telemetry for runbrick.
+
+A Telemetry object appends JSON-lines events to a file: one event per
+stage (wall-clock and CPU time, peak RSS, bytes read and written, for
+the main process and the multiprocessing pool's workers, plus the
+pool's pickle traffic and the number of tims), and one event per blob
+in the fitblobs stage.  Optionally, each stage is profiled, with
+cProfile or a simple statistical sampler of the main thread, and the
+hottest functions are included in the stage event.
+
+The events from many bricks can be summarized with legacypipe/perf.py.
+'''
+import os
+import sys
+import json
+import time
+import threading
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.telemetry')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+# Number of functions to list in the stage events' profile summaries
+PROFILE_TOP = 25
+
+def _read_proc_fields(fn):
+    '''
+    Reads a /proc file of "key: value ..." lines into a dict of
+    the (integer) first values; returns {} if unreadable.
+    '''
+    d = {}
+    try:
+        with open(fn) as f:
+            for line in f:
+                words = line.split(':', 1)
+                if len(words) != 2:
+                    continue
+                vals = words[1].split()
+                if len(vals) == 0:
+                    continue
+                try:
+                    d[words[0].strip()] = int(vals[0])
+                except ValueError:
+                    pass
+    except (OSError, IOError):
+        pass
+    return d
+
+_clock_ticks = None
+def pid_usage(pid):
+    '''
+    Returns a dict of the CPU time (seconds), peak RSS (MB) and I/O
+    (bytes) of process *pid*, from /proc; missing entries are omitted.
+    '''
+    global _clock_ticks
+    if _clock_ticks is None:
+        _clock_ticks = os.sysconf('SC_CLK_TCK')
+    u = {}
+    try:
+        with open('/proc/%i/stat' % pid) as f:
+            # (the command name may contain spaces)
+            words = f.read().rsplit(')', 1)[1].split()
+        # utime, stime are fields 14,15 (ie, after "pid (comm)" 11,12)
+        u.update(cpu=(int(words[11]) + int(words[12])) / _clock_ticks)
+    except (OSError, IOError, IndexError, ValueError):
+        pass
+    st = _read_proc_fields('/proc/%i/status' % pid)
+    if 'VmHWM' in st:
+        u.update(peak_rss_mb=st['VmHWM'] / 1024.)
+    io = _read_proc_fields('/proc/%i/io' % pid)
+    for k in ['rchar', 'wchar', 'read_bytes', 'write_bytes']:
+        if k in io:
+            u[k] = io[k]
+    return u
+
+def reset_peak_rss(pid):
+    '''
+    Resets the peak RSS ("VmHWM") of process *pid*, where supported
+    (Linux >= 4.0).
+    '''
+    try:
+        with open('/proc/%i/clear_refs' % pid, 'w') as f:
+            f.write('5')
+    except (OSError, IOError):
+        pass
+
+def pool_pids(pool):
+    '''
+    Returns the PIDs of the worker processes of multiprocessing *pool*.
+    '''
+    if pool is None:
+        return []
+    procs = getattr(pool, '_pool', None) or []
+    return [p.pid for p in procs if getattr(p, 'pid', None) is not None]
+
+def usage_snapshot(pool=None):
+    '''
+    Returns the current resource usage of this process ("main") and
+    the summed usage of the *pool* workers ("workers").
+    '''
+    import resource
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    main = pid_usage(os.getpid())
+    main.update(cpu=ru.ru_utime + ru.ru_stime)
+    main.setdefault('peak_rss_mb', ru.ru_maxrss / 1024.)
+    workers = {}
+    pids = pool_pids(pool)
+    for pid in pids:
+        for k,v in pid_usage(pid).items():
+            if k == 'peak_rss_mb':
+                workers[k] = max(workers.get(k, 0.), v)
+            else:
+                workers[k] = workers.get(k, 0) + v
+    snap = dict(wall=time.time(), main=main, workers=workers, nworkers=len(pids))
+    pickles = getattr(pool, 'get_pickle_traffic', None)
+    if pickles is not None:
+        try:
+            snap.update(pickle_traffic=pickles())
+        except Exception:
+            pass
+    return snap
+
+def usage_delta(s0, s1):
+    '''
+    Returns the usage between snapshots *s0* and *s1*: differences of
+    the cumulative values, and the peak RSS at *s1*.
+    '''
+    d = dict(wall=s1['wall'] - s0['wall'], nworkers=s1['nworkers'])
+    for who in ['main', 'workers']:
+        a,b = s0[who], s1[who]
+        dw = {}
+        for k,v in b.items():
+            if k == 'peak_rss_mb':
+                dw[k] = v
+            elif k in a:
+                # (workers may have been replaced -- don't go negative)
+                dw[k] = max(v - a[k], 0)
+        d[who] = dw
+    if 'pickle_traffic' in s1:
+        p0 = s0.get('pickle_traffic')
+        p1 = s1['pickle_traffic']
+        try:
+            d.update(pickle_traffic=[b - a for a,b in zip(p0, p1)])
+        except TypeError:
+            d.update(pickle_traffic=p1)
+    return d
+
+def _jsonable(x):
+    if isinstance(x, np.integer):
+        return int(x)
+    if isinstance(x, np.floating):
+        return float(x)
+    if isinstance(x, np.bool_):
+        return bool(x)
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    return str(x)
+
+def _func_name(filename, lineno, funcname):
+    return '%s:%i(%s)' % (filename, lineno, funcname)
+
+class SamplingProfiler(object):
+    '''
+    A statistical profiler: a thread that samples the stack of the
+    thread that started it every *interval* seconds, counting the
+    functions that are running ("self") and on the stack ("cumulative").
+    '''
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.nsamples = 0
+        self.self_counts = {}
+        self.cum_counts = {}
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+            self.nsamples += 1
+            seen = set()
+            top = True
+            while frame is not None:
+                code = frame.f_code
+                key = _func_name(code.co_filename, code.co_firstlineno, code.co_name)
+                if top:
+                    self.self_counts[key] = self.self_counts.get(key, 0) + 1
+                    top = False
+                if not key in seen:
+                    self.cum_counts[key] = self.cum_counts.get(key, 0) + 1
+                    seen.add(key)
+                frame = frame.f_back
+            del frame
+
+    def summary(self, n=PROFILE_TOP):
+        '''
+        Returns the top *n* functions by cumulative samples, as a list of
+        [function, self seconds, cumulative seconds].
+        '''
+        keys = sorted(self.cum_counts.keys(), key=lambda k: -self.cum_counts[k])[:n]
+        return [[k, self.self_counts.get(k, 0) * self.interval,
+                 self.cum_counts[k] * self.interval] for k in keys]
+
+class StageProfiler(object):
+    '''
+    Profiles (the main thread of) a stage, with *kind* = "cprofile" or
+    "sample".  For cProfile, the full statistics are written to file
+    *fn*, if given.
+    '''
+    def __init__(self, kind, fn=None):
+        if not kind in ['cprofile', 'sample']:
+            raise ValueError('Unknown profiler type "%s"' % kind)
+        self.kind = kind
+        self.fn = fn
+
+    def __enter__(self):
+        if self.kind == 'cprofile':
+            import cProfile
+            self.prof = cProfile.Profile()
+            self.prof.enable()
+        else:
+            self.prof = SamplingProfiler()
+            self.prof.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.kind == 'cprofile':
+            self.prof.disable()
+            if self.fn is not None:
+                self.prof.dump_stats(self.fn)
+                debug('Wrote profile', self.fn)
+        else:
+            self.prof.stop()
+
+    def summary(self, n=PROFILE_TOP):
+        '''
+        Returns the top *n* functions by cumulative time, as a list of
+        [function, self seconds, cumulative seconds].
+        '''
+        if self.kind == 'sample':
+            return self.prof.summary(n=n)
+        import pstats
+        st = pstats.Stats(self.prof).stats
+        keys = sorted(st.keys(), key=lambda k: -st[k][3])[:n]
+        return [[_func_name(*k), st[k][2], st[k][3]] for k in keys]
+
+class Telemetry(object):
+    '''
+    Writes JSON-lines resource events for brick *brick* to file *fn*
+    (appending).
+
+    *pool*: the multiprocessing pool whose workers' usage is included.
+    *profile*: None, "cprofile" or "sample" -- profile each stage?
+    *profile_dir*: where to write the cProfile statistics files.
+    '''
+    def __init__(self, fn, brick, pool=None, profile=None, profile_dir=None):
+        self.fn = fn
+        self.brick = brick
+        self.pool = pool
+        self.profile = profile
+        self.profile_dir = profile_dir
+        dirnm = os.path.dirname(fn)
+        if len(dirnm):
+            os.makedirs(dirnm, exist_ok=True)
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+        self.f = open(fn, 'a')
+        self.lock = threading.Lock()
+        self.s0 = usage_snapshot(pool)
+
+    def event(self, kind, **kwargs):
+        '''
+        Writes one event, of type *kind*, with the given values.
+        '''
+        ev = dict(kind=kind, brick=self.brick, time=time.time(), pid=os.getpid())
+        ev.update(kwargs)
+        line = json.dumps(ev, default=_jsonable)
+        with self.lock:
+            self.f.write(line + '\n')
+            self.f.flush()
+
+    def stage(self, stage):
+        '''
+        Returns a context manager that measures (and profiles, if
+        requested) stage *stage*, writing a "stage" event on exit.
+        '''
+        return StageTelemetry(self, stage)
+
+    def blob_events(self, T):
+        '''
+        Writes a "blob" event for each blob in the fitblobs results
+        table *T*.
+        '''
+        if len(T) == 0:
+            return
+        I = np.flatnonzero(T.blob >= 0)
+        if len(I) == 0:
+            return
+        I = I[np.argsort(T.blob[I], kind='stable')]
+        blobs,i0,nsrc = np.unique(T.blob[I], return_index=True, return_counts=True)
+        cpu = np.maximum.reduceat(T.cpu_blob[I], i0)
+        hit = np.logical_or.reduceat(T.hit_limit[I], i0)
+        for j,b in enumerate(blobs):
+            i = I[i0[j]]
+            self.event('blob', blob=int(b), nsources=int(nsrc[j]),
+                       cpu=float(cpu[j]),
+                       x=int(T.bx0[i]), y=int(T.by0[i]),
+                       npix=int(T.blob_npix[i]),
+                       nimages=int(T.blob_nimages[i]),
+                       totalpix=int(T.blob_totalpix[i]),
+                       hit_limit=bool(hit[j]))
+
+    def finish(self, **kwargs):
+        '''
+        Writes a "brick" event with the total usage since this object
+        was created (and the given values), and closes the file.
+        '''
+        ev = usage_delta(self.s0, usage_snapshot(self.pool))
+        ev.update(kwargs)
+        self.event('brick', **ev)
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+class StageTelemetry(object):
+    def __init__(self, telemetry, stage):
+        self.telemetry = telemetry
+        self.stage = stage
+        self.ntims = None
+        self.profiler = None
+
+    def set_tims(self, tims):
+        '''
+        Records the tims the stage worked on.
+        '''
+        if tims is not None:
+            self.ntims = len(tims)
+
+    def __enter__(self):
+        tel = self.telemetry
+        for pid in [os.getpid()] + pool_pids(tel.pool):
+            reset_peak_rss(pid)
+        if tel.profile is not None:
+            fn = None
+            if tel.profile_dir is not None:
+                fn = os.path.join(tel.profile_dir, 'profile-%s-%s.prof' %
+                                  (tel.brick, self.stage))
+            self.profiler = StageProfiler(tel.profile, fn=fn)
+            self.profiler.__enter__()
+        self.s0 = usage_snapshot(tel.pool)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        tel = self.telemetry
+        s1 = usage_snapshot(tel.pool)
+        ev = usage_delta(self.s0, s1)
+        if self.profiler is not None:
+            self.profiler.__exit__(exc_type, exc_value, traceback)
+            ev.update(profile=self.profiler.summary())
+        ev.update(stage=self.stage, ntims=self.ntims,
+                  ok=(exc_type is None))
+        tel.event('stage', **ev)
@@ -5,6 +5,7 @@ from astrometry.util.fits import fits_table
 from astrometry.util.ttime import Time
 
 from wise.unwise import get_unwise_tractor_image
+from legacypipe.unwise_cache import cached_unwise_dir, cached_filename, get_unwise_psf
 
 import logging
 logger = logging.getLogger('legacypipe.unwise')
@@ -29,13 +30,19 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
                       get_masks=None,
                       move_crpix=False,
                       modelsky_dir=None,
-                      tag=None):
+                      tag=None,
+                      core=None):
     '''
     Given a list of tractor sources *cat*
     and a list of unWISE tiles *tiles* (a fits_table with RA,Dec,coadd_id)
     runs forced photometry, returning a FITS table the same length as *cat*.
 
     *get_masks*: the WCS to resample mask bits into.
+
+    *core*: (wcs, x0, x1, y0, y1): when photometering one spatial tile
+    of a brick (see split_unwise_phot), only the pixels within this
+    (zero-indexed) pixel box of *wcs* are included in the models
+    returned with *get_models*.
     '''
     from tractor import PointSource, Tractor, ExpGalaxy, DevGalaxy
     from tractor.sersic import SersicGalaxy
@@ -88,7 +95,9 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
     tims = []
     for tile in tiles:
         info(tag + 'Reading WISE tile', tile.coadd_id, 'band', band)
-        tim = get_unwise_tractor_image(tile.unwise_dir, tile.coadd_id, band,
+        # (via the node-local cache, if configured)
+        unwise_dir = cached_unwise_dir(tile.unwise_dir, tile.coadd_id, band)
+        tim = get_unwise_tractor_image(unwise_dir, tile.coadd_id, band,
                                        bandname=wanyband, roiradecbox=roiradecbox)
         if tim is None:
             debug('Actually, no overlap with WISE coadd tile', tile.coadd_id)
@@ -124,6 +133,7 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             fn = os.path.join(modelsky_dir, '%s.%i.mod.fits' % (tile.coadd_id, band))
             if not os.path.exists(fn):
                 raise RuntimeError('WARNING: does not exist:', fn)
+            fn = cached_filename(fn)
             x0,x1,y0,y1 = tim.roi
             bg = fitsio.FITS(fn)[2][y0:y1, x0:x1]
             assert(bg.shape == tim.shape)
@@ -202,7 +212,7 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             from astrometry.util.resample import resample_with_wcs, OverlapError
             # unwise_dir can be a colon-separated list of paths
             tilemask = None
-            for d in tile.unwise_dir.split(':'):
+            for d in unwise_dir.split(':'):
                 fn = os.path.join(d, tile.coadd_id[:3], tile.coadd_id,
                                   'unwise-%s-msk.fits.gz' % tile.coadd_id)
                 if os.path.exists(fn):
@@ -254,6 +264,12 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             # (actually, slightly more subtly, expand unique area by 1 pixel)
             from scipy.ndimage.morphology import binary_dilation
             du = binary_dilation(unique)
+            if core is not None:
+                # Only this spatial tile's core goes into the coadds
+                cwcs,cx0,cx1,cy0,cy1 = core
+                _,cx,cy = cwcs.radec2pixelxy(rr, dd)
+                du *= ((cx-1 >= cx0) * (cx-1 < cx1) * (cy-1 >= cy0) * (cy-1 < cy1))
+                del cx,cy
             tim.coadd_inverr = tim.inverr * du
         tim.inverr[unique == False] = 0.
         del xx,yy,rr,dd,unique
@@ -270,13 +286,12 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             ps.savefig()
 
         if pixelized_psf:
-            from unwise_psf import unwise_psf
             if (band == 1) or (band == 2):
                 # we only have updated PSFs for W1 and W2
-                psfimg = unwise_psf.get_unwise_psf(band, tile.coadd_id,
-                                                   modelname='neo6_unwisecat')
+                psfimg = get_unwise_psf(band, tile.coadd_id,
+                                        modelname='neo6_unwisecat')
             else:
-                psfimg = unwise_psf.get_unwise_psf(band, tile.coadd_id)
+                psfimg = get_unwise_psf(band, tile.coadd_id)
 
             if band == 4:
                 # oversample (the unwise_psf models are at native W4 5.5"/pix,
@@ -594,11 +609,14 @@ def unwise_phot(X):
     '''
     This is the entry-point from runbrick.py, called via mp.map()
     '''
-    (key, (wcat, tiles, band, roiradec, wise_ceres, pixelized_psf, get_mods,
-           get_masks, ps, move_crpix, modelsky_dir, tag)) = X
+    (key, args) = X
+    (wcat, tiles, band, roiradec, wise_ceres, pixelized_psf, get_mods,
+     get_masks, ps, move_crpix, modelsky_dir, tag) = args[:12]
+    # (from split_unwise_phot)
+    core = args[12] if len(args) > 12 else None
     kwargs = dict(roiradecbox=roiradec, band=band, pixelized_psf=pixelized_psf,
                   get_masks=get_masks, ps=ps, move_crpix=move_crpix,
-                  modelsky_dir=modelsky_dir, tag=tag)
+                  modelsky_dir=modelsky_dir, tag=tag, core=core)
     if get_mods:
         kwargs.update(get_models=get_mods)
 
@@ -623,6 +641,146 @@ def unwise_phot(X):
                 traceback.print_exc()
     return key,W
 
+# When the forced photometry of a brick is split into spatial tiles,
+# sources within this margin (in unWISE pixels) outside a tile's core
+# are fit along with it, but their fluxes are taken from their own tile.
+forcedphot_tile_margin = 20
+# Minimum number of sources per spatial tile
+forcedphot_min_tile_sources = 500
+
+def _unwise_phot_cost(args):
+    # Rough relative cost of an unwise_phot job: the full-depth coadds
+    # (with get_mods) take about twice as long as one epoch, being
+    # deeper (more sources get big PSF patches) and rendering models.
+    (wcat, _, _, _, _, _, get_mods) = args[:7]
+    return len(wcat) * (2. if get_mods else 1.)
+
+def plan_unwise_phot(jobs, targetwcs, nworkers):
+    '''
+    Splits the unwise_phot *jobs*, a list of (key, args), into spatial
+    tiles (see split_unwise_phot), so that the forced photometry of a
+    crowded brick can keep *nworkers* processes busy, and orders them
+    by decreasing estimated cost.
+
+    Returns (runargs, splits), where *splits* is a dict from the key of
+    each job that was split to its tiles, for merge_unwise_phot.
+    '''
+    costs = [_unwise_phot_cost(args) for _,args in jobs]
+    # Aim for a couple of pieces per worker
+    piece = sum(costs) / (2. * nworkers)
+    runargs = []
+    splits = {}
+    for (key,args),cost in zip(jobs, costs):
+        nsrcs = len(args[0])
+        ntiles = 1
+        if nworkers > 1 and piece > 0:
+            ntiles = min(int(np.ceil(cost / piece)),
+                         nsrcs // forcedphot_min_tile_sources)
+        if ntiles <= 1:
+            runargs.append((cost, key, args))
+            continue
+        parts = split_unwise_phot(key, args, targetwcs, ntiles)
+        for tkey,targs,I,_,_ in parts:
+            runargs.append((cost * len(I) / nsrcs, tkey, targs))
+        splits[key] = [(tkey,I,incore,maskxy) for tkey,_,I,incore,maskxy in parts]
+        info('Split unWISE forced phot', args[11], 'into', len(parts), 'spatial tiles')
+    runargs.sort(key=lambda x: -x[0])
+    return [(key,args) for _,key,args in runargs], splits
+
+def split_unwise_phot(key, args, targetwcs, ntiles):
+    '''
+    Splits the unwise_phot job (*key*, *args*) for the brick *targetwcs*
+    into (about) *ntiles* spatial tiles.  Each tile photometers the
+    sources in its core plus a margin, using the pixels of the core plus
+    margin, and reports only its core sources (and core pixels, for the
+    models and masks).  Tiles at the edges extend to include sources
+    outside the brick.
+
+    Returns a list of (key, args, I, incore, maskxy), where *I* are the
+    indices of the tile's sources in the job's catalog, *incore* says
+    which of those are in the core, and *maskxy* is the offset of the
+    core (and its mask map) in the brick.
+    '''
+    (wcat, tiles, band, roiradec, wise_ceres, pixelized_psf, get_mods,
+     get_masks, ps, move_crpix, modelsky_dir, tag) = args
+    H,W = targetwcs.shape
+    nx = int(np.ceil(np.sqrt(ntiles)))
+    ny = int(np.ceil(ntiles / nx))
+    xb = np.round(np.linspace(0, W, nx+1)).astype(int)
+    yb = np.round(np.linspace(0, H, ny+1)).astype(int)
+    # unWISE pixels are 2.75"
+    margin = forcedphot_tile_margin * 2.75 / targetwcs.pixel_scale()
+    ra  = np.array([src.getPosition().ra  for src in wcat])
+    dec = np.array([src.getPosition().dec for src in wcat])
+    _,sx,sy = targetwcs.radec2pixelxy(ra, dec)
+    sx -= 1.
+    sy -= 1.
+    def core_range(b, i, n):
+        return (b[i] if i > 0 else -np.inf), (b[i+1] if i < n-1 else np.inf)
+    parts = []
+    for iy in range(ny):
+        for ix in range(nx):
+            cx0,cx1 = core_range(xb, ix, nx)
+            cy0,cy1 = core_range(yb, iy, ny)
+            incore = (sx >= cx0) * (sx < cx1) * (sy >= cy0) * (sy < cy1)
+            if not (np.any(incore) or get_mods or get_masks is not None):
+                continue
+            I = np.flatnonzero((sx >= cx0 - margin) * (sx < cx1 + margin) *
+                               (sy >= cy0 - margin) * (sy < cy1 + margin))
+            # Pixels: the core plus margin, within the brick
+            x0,x1 = max(0, xb[ix] - margin), min(W, xb[ix+1] + margin)
+            y0,y1 = max(0, yb[iy] - margin), min(H, yb[iy+1] + margin)
+            rr,dd = targetwcs.pixelxy2radec(np.array([x0, x1]) + 0.5,
+                                            np.array([y0, y1]) + 0.5)
+            subroi = [rr[0], rr[1], dd[0], dd[1]]
+            submasks = None
+            if get_masks is not None:
+                submasks = targetwcs.get_subimage(int(xb[ix]), int(yb[iy]),
+                                                  int(xb[ix+1]-xb[ix]),
+                                                  int(yb[iy+1]-yb[iy]))
+            itile = len(parts)
+            parts.append((key + (itile, nx*ny),
+                          ([wcat[i] for i in I], tiles, band, subroi, wise_ceres,
+                           pixelized_psf, get_mods, submasks, ps, move_crpix,
+                           modelsky_dir, '%s (tile %i/%i)' % (tag, iy*nx+ix+1, nx*ny),
+                           (targetwcs, cx0, cx1, cy0, cy1)),
+                          I, incore[I], (xb[ix], yb[iy])))
+    return parts
+
+def merge_unwise_phot(nsrcs, parts, results, maskshape=None):
+    '''
+    Merges the unwise_phot *results* (a dict) for the spatial tiles
+    *parts* (from plan_unwise_phot) of one job into a single result for
+    its *nsrcs* sources, taking each source's measurements from the
+    tile whose core contains it.  Returns None if any tile failed.
+    '''
+    rtn = wphotduck()
+    rtn.phot = None
+    rtn.models = None
+    rtn.maskmap = None
+    for tkey,I,incore,maskxy in parts:
+        W = results[tkey]
+        if W is None:
+            return None
+        if rtn.phot is None:
+            rtn.phot = fits_table()
+            for c in W.phot.get_columns():
+                v = W.phot.get(c)
+                rtn.phot.set(c, np.zeros((nsrcs,) + v.shape[1:], v.dtype))
+        for c in W.phot.get_columns():
+            rtn.phot.get(c)[I[incore]] = W.phot.get(c)[incore]
+        if W.models is not None:
+            if rtn.models is None:
+                rtn.models = []
+            rtn.models.extend(W.models)
+        if W.maskmap is not None:
+            if rtn.maskmap is None:
+                rtn.maskmap = np.zeros(maskshape, W.maskmap.dtype)
+            x0,y0 = maskxy
+            h,w = W.maskmap.shape
+            rtn.maskmap[y0:y0+h, x0:x0+w] = W.maskmap
+    return rtn
+
 def collapse_unwise_bitmask(bitmask, band):
     '''
     Converts WISE mask bits (in the unWISE data products) into the
@@ -0,0 +1,417 @@
+'''
+A node-local cache of unWISE inputs for the WISE forced-photometry
+stage, shared by the bricks that run (in sequence or concurrently) on
+one node.
+
+One 2048x2048 unWISE tile covers dozens of bricks, so reading it over
+the network for each brick is mostly repeated I/O.  With a cache
+directory on node-local storage (eg, /tmp or /dev/shm; runbrick
+--unwise-cache-dir, or $LEGACYPIPE_UNWISE_CACHE_DIR), the tile files
+for each (tile, band) and the model-sky maps are copied there once and
+read locally afterward.  The directory is kept below a size limit by
+evicting the least-recently-used entries; entries used recently (by a
+brick that may still be reading them) are never evicted.  Copies are
+made under a file lock and renamed into place, so concurrent bricks
+neither duplicate nor see partial copies.  Staged files are assumed not
+to change: use a new cache directory for a new unWISE release.
+
+The pixelized PSF models and the time-resolved atlas are also cached in
+memory, per process, and the PSF models as .npy cache entries (counted
+towards the size limit, and evicted like the others).
+
+order_bricks_by_unwise_tile() (or running this script on a list of
+bricks) orders bricks so that those in the same unWISE tile run
+together, which is what makes the cache effective.
+'''
+import os
+import sys
+import time
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.unwise_cache')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+# Default size limit of the cache directory, in bytes
+default_cache_size = 100e9
+# Cache entries used within this many seconds are not evicted
+eviction_grace = 3600.
+
+class UnwiseCache(object):
+    '''
+    A size-bounded cache of unWISE files in (node-local) directory
+    *cachedir*, holding at most *maxsize* bytes.
+
+    Each cache entry is a group of files in one directory, staged
+    together, and recorded in a ".staged-<name>" file listing them;
+    that file's modification time records when the entry was last used.
+    '''
+    def __init__(self, cachedir, maxsize=None):
+        if maxsize is None:
+            maxsize = default_cache_size
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def _srcdir_key(self, srcdir):
+        import hashlib
+        return hashlib.md5(os.path.abspath(srcdir).encode()).hexdigest()[:12]
+
+    def _stage(self, destdir, name, srcfns):
+        '''
+        Copies files *srcfns* (a callable returning the list of files,
+        called only if the entry is not already staged) into *destdir*,
+        as the entry called *name*.  Returns True on success.
+        '''
+        import fcntl
+        import shutil
+        marker = os.path.join(destdir, '.staged-%s' % name)
+        if os.path.exists(marker):
+            try:
+                os.utime(marker)
+                self.hits += 1
+                return True
+            except OSError:
+                # evicted just now
+                pass
+        self.misses += 1
+        os.makedirs(destdir, exist_ok=True)
+        with open(os.path.join(destdir, '.lock-%s' % name), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(marker):
+                # Another process staged it while we waited for the lock.
+                os.utime(marker)
+                return True
+            fns = srcfns()
+            if len(fns) == 0:
+                return False
+            t0 = time.time()
+            nbytes = 0
+            for fn in fns:
+                dest = os.path.join(destdir, os.path.basename(fn))
+                tmpfn = dest + '.tmp-%i' % os.getpid()
+                shutil.copyfile(fn, tmpfn)
+                os.rename(tmpfn, dest)
+                nbytes += os.path.getsize(dest)
+            tmpfn = marker + '.tmp-%i' % os.getpid()
+            with open(tmpfn, 'w') as f:
+                f.write('\n'.join(os.path.basename(fn) for fn in fns) + '\n')
+            os.rename(tmpfn, marker)
+            debug('Staged', len(fns), 'files (%.1f MB) in %.1f s to' % (nbytes/1e6, time.time()-t0),
+                  destdir)
+        self.evict()
+        return True
+
+    def unwise_dir(self, unwise_dir, coadd_id, band):
+        '''
+        Returns the unWISE directory (path) to read tile *coadd_id*,
+        band *band* from: a cache directory holding the tile's files
+        for that band (and its mask), followed by the original
+        *unwise_dir*.  Returns *unwise_dir* if the tile is not found.
+        '''
+        # unwise_dir can be a colon-separated list of paths
+        for d in unwise_dir.split(':'):
+            tiledir = os.path.join(d, coadd_id[:3], coadd_id)
+            if os.path.isdir(tiledir):
+                break
+        else:
+            return unwise_dir
+        base = os.path.join(self.cachedir, 'unwise', self._srcdir_key(d))
+        destdir = os.path.join(base, coadd_id[:3], coadd_id)
+        def srcfns():
+            prefix = 'unwise-%s-w%i-' % (coadd_id, band)
+            fns = [fn for fn in sorted(os.listdir(tiledir)) if fn.startswith(prefix)]
+            msk = 'unwise-%s-msk.fits.gz' % coadd_id
+            if band == 1 and os.path.exists(os.path.join(tiledir, msk)):
+                fns.append(msk)
+            return [os.path.join(tiledir, fn) for fn in fns]
+        try:
+            ok = self._stage(destdir, 'w%i' % band, srcfns)
+        except (OSError, IOError) as e:
+            info('Failed to cache unWISE tile', coadd_id, 'band', band, ':', e)
+            return unwise_dir
+        if not ok:
+            return unwise_dir
+        return base + ':' + unwise_dir
+
+    def filename(self, fn):
+        '''
+        Returns the name of a cached copy of file *fn* (eg, a model-sky
+        map), or *fn* if it cannot be cached.
+        '''
+        if not os.path.exists(fn):
+            return fn
+        srcdir,base = os.path.split(fn)
+        destdir = os.path.join(self.cachedir, 'files', self._srcdir_key(srcdir))
+        try:
+            ok = self._stage(destdir, base, lambda: [fn])
+        except (OSError, IOError) as e:
+            info('Failed to cache', fn, ':', e)
+            return fn
+        if not ok:
+            return fn
+        return os.path.join(destdir, base)
+
+    def array(self, name, func):
+        '''
+        Returns the numpy array cached as the .npy file *name*, calling
+        *func()* to compute it if it is not cached (or cannot be).
+        '''
+        import shutil
+        import tempfile
+        destdir = os.path.join(self.cachedir, 'arrays')
+        tmpdirs = []
+        def srcfns():
+            # Save to a scratch directory, from which _stage copies it.
+            tmpdir = tempfile.mkdtemp(dir=self.cachedir, prefix='.tmp-')
+            tmpdirs.append(tmpdir)
+            fn = os.path.join(tmpdir, name)
+            np.save(fn, func())
+            return [fn]
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            ok = self._stage(destdir, name, srcfns)
+            if ok:
+                return np.load(os.path.join(destdir, name))
+        except (OSError, IOError) as e:
+            info('Failed to cache', name, ':', e)
+        finally:
+            for d in tmpdirs:
+                shutil.rmtree(d, ignore_errors=True)
+        return func()
+
+    def entries(self):
+        '''
+        Returns a list of (last-used time, size in bytes, directory,
+        marker filename) for the staged entries.
+        '''
+        E = []
+        for dirpath,_,filenames in os.walk(self.cachedir):
+            for fn in filenames:
+                if not fn.startswith('.staged-') or '.tmp-' in fn:
+                    continue
+                marker = os.path.join(dirpath, fn)
+                try:
+                    t = os.path.getmtime(marker)
+                    with open(marker) as f:
+                        names = f.read().split()
+                except (OSError, IOError):
+                    continue
+                size = 0
+                for n in names:
+                    try:
+                        size += os.path.getsize(os.path.join(dirpath, n))
+                    except OSError:
+                        pass
+                E.append((t, size, dirpath, marker))
+        return E
+
+    def evict(self):
+        '''
+        Deletes the least-recently-used entries until the cache holds
+        no more than *maxsize* bytes, keeping the entries used in the
+        last *eviction_grace* seconds.
+        '''
+        import fcntl
+        with open(os.path.join(self.cachedir, '.lock-evict'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (OSError, IOError):
+                # Someone else is evicting
+                return
+            E = self.entries()
+            total = sum(e[1] for e in E)
+            if total <= self.maxsize:
+                return
+            E.sort()
+            now = time.time()
+            for t,size,dirpath,marker in E:
+                if total <= self.maxsize or t > now - eviction_grace:
+                    break
+                with open(marker) as f:
+                    names = f.read().split()
+                # Remove the marker first, so the entry is not used while
+                # its files are being deleted.
+                os.remove(marker)
+                for n in names:
+                    try:
+                        os.remove(os.path.join(dirpath, n))
+                    except OSError:
+                        pass
+                total -= size
+                debug('Evicted', dirpath, marker)
+            if total > self.maxsize:
+                info('unWISE cache holds %.1f GB (limit %.1f GB) of recently-used files' %
+                     (total/1e9, self.maxsize/1e9))
+
+_unwise_cache = None
+def get_unwise_cache():
+    '''
+    Returns the UnwiseCache for $LEGACYPIPE_UNWISE_CACHE_DIR (of size
+    $LEGACYPIPE_UNWISE_CACHE_SIZE bytes), or None if it is not set.
+    The environment is read on each call, so this works in pool worker
+    processes.
+    '''
+    global _unwise_cache
+    cachedir = os.environ.get('LEGACYPIPE_UNWISE_CACHE_DIR')
+    if not cachedir:
+        return None
+    maxsize = os.environ.get('LEGACYPIPE_UNWISE_CACHE_SIZE')
+    maxsize = float(maxsize) if maxsize else None
+    if (_unwise_cache is None or _unwise_cache.cachedir != cachedir or
+        (maxsize is not None and _unwise_cache.maxsize != maxsize)):
+        _unwise_cache = UnwiseCache(cachedir, maxsize=maxsize)
+    return _unwise_cache
+
+def cached_unwise_dir(unwise_dir, coadd_id, band):
+    '''
+    Returns the unWISE directory to read tile *coadd_id*, band *band*
+    from -- via the node-local cache, if one is configured.
+    '''
+    cache = get_unwise_cache()
+    if cache is None:
+        return unwise_dir
+    return cache.unwise_dir(unwise_dir, coadd_id, band)
+
+def cached_filename(fn):
+    '''
+    Returns the name of file *fn* in the node-local cache, if one is
+    configured, or else *fn*.
+    '''
+    cache = get_unwise_cache()
+    if cache is None:
+        return fn
+    return cache.filename(fn)
+
+# Process-wide cache of the pixelized PSF models
+psf_cache = None
+def get_unwise_psf(band, coadd_id, **kwargs):
+    '''
+    Returns (a copy of) unwise_psf.get_unwise_psf(*band*, *coadd_id*,
+    **kwargs), cached in memory and (with a cache directory) as a .npy
+    cache entry.
+    '''
+    global psf_cache
+    from legacypipe.utils import LRUCache
+    if psf_cache is None:
+        psf_cache = LRUCache(maxitems=1000)
+    key = (band, coadd_id) + tuple(sorted(kwargs.items()))
+    psfimg = psf_cache.get(key)
+    if psfimg is not None:
+        return psfimg.copy()
+    def compute():
+        from unwise_psf import unwise_psf
+        return unwise_psf.get_unwise_psf(band, coadd_id, **kwargs)
+    cache = get_unwise_cache()
+    if cache is None:
+        psfimg = compute()
+    else:
+        tag = ''.join('-%s' % v for _,v in sorted(kwargs.items()))
+        psfimg = cache.array('unwise-psf-%s-w%i%s.npy' % (coadd_id, band, tag),
+                             compute)
+    psf_cache.put(key, psfimg)
+    return psfimg.copy()
+
+# Process-wide cache of time-resolved atlas tables
+atlas_cache = None
+def read_tr_atlas(fn):
+    '''
+    Returns (a copy of) the time-resolved unWISE atlas table in file
+    *fn*.  Cache entries are keyed by the file's modification time and
+    size.
+    '''
+    global atlas_cache
+    from astrometry.util.fits import fits_table
+    from legacypipe.utils import LRUCache
+    if atlas_cache is None:
+        atlas_cache = LRUCache(maxitems=4)
+    st = os.stat(fn)
+    key = (fn, st.st_mtime_ns, st.st_size)
+    T = atlas_cache.get(key)
+    if T is None:
+        T = fits_table(cached_filename(fn))
+        atlas_cache.put(key, T)
+    return T.copy()
+
+def order_bricks_by_unwise_tile(ra, dec):
+    '''
+    Orders bricks (with centers *ra*, *dec*) so that bricks in the same
+    unWISE tile (whose unique area contains the brick center) are
+    adjacent, with tiles in order of Dec and then RA, and the bricks in
+    each tile in order of Dec and then RA.
+
+    Returns (I, coadd_id): the ordering (index array) and the unWISE
+    tile of each (input) brick.
+    '''
+    from astrometry.util.fits import fits_table
+    from pkg_resources import resource_filename
+    from legacypipe.unwise import radec_in_unique_area
+    ra = np.atleast_1d(ra).astype(float)
+    dec = np.atleast_1d(dec).astype(float)
+    atlasfn = resource_filename('legacypipe', 'data/wise-tiles.fits')
+    T = fits_table(atlasfn, columns=['coadd_id', 'ra', 'dec', 'ra1', 'ra2', 'dec1', 'dec2'])
+    T.cut(np.lexsort((T.ra, T.dec)))
+
+    itile = np.empty(len(ra), int)
+    itile[:] = len(T)
+    J = np.argsort(dec)
+    sdec = dec[J]
+    for i in range(len(T)):
+        j0,j1 = np.searchsorted(sdec, [T.dec1[i], T.dec2[i]])
+        if j0 == j1:
+            continue
+        K = J[j0:j1]
+        K = K[radec_in_unique_area(ra[K], dec[K], T.ra1[i], T.ra2[i],
+                                   T.dec1[i], T.dec2[i])]
+        itile[K] = np.minimum(itile[K], i)
+    I = np.lexsort((ra, dec, itile))
+    coadd_id = np.array([T.coadd_id[i] if i < len(T) else '' for i in itile])
+    return I, coadd_id
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Order a list of bricks so that bricks in the same unWISE tile run together (making good use of runbrick --unwise-cache-dir).')
+    parser.add_argument('bricklist', help='Text file of brick names, one per line')
+    parser.add_argument('--survey-dir', default=None,
+                        help='Survey directory (for the bricks table)')
+    parser.add_argument('--out', default=None,
+                        help='Write the ordered brick names to this file (default: stdout)')
+    parser.add_argument('--tiles', default=False, action='store_true',
+                        help='Also print the unWISE tile of each brick')
+    opt = parser.parse_args(args=args)
+
+    from legacypipe.survey import LegacySurveyData
+    names = []
+    with open(opt.bricklist) as f:
+        for line in f:
+            words = line.split()
+            if len(words) and not words[0].startswith('#'):
+                names.append(words[0])
+    survey = LegacySurveyData(survey_dir=opt.survey_dir)
+    B = survey.get_bricks_readonly()
+    bmap = dict((n,i) for i,n in enumerate(B.brickname))
+    missing = [n for n in names if not n in bmap]
+    if len(missing):
+        print('Bricks not found:', ' '.join(missing))
+        return -1
+    K = np.array([bmap[n] for n in names])
+    I,coadd_id = order_bricks_by_unwise_tile(B.ra[K], B.dec[K])
+    out = sys.stdout if opt.out is None else open(opt.out, 'w')
+    for i in I:
+        if opt.tiles:
+            print(names[i], coadd_id[i], file=out)
+        else:
+            print(names[i], file=out)
+    if opt.out is not None:
+        out.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
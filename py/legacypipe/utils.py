@@ -160,6 +160,81 @@ def add_bits(hdr, bitmap, description, desc, bitpre):
             dict(name='%sBIT_%i' % (bitpre, i), value=revmap[bit],
                  comment='%s bit 2**%i=%i meaning' % (description, i, bit)))
 
+class LRUCache(object):
+    '''
+    A least-recently-used cache, for data we would like to keep around
+    between bricks / CCDs in a single process.
+
+    *maxitems*: maximum number of entries to keep.
+    *maxsize*: maximum total size (as computed by *sizefunc*, by default
+     the summed *nbytes* of numpy arrays) of the entries to keep.
+    '''
+    def __init__(self, maxitems=None, maxsize=None, sizefunc=None):
+        from collections import OrderedDict
+        self.maxitems = maxitems
+        self.maxsize = maxsize
+        if sizefunc is None:
+            sizefunc = _cache_nbytes
+        self.sizefunc = sizefunc
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            val = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return val
+
+    def put(self, key, val):
+        self.pop(key)
+        sz = self.sizefunc(val) if self.maxsize is not None else 0
+        self.items[key] = val
+        self.sizes[key] = sz
+        self.size += sz
+        # Evict the oldest entries, but always keep the newest one.
+        while len(self.items) > 1 and (
+                (self.maxitems is not None and len(self.items) > self.maxitems) or
+                (self.maxsize is not None and self.size > self.maxsize)):
+            oldkey = next(iter(self.items))
+            self.pop(oldkey)
+
+    def pop(self, key, default=None):
+        if not key in self.items:
+            return default
+        self.size -= self.sizes.pop(key)
+        return self.items.pop(key)
+
+    def clear(self):
+        self.items.clear()
+        self.sizes.clear()
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+def _cache_nbytes(val):
+    if isinstance(val, np.ndarray):
+        return val.nbytes
+    if isinstance(val, (tuple, list)):
+        return sum(_cache_nbytes(v) for v in val)
+    if isinstance(val, dict):
+        return sum(_cache_nbytes(v) for v in val.values())
+    cols = getattr(val, 'get_columns', None)
+    if cols is not None:
+        # fits_table
+        return sum(_cache_nbytes(val.get(c)) for c in cols())
+    return 0
+
 def run_ps_thread(parent_pid, parent_ppid, fn, shutdown, event_queue):
     from astrometry.util.run_command import run_command
     from astrometry.util.fits import fits_table, merge_tables
@@ -59,7 +59,54 @@ def worker(workq, resultq):
         if max([tget, tpickle, tput, tunpickle]) > 1:
             print('Worker', myid, ': work %5.2f, unpickle %5.2f, get work %5.2f (queue size %i), pickle %5.2f, put results %5.2f' % (t1_wall-t0_wall, tunpickle, tget, qsize, tpickle, tput))
 
-def queue_feeder(server, workq, resultq):
+class FeederCredit(object):
+    '''
+    The credit we give the farm.py server.  Rather than the number of
+    additional work packets we want (which the server would add up),
+    each message reports our absolute state: the number of packets we
+    have received so far, and the number we have room for.  The server
+    knows how many it has sent us, so it can work out how many are in
+    flight and how many more it may send.  Repeating a report -- eg,
+    to renew our credit in case the server was restarted and forgot
+    it -- therefore never gives us more than *prefetch* packets.
+    '''
+    def __init__(self, prefetch, timeout=300):
+        self.prefetch = prefetch
+        self.timeout = timeout
+        self.nreceived = 0
+        # nreceived + room, as of our last report
+        self.reported = 0
+        self.last_report = 0.
+        self.last_recv = time.time()
+
+    def room(self, qsize):
+        return max(0, self.prefetch - qsize)
+
+    def need_report(self, qsize):
+        '''
+        Do we need to tell the server about new room in our queue, or
+        renew our credit after not getting any work for a while?
+        '''
+        if self.nreceived + self.room(qsize) > self.reported:
+            return True
+        now = time.time()
+        return (self.room(qsize) > 0 and now - self.last_recv > self.timeout and
+                now - self.last_report > self.timeout)
+
+    def report(self, qsize):
+        '''
+        Returns the credit message to send, "nreceived:room".
+        '''
+        room = self.room(qsize)
+        self.reported = self.nreceived + room
+        self.last_report = time.time()
+        return ('%i:%i' % (self.nreceived, room)).encode()
+
+    def received(self):
+        self.nreceived += 1
+        self.last_recv = time.time()
+
+def queue_feeder(server, workq, resultq, prefetch):
     from queue import Empty
 
     # Build job id string to identify myself to the farm.py server.
@@ -88,65 +135,55 @@ def queue_feeder(server, workq, resultq):
 
     print('Connecting to', server)
     ctx = zmq.Context()
-    sock = ctx.socket(zmq.REQ)
+    # A DEALER socket lets us keep several requests for work in flight
+    # and send results as soon as they are ready.  The server grants us
+    # work packets against "credit", which we send along with each
+    # message (see FeederCredit).
+    sock = ctx.socket(zmq.DEALER)
     sock.connect(server)
 
     nonemsg = pickle.dumps(None, -1)
-
-    was_full = False
-
+    credit = FeederCredit(prefetch)
     nassigned = 0
     while True:
-
-        if workq.full():
-            #print('Work queue is full.  Waiting.')
-            was_full = True
-            #s_0 = workq.qsize()
-            # FIXME -- dynamic sleep time?
-            time.sleep(0.1)
-            # s_1 = workq.qsize()
-            # if s_1 < s_0:
-            #     print('Work queue dropped in size by %i items while I slept' % (s_0-s_1))
-            continue
-
-        # if was_full:
-        #     print('Work queue is newly not-full.  Work queue size:', workq.qsize())
-        # was_full = False
-
-        t_0 = time.time()
-        # Check for a result produced by worker processes
-        try:
-            result,rmeta,brick,iblob = resultq.get_nowait()
-            #print('Completed work: brick', brick, 'blob', iblob)
-        except Empty:
-            result,rmeta = nonemsg,nonemsg
-        #print('Work queue contains ~%i items.  Results queue contains ~%i items.' %
-        #      (workq.qsize(), resultq.qsize()))
-
-        # Send result (if any) to server (and get back work item)
-        t_a = time.time()
-        sock.send_multipart([jobid, rmeta, result])
-        t_b = time.time()
-        work = sock.recv()
-        t_c = time.time()
-        # only unpickle very short work packets to check for None.
-        if len(work) < 10:
-            realwork = pickle.loads(work)
-            if realwork is None:
-                print('No work assigned!')
-                time.sleep(1)
-                continue
-        nassigned += 1
-        # We don't unpickle the work packet, we let the worker process do that
-        workq.put(work)
-        t_e = time.time()
-        #print('Queue feeder: read result: %5.2f, send: %5.2f, recv: %5.2f, queue %5.2f, queue size %i' %
-        #      (t_a - t_0, t_b - t_a, t_c - t_b, t_e - t_c, workq.qsize()))
+        # Send all results (if any) produced by the worker processes,
+        # with our current credit.
+        nsent = 0
+        while True:
+            try:
+                result,rmeta,brick,iblob = resultq.get_nowait()
+            except Empty:
+                break
+            sock.send_multipart([b'', jobid, rmeta, result, credit.report(workq.qsize())])
+            nsent += 1
+        if nsent == 0 and credit.need_report(workq.qsize()):
+            # No results, but we have room for more work (or have not
+            # heard from the server for a while).
+            sock.send_multipart([b'', jobid, nonemsg, nonemsg, credit.report(workq.qsize())])
+
+        # Receive work packets, waiting a short while for the first one.
+        timeout = 100
+        while sock.poll(timeout=timeout):
+            timeout = 0
+            parts = sock.recv_multipart()
+            credit.received()
+            work = parts[-1]
+            # only unpickle very short work packets to check for None.
+            if len(work) < 10:
+                realwork = pickle.loads(work)
+                if realwork is None:
+                    print('No work assigned!')
+                    continue
+            nassigned += 1
+            # We don't unpickle the work packet, we let the worker process do that
+            workq.put(work)
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('server', nargs=1, help='Server URL, eg tcp://edison08:5555')
     parser.add_argument('--threads', type=int, help='Number of processes to run')
+    parser.add_argument('--prefetch', type=int, default=8,
+                        help='Number of work packets to keep queued locally')
 
     opt = parser.parse_args()
 
@@ -160,12 +197,13 @@ def main():
     # this is to reduce the number of clients contacting the
     # server and to provide a short local buffer of work to reduce
     # overheads.  There is also a "results" queue where the
-    # workers place their finished results.
-    nqueued = 8
-    workq = Queue(nqueued)
+    # workers place their finished results.  The feeder keeps up to
+    # "prefetch" work packets queued or in flight, so the workers
+    # do not wait on the network between blobs.
+    workq = Queue(opt.prefetch)
     resultq = Queue()
 
-    p_feeder = Process(target=queue_feeder, args=(server, workq, resultq))
+    p_feeder = Process(target=queue_feeder, args=(server, workq, resultq, opt.prefetch))
     p_feeder.start()
 
     if opt.threads:
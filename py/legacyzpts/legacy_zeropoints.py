@@ -295,11 +295,33 @@ def measure_image(img_fn, mp, image_dir='images',
             validate_version(fn, 'table', img.expnum, img.plver, img.plprocid, quiet=quiet)):
             psfex = False
 
+    # If we have to run calibs and zeropoints, and there are no stale
+    # merged calib files that would be read instead of the new
+    # single-CCD ones, run both for each CCD in one task, so that the
+    # pixels are only read (and decompressed) once.
+    rtns = None
+    fused = ((splinesky or psfex) and
+             not (run_calibs_only or run_psf_only or run_sky_only))
+    if splinesky and os.path.exists(survey.find_file('sky', img=img, use_cache=False)):
+        fused = False
+    if psfex and os.path.exists(survey.find_file('psf', img=img, use_cache=False)):
+        fused = False
+
     if splinesky or psfex:
         git_version = get_git_version(dirnm=os.path.dirname(legacypipe.__file__))
-        imgs = mp.map(run_one_calib, [(img_fn, camera, survey, ext, psfex, splinesky,
-                                       plots, survey_blob_mask, survey_zeropoints, git_version)
-                                      for ext in extlist])
+        calibargs = [(img_fn, camera, survey, ext, psfex, splinesky,
+                      plots, survey_blob_mask, survey_zeropoints, git_version)
+                     for ext in extlist]
+        if fused:
+            R = mp.map(run_one_calib_and_ext,
+                       [(args, splinesky, measureargs['sdss_photom'],
+                         measureargs.get('batch_starfit', False))
+                        for args in calibargs])
+            imgs = [img for img,_ in R]
+            rtns = [rtn for _,rtn in R]
+            del R
+        else:
+            imgs = mp.map(run_one_calib, calibargs)
         from legacyzpts.merge_calibs import merge_splinesky, merge_psfex
         class FakeOpts(object):
             pass
@@ -365,9 +387,11 @@ def measure_image(img_fn, mp, image_dir='images',
     if run_calibs_only or run_psf_only or run_sky_only:
         return
 
-    rtns = mp.map(run_one_ext, [(img, ext, survey, splinesky,
-                                 measureargs['sdss_photom'])
-                                for ext in extlist])
+    if rtns is None:
+        rtns = mp.map(run_one_ext, [(img, ext, survey, splinesky,
+                                     measureargs['sdss_photom'],
+                                     measureargs.get('batch_starfit', False))
+                                    for ext in extlist])
 
     for ccd,photom in rtns:
         if ccd is not None:
@@ -463,13 +487,35 @@ def run_one_calib(X):
     # Otherwise, let the exception propagate.
     return img
 
+# Bytes of decompressed pixels to keep between the calibration and
+# zeropoint steps for a CCD (in run_one_calib_and_ext).
+PIXEL_CACHE_SIZE = 1e9
+
+def run_one_calib_and_ext(X):
+    '''
+    Runs run_one_calib and then run_one_ext for one CCD, in the same
+    process, with the image, weight and DQ pixels cached between them.
+    '''
+    from legacypipe.image import set_pixel_cache
+    calibargs, splinesky, sdss_photom, batch_starfit = X
+    survey, ext = calibargs[2:4]
+    set_pixel_cache(PIXEL_CACHE_SIZE)
+    try:
+        img = run_one_calib(calibargs)
+        rtn = run_one_ext((img, ext, survey, splinesky, sdss_photom,
+                           batch_starfit))
+    finally:
+        set_pixel_cache(None)
+    return img, rtn
+
 def run_one_ext(X):
-    img, ext, survey, splinesky, sdss_photom = X
+    img, ext, survey, splinesky, sdss_photom, batch_starfit = X
 
     img = survey.get_image_object(None, camera=img.camera,
                                   image_fn=img.image_filename, image_hdu=ext,
                                   prime_cache=False)
-    return run_zeropoints(img, splinesky=splinesky, sdss_photom=sdss_photom)
+    return run_zeropoints(img, splinesky=splinesky, sdss_photom=sdss_photom,
+                          batch_starfit=batch_starfit)
 
 class outputFns(object):
     def __init__(self, imgfn, outdir, camera, image_dir='images', debug=False):
@@ -516,6 +562,36 @@ class outputFns(object):
         self.photomfn = os.path.join(basedir, base + '-photom.fits')
         self.annfn = os.path.join(basedir, base + '-annotated.fits')
 
+def prefetch_image_files(survey, camera, imgfn, blocksize=8*1024*1024):
+    '''
+    Starts a background thread that reads through the image, weight and
+    DQ files for *imgfn*, so that they are in the page cache by the time
+    we get to them (ie, overlapping the reads for the next exposure with
+    the processing of this one).  Best-effort: errors are ignored.
+    '''
+    import threading
+    def prefetch():
+        try:
+            img = survey.get_image_object(None, camera=camera, image_fn=imgfn,
+                                          image_hdu=None, prime_cache=False,
+                                          check_cache=False)
+            fns = [img.imgfn, img.wtfn, img.dqfn]
+        except Exception as e:
+            print('Prefetch: failed to find files for', imgfn, ':', e)
+            return
+        for fn in fns:
+            if fn is None or not os.path.exists(fn):
+                continue
+            try:
+                with open(fn, 'rb', buffering=0) as f:
+                    while f.read(blocksize):
+                        pass
+            except OSError:
+                pass
+    thread = threading.Thread(target=prefetch, daemon=True)
+    thread.start()
+    return thread
+
 def writeto_via_temp(outfn, obj, func_write=False, **kwargs):
     tempfn = os.path.join(os.path.dirname(outfn), 'tmp-' + os.path.basename(outfn))
     if func_write:
@@ -629,6 +705,8 @@ def get_parser():
     parser.add_argument('--outdir', type=str, default=None, help='Where to write photom and annotated files; default [survey_dir]/zpt')
     parser.add_argument('--sdss-photom', default=False, action='store_true',
                         help='Use SDSS rather than PS-1 for photometric cal.')
+    parser.add_argument('--batch-starfit', default=False, action='store_true',
+                        help='Fit the calibration stars all at once in numpy (legacyzpts/starfit.py) rather than with tractor, star by star.')
     parser.add_argument('--debug', action='store_true', default=False, help='Write additional files and plots for debugging')
     parser.add_argument('--choose_ccd', action='store', default=None, help='forced to use only the specified ccd')
     parser.add_argument('--prefix', type=str, default='', help='Prefix to prepend to the output files.')
@@ -654,6 +732,10 @@ def get_parser():
                         help='if None will use LEGACY_SURVEY_DIR/calib, e.g. /global/cscratch1/sd/desiproc/dr5-new/calib')
     parser.add_argument('--no-check-photom', dest='check_photom', action='store_false',
                         help='Do not check for photom file when deciding if this file is done or not.')
+    parser.add_argument('--no-prefetch', dest='prefetch', default=True, action='store_false',
+                        help='Do not read the next image\'s files in the background while processing the current one')
+    parser.add_argument('--healpix-cache-size', type=float, default=0,
+                        help='Keep up to this many MB of decoded Gaia/PS1 catalog tiles in memory, per process, for reuse by later CCDs (default: off)')
     parser.add_argument('--threads', default=None, type=int,
                         help='Multiprocessing threads (parallel by HDU)')
     parser.add_argument('--quiet', default=False, action='store_true', help='quiet down')
@@ -716,6 +798,9 @@ def main(args=None):
     quiet = measureargs.get('quiet', False)
 
     from astrometry.util.multiproc import multiproc
+    from legacypipe.ps1cat import set_healpix_cache_size
+    # (before starting the worker processes, so that they inherit it)
+    set_healpix_cache_size(measureargs.pop('healpix_cache_size') * 1e6)
     threads = measureargs.pop('threads')
     mp = multiproc(nthreads=(threads or 1))
 
@@ -746,10 +831,14 @@ def main(args=None):
 
     version_header = None
     check_photom = measureargs.pop('check_photom')
+    prefetch = measureargs.pop('prefetch')
 
     for ii, imgfn in enumerate(image_list):
         print('Working on image {}/{}: {}'.format(ii+1, nimage, imgfn))
 
+        if prefetch and ii+1 < nimage:
+            prefetch_image_files(survey, camera, image_list[ii+1])
+
         # Check if the outputs are done and have the correct data model.
         F = outputFns(imgfn, outdir, camera, image_dir=survey.get_image_dir(),
                       debug=measureargs['debug'])
@@ -846,7 +935,8 @@ def main(args=None):
     tnow = Time()
     print("TIMING:total %s" % (tnow-tbegin,))
 
-def run_zeropoints(imobj, splinesky=False, sdss_photom=False):
+def run_zeropoints(imobj, splinesky=False, sdss_photom=False,
+                   batch_starfit=False):
     """Computes photometric and astrometric zeropoints for one CCD.
 
     Args:
@@ -1196,7 +1286,8 @@ def run_zeropoints(imobj, splinesky=False, sdss_photom=False):
 
     # Run tractor fitting on the ref stars, using the PsfEx model.
     phot = tractor_fit_sources(imobj, wcs, refs.ra_now, refs.dec_now, refs.flux0,
-                               fit_img, ierr, psf, x0, y0)
+                               fit_img, ierr, psf, x0, y0,
+                               batched=batch_starfit)
     print('Got photometry results for', len(phot), 'reference stars')
     if len(phot) == 0:
         return None, None
@@ -1375,7 +1466,10 @@ def run_zeropoints(imobj, splinesky=False, sdss_photom=False):
     return ccds, phot
 
 def tractor_fit_sources(imobj, wcs, ref_ra, ref_dec, ref_flux, img, ierr,
-                        psf, ccd_x0, ccd_y0, normalize_psf=True):
+                        psf, ccd_x0, ccd_y0, normalize_psf=True, batched=False):
+    if batched:
+        return batch_fit_sources(wcs, ref_ra, ref_dec, ref_flux, img, ierr,
+                                 psf, ccd_x0, ccd_y0, normalize_psf=normalize_psf)
     import tractor
     from tractor import PixelizedPSF
     from tractor.brightness import LinearPhotoCal
@@ -1537,5 +1631,33 @@ def tractor_fit_sources(imobj, wcs, ref_ra, ref_dec, ref_flux, img, ierr,
     cal.ra_fit,cal.dec_fit = wcs.pixelxy2radec(cal.x_fit + 1, cal.y_fit + 1)
     return cal
 
+def batch_fit_sources(wcs, ref_ra, ref_dec, ref_flux, img, ierr,
+                      psf, ccd_x0, ccd_y0, normalize_psf=True):
+    '''
+    Same as tractor_fit_sources, but fits all the stars at once (see
+    starfit.py) rather than with a Tractor object per star.
+    '''
+    from legacyzpts.starfit import fit_stars
+
+    print('Fitting positions & fluxes of %i stars' % len(ref_ra))
+    _,x,y = wcs.radec2pixelxy(ref_ra, ref_dec)
+    # Fit results, with zero-indexed coords.
+    R = fit_stars(img, ierr, psf, x - 1, y - 1, ref_flux,
+                  normalize_psf=normalize_psf)
+    if R['nzeroivar'] > 0:
+        print('Zero ivar for %d stars' % R['nzeroivar'])
+    if R['noffim'] > 0:
+        print('Off image for %d stars' % R['noffim'])
+    cal = fits_table()
+    # These x_ref,y_ref,x_fit,y_fit are zero-indexed coords.
+    cal.x_ref = ccd_x0 + R['x_ref']
+    cal.y_ref = ccd_y0 + R['y_ref']
+    cal.x_fit = ccd_x0 + R['x_fit']
+    cal.y_fit = ccd_y0 + R['y_fit']
+    for k in ['flux', 'dx', 'dy', 'dflux', 'psfsum', 'iref', 'chi2', 'fracmasked']:
+        cal.set(k, R[k])
+    cal.ra_fit,cal.dec_fit = wcs.pixelxy2radec(cal.x_fit + 1, cal.y_fit + 1)
+    return cal
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,216 @@
+'''
+A vectorized fitter for the positions and fluxes of the calibration
+(Gaia / PS1) stars on a CCD, used by legacy_zeropoints.py.
+
+Rather than building a tractor Image, PointSource and Tractor object for
+each star and optimizing them one at a time, all the postage stamps for
+a CCD are stacked into one (N x S x S) array, the PSF model stamps into
+another, and the fit is done for all stars at once:
+
+- a linear (weighted least-squares) fit for the flux at the reference
+  position, then
+- a few Gauss-Newton steps in (x, y, flux).
+
+Point sources are rendered by shifting the pixelized PSF by its
+sub-pixel offset with a (normalized) Lanczos-3 kernel, as tractor's
+PixelizedPSF does, and the reported uncertainties are, as in tractor's
+optimizer, from the diagonal of the Fisher information.
+'''
+import numpy as np
+
+def lanczos3_weights(f):
+    '''
+    Returns the (N x 7) normalized Lanczos-3 weights for shifting by
+    the fractional pixel offsets *f* (taps at -3..3).
+    '''
+    d = np.arange(-3, 4)[np.newaxis,:] - np.atleast_1d(f)[:,np.newaxis]
+    L = np.sinc(d) * np.sinc(d / 3.)
+    L[np.abs(d) >= 3] = 0.
+    return L / np.sum(L, axis=1)[:,np.newaxis]
+
+def render_point_sources(psfs, x, y, size):
+    '''
+    Renders unit-flux point sources.
+
+    *psfs*: (N x P x P) PSF images, centered on pixel (P//2, P//2).
+    *x*, *y*: (N) source positions, in stamp pixel coordinates.
+    *size*: output stamp size.
+
+    Returns (N x size x size) model images.
+    '''
+    n,ph,pw = psfs.shape
+    ix = np.floor(x).astype(int)
+    iy = np.floor(y).astype(int)
+    wx = lanczos3_weights(x - ix)
+    wy = lanczos3_weights(y - iy)
+    # Sub-pixel shift, separably: out[b] = sum_d w[d] psf[b - d]
+    pad = 3
+    P = np.zeros((n, ph + 2*pad, pw + 2*pad), np.float64)
+    P[:, pad:-pad, pad:-pad] = psfs
+    S = np.zeros((n, ph + 2*pad, pw), np.float64)
+    for k,d in enumerate(range(-3, 4)):
+        S += wx[:,k,np.newaxis,np.newaxis] * P[:, :, pad-d : pad-d+pw]
+    P = np.zeros((n, ph, pw), np.float64)
+    for k,d in enumerate(range(-3, 4)):
+        P += wy[:,k,np.newaxis,np.newaxis] * S[:, pad-d : pad-d+ph, :]
+    # Integer shift: stamp pixel i holds psf pixel i - ix + pw//2.
+    i = np.arange(size)
+    xi = i[np.newaxis,:] - ix[:,np.newaxis] + pw//2
+    yi = i[np.newaxis,:] - iy[:,np.newaxis] + ph//2
+    okx = (xi >= 0) * (xi < pw)
+    oky = (yi >= 0) * (yi < ph)
+    xi = np.clip(xi, 0, pw-1)
+    yi = np.clip(yi, 0, ph-1)
+    N = np.arange(n)[:,np.newaxis,np.newaxis]
+    mod = P[N, yi[:,:,np.newaxis], xi[:,np.newaxis,:]]
+    mod *= (oky[:,:,np.newaxis] * okx[:,np.newaxis,:])
+    return mod
+
+def fit_point_sources(imgs, ies, psfs, x, y, niter=50, step=1e-3,
+                      max_shift=1.):
+    '''
+    Fits the positions and fluxes of point sources in a stack of
+    postage stamps.
+
+    *imgs*, *ies*: (N x S x S) image and inverse-error stamps.
+    *psfs*: (N x P x P) PSF images.
+    *x*, *y*: (N) initial positions, in stamp pixel coordinates.
+
+    Returns (x, y, flux, var, mod), where *var* is the (N x 3) variance
+    of (x, y, flux) -- zero where it is undefined -- and *mod* the
+    (N x S x S) best-fit models.
+    '''
+    size = imgs.shape[1]
+    w = ies.astype(np.float64)**2
+    imgs = imgs.astype(np.float64)
+    x = np.array(x, np.float64)
+    y = np.array(y, np.float64)
+
+    def linear_flux(m):
+        num = np.sum(w * m * imgs, axis=(1,2))
+        den = np.sum(w * m * m, axis=(1,2))
+        return np.where(den > 0, num / np.where(den > 0, den, 1.), 0.)
+
+    def jacobian(psfs, x, y, flux):
+        m = render_point_sources(psfs, x, y, size)
+        dmx = (render_point_sources(psfs, x + step, y, size) -
+               render_point_sources(psfs, x - step, y, size)) / (2.*step)
+        dmy = (render_point_sources(psfs, x, y + step, size) -
+               render_point_sources(psfs, x, y - step, size)) / (2.*step)
+        J = np.stack([flux[:,np.newaxis,np.newaxis] * dmx,
+                      flux[:,np.newaxis,np.newaxis] * dmy,
+                      m], axis=-1)
+        return m, J
+
+    # Flux at the initial position.
+    flux = linear_flux(render_point_sources(psfs, x, y, size))
+
+    # Gauss-Newton steps in (x, y, flux), for the stars that have not
+    # converged yet.
+    active = np.ones(len(x), bool)
+    for _ in range(niter):
+        I = np.flatnonzero(active)
+        if len(I) == 0:
+            break
+        m,J = jacobian(psfs[I], x[I], y[I], flux[I])
+        r = imgs[I] - flux[I,np.newaxis,np.newaxis] * m
+        wI = w[I][..., np.newaxis]
+        # Normal equations, (n x 3 x 3) and (n x 3)
+        A = np.einsum('nyxi,nyxj->nij', J * wI, J)
+        b = np.einsum('nyxi,nyx->ni', J * wI, r)
+        # Singular systems (eg, zero flux, so that the position
+        # derivatives vanish) take no step and stop.
+        ok = np.abs(np.linalg.det(A)) > 0
+        delta = np.zeros((len(I), 3))
+        if np.any(ok):
+            delta[ok] = np.linalg.solve(A[ok], b[ok][..., np.newaxis])[..., 0]
+        # Limit the position step
+        shift = np.hypot(delta[:,0], delta[:,1])
+        scale = np.minimum(1., max_shift / np.maximum(shift, 1e-12))
+        delta[:,:2] *= scale[:,np.newaxis]
+        x[I] += delta[:,0]
+        y[I] += delta[:,1]
+        flux[I] += delta[:,2]
+        active[I] = ok * ((shift > 1e-4) |
+                          (np.abs(delta[:,2]) > 1e-6 * np.maximum(np.abs(flux[I]), 1.)))
+
+    m,J = jacobian(psfs, x, y, flux)
+    fisher = np.sum(J**2 * w[..., np.newaxis], axis=(1,2))
+    var = np.zeros_like(fisher)
+    pos = fisher > 0
+    var[pos] = 1. / fisher[pos]
+    return x, y, flux, var, flux[:,np.newaxis,np.newaxis] * m
+
+def fit_stars(img, ierr, psf, x, y, flux0, R=10, normalize_psf=True):
+    '''
+    Fits the stars at (zero-indexed) pixel positions *x*, *y* in image
+    *img* (with inverse-error *ierr*), using *psf* (a tractor PSF with
+    *getImage(x, y)*), in (2R+1)-pixel square postage stamps.
+
+    Returns a dict of arrays for the fit stars: *iref* (index into the
+    inputs), *x_ref*, *y_ref*, *x_fit*, *y_fit*, *flux*, *dx*, *dy*,
+    *dflux*, *psfsum*, *chi2* and *fracmasked*; plus the counts
+    *noffim* and *nzeroivar* of skipped stars.
+    '''
+    H,W = img.shape
+    x = np.atleast_1d(np.asarray(x, np.float64))
+    y = np.atleast_1d(np.asarray(y, np.float64))
+    # (int() truncates toward zero)
+    xlo = np.trunc(x - R).astype(int)
+    ylo = np.trunc(y - R).astype(int)
+    onim = ((xlo >= 0) * (ylo >= 0) * (xlo + 2*R < W) * (ylo + 2*R < H))
+    noffim = int(np.sum(~onim))
+    I = np.flatnonzero(onim)
+
+    size = 2*R + 1
+    d = np.arange(size)
+    yy = ylo[I,np.newaxis,np.newaxis] + d[np.newaxis,:,np.newaxis]
+    xx = xlo[I,np.newaxis,np.newaxis] + d[np.newaxis,np.newaxis,:]
+    subimg = img[yy, xx]
+    subie = ierr[yy, xx]
+    nonzero = np.any(subie != 0, axis=(1,2))
+    nzeroivar = int(np.sum(~nonzero))
+    I = I[nonzero]
+    subimg = subimg[nonzero]
+    subie = subie[nonzero]
+
+    sz = R + 5
+    psfs = np.zeros((len(I), 2*sz+1, 2*sz+1))
+    psfsum = np.zeros(len(I))
+    # The PSF model is evaluated through its own getImage, once per star,
+    # as the tractor path does: camera subclasses override it (eg,
+    # NormalizedPixelizedPsfEx renormalizes), so it cannot be replaced by
+    # one batched evaluation of the PsfEx bases without duplicating them.
+    for j,i in enumerate(I):
+        psfimg = psf.getImage(x[i], y[i])
+        ph,pw = psfimg.shape
+        psfsum[j] = np.sum(psfimg)
+        if normalize_psf:
+            psfimg = psfimg / psfsum[j]
+        psfs[j] = psfimg[ph//2-sz:ph//2+sz+1, pw//2-sz:pw//2+sz+1]
+
+    x_init = x[I] - xlo[I]
+    y_init = y[I] - ylo[I]
+    xf,yf,flux,var,mod = fit_point_sources(subimg, subie, psfs, x_init, y_init)
+
+    modsum = np.sum(mod, axis=(1,2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        psfimg = mod / modsum[:,np.newaxis,np.newaxis]
+    chi = (subimg - mod) * subie
+    # profile-weighted chi-squared
+    chi2 = np.sum(chi**2 * psfimg, axis=(1,2))
+    # profile-weighted fraction of masked pixels
+    fracmasked = np.sum(psfimg * (subie == 0), axis=(1,2))
+    std = np.sqrt(var)
+
+    return dict(iref=I,
+                x_ref=x_init + xlo[I],
+                y_ref=y_init + ylo[I],
+                x_fit=xf + xlo[I],
+                y_fit=yf + ylo[I],
+                flux=flux,
+                dx=std[:,0], dy=std[:,1], dflux=std[:,2],
+                psfsum=psfsum,
+                chi2=chi2,
+                fracmasked=fracmasked,
+                noffim=noffim, nzeroivar=nzeroivar)
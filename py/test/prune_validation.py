@@ -0,0 +1,177 @@
+'''
+Validation harness for runbrick --prune-models: runs the py/test test
+cases with and without model pruning, and measures the differences
+between the resulting catalogs (sources, types, fluxes) along with the
+number of pruned model fits and the model-fitting CPU time saved.
+
+Run from the py/ directory, eg,
+
+    python test/prune_validation.py --prune 3
+
+Returns non-zero if more than --max-type-frac of the matched sources
+changed type, or any flux changed by more than --max-flux-sigma.
+'''
+if __name__ == '__main__':
+    import matplotlib
+    matplotlib.use('Agg')
+import os
+import sys
+import glob
+import tempfile
+import numpy as np
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+
+def gaia_env(surveydir, **kwargs):
+    env = dict(GAIA_CAT_DIR=os.path.join(surveydir, 'gaia'), GAIA_CAT_VER='2')
+    env.update(kwargs)
+    return env
+
+def get_testcases():
+    '''
+    Returns a list of (name, runbrick arguments, environment) for the
+    test cases, taken from runbrick_test.py.
+    '''
+    cases = []
+    d = os.path.join(testdir, 'testcase6')
+    cases.append(('testcase6', ['--brick', '1102p240', '--zoom', '500', '600', '650', '750',
+                                '--skip-calibs', '--survey-dir', d], gaia_env(d)))
+    d = os.path.join(testdir, 'testcase7')
+    cases.append(('testcase7', ['--brick', '1102p240', '--zoom', '250', '350', '1550', '1650',
+                                '--survey-dir', d], gaia_env(d)))
+    d = os.path.join(testdir, 'testcase8')
+    cases.append(('testcase8', ['--brick', '1209p050', '--zoom', '720', '1095', '3220', '3500',
+                                '--survey-dir', d], gaia_env(d)))
+    d = os.path.join(testdir, 'testcase9')
+    cases.append(('testcase9', ['--radec', '9.1228', '3.3975', '--width', '100',
+                                '--height', '100', '--old-calibs-ok', '--survey-dir', d],
+                  gaia_env(d, LARGEGALAXIES_CAT=os.path.join(d, 'sga-sub.kd.fits'))))
+    d = os.path.join(testdir, 'mzlsbass2')
+    cases.append(('mzlsbass2', ['--brick', '1773p595', '--zoom', '1300', '1500', '700', '900',
+                                '--survey-dir', d], gaia_env(d)))
+    return cases
+
+def run_case(args, env, outdir, prune, threads):
+    from legacypipe.runbrick import main
+    oldenv = dict([(k, os.environ.get(k)) for k in env.keys()])
+    os.environ.update(env)
+    args = args + ['--force-all', '--no-wise', '--skip-coadd', '--outdir', outdir]
+    if prune:
+        args += ['--prune-models', str(prune)]
+    if threads:
+        args += ['--threads', str(threads)]
+    try:
+        r = main(args=args)
+    finally:
+        for k,v in oldenv.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+    return r
+
+def read_outputs(outdir):
+    from astrometry.util.fits import fits_table
+    fns = glob.glob(os.path.join(outdir, 'tractor', '*', 'tractor-*.fits'))
+    assert(len(fns) == 1)
+    T = fits_table(fns[0])
+    M = None
+    fns = glob.glob(os.path.join(outdir, 'metrics', '*', 'all-models-*.fits'))
+    if len(fns):
+        M = fits_table(fns[0])
+    return T,M
+
+def model_cpu(M):
+    from legacypipe.oneblob import MODEL_NAMES
+    if M is None:
+        return 0.
+    return sum([np.sum(M.get('%s_cpu' % m)) for m in MODEL_NAMES
+                if ('%s_cpu' % m) in M.get_columns()])
+
+def compare_catalogs(T1, M1, T2, M2, match_radius=0.1):
+    '''
+    Compares catalog *T2* (with pruning) against *T1* (without), and
+    their all-models tables *M1*, *M2*.  Returns a dict of statistics.
+    '''
+    from astrometry.libkd.spherematch import match_radec
+    from legacypipe.oneblob import MODEL_NAMES
+    I,J,_ = match_radec(T1.ra, T1.dec, T2.ra, T2.dec, match_radius/3600.,
+                        nearest=True)
+    type1 = np.array([t.strip() for t in T1.type[I]])
+    type2 = np.array([t.strip() for t in T2.type[J]])
+    changed = [(a,b) for a,b in zip(type1, type2) if a != b]
+    # Flux differences in units of the (unpruned) flux errors
+    dflux = []
+    for col in T1.get_columns():
+        if not col.startswith('flux_') or col.startswith('flux_ivar_'):
+            continue
+        iv = T1.get('flux_ivar_' + col[5:])[I]
+        ok = (iv > 0)
+        dflux.append(np.abs(T2.get(col)[J] - T1.get(col)[I])[ok] * np.sqrt(iv[ok]))
+    dflux = np.hstack(dflux + [np.zeros(0)])
+    npruned = dict([(m, 0) for m in MODEL_NAMES])
+    if M2 is not None and 'dchisq_pruned' in M2.get_columns():
+        for i,m in enumerate(MODEL_NAMES):
+            npruned[m] = int(np.sum((M2.dchisq_pruned & (1 << i)) > 0))
+    return dict(n1=len(T1), n2=len(T2), nmatched=len(I),
+                type_changes=changed,
+                type_frac=len(changed) / max(len(I), 1),
+                dflux_max=float(np.max(dflux)) if len(dflux) else 0.,
+                dflux_median=float(np.median(dflux)) if len(dflux) else 0.,
+                npruned=npruned,
+                cpu1=model_cpu(M1), cpu2=model_cpu(M2))
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Measure the catalog differences caused by runbrick --prune-models on the test cases.')
+    parser.add_argument('--prune', type=int, default=3,
+                        help='Number of optimizer steps before pruning (runbrick --prune-models)')
+    parser.add_argument('--outdir', default=None,
+                        help='Directory for the runbrick outputs (default: a temporary directory)')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--case', action='append', default=None,
+                        help='Run only this test case (may be repeated)')
+    parser.add_argument('--max-type-frac', type=float, default=0.,
+                        help='Fail if more than this fraction of sources change type')
+    parser.add_argument('--max-flux-sigma', type=float, default=0.1,
+                        help='Fail if any flux changes by more than this many sigma')
+    opt = parser.parse_args(args=args)
+
+    tempdir = None
+    outdir = opt.outdir
+    if outdir is None:
+        tempdir = tempfile.TemporaryDirectory()
+        outdir = tempdir.name
+
+    ok = True
+    totals = [0., 0.]
+    for name,cargs,env in get_testcases():
+        if opt.case and not name in opt.case:
+            continue
+        base = os.path.join(outdir, name + '-base')
+        pruned = os.path.join(outdir, name + '-prune')
+        run_case(cargs, env, base, 0, opt.threads)
+        run_case(cargs, env, pruned, opt.prune, opt.threads)
+        T1,M1 = read_outputs(base)
+        T2,M2 = read_outputs(pruned)
+        S = compare_catalogs(T1, M1, T2, M2)
+        totals[0] += S['cpu1']
+        totals[1] += S['cpu2']
+        print('%-10s: %i vs %i sources (%i matched); %i type changes; flux diff median %.3g, max %.3g sigma; pruned %s; model CPU %.1f -> %.1f s' %
+              (name, S['n1'], S['n2'], S['nmatched'], len(S['type_changes']),
+               S['dflux_median'], S['dflux_max'],
+               ', '.join(['%s %i' % kv for kv in S['npruned'].items() if kv[1]]) or 'none',
+               S['cpu1'], S['cpu2']))
+        for a,b in S['type_changes']:
+            print('    type changed:', a, '->', b)
+        if (S['n1'] != S['n2'] or S['type_frac'] > opt.max_type_frac or
+            S['dflux_max'] > opt.max_flux_sigma):
+            ok = False
+    print('Total model-fitting CPU: %.1f s without pruning, %.1f s with' % tuple(totals))
+    if tempdir is not None:
+        tempdir.cleanup()
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,6 +17,21 @@ def set_env():
             del os.environ[v]
 
 
+def assert_same_catalogs(fn1, fn2):
+    '''
+    Asserts that tractor catalogs *fn1* and *fn2* are identical.
+    '''
+    T1 = fits_table(fn1)
+    T2 = fits_table(fn2)
+    assert(len(T1) == len(T2))
+    assert(T1.get_columns() == T2.get_columns())
+    for c in T1.get_columns():
+        a,b = T1.get(c), T2.get(c)
+        if a.dtype.kind == 'f':
+            assert(np.array_equal(a, b, equal_nan=True))
+        else:
+            assert(np.all(a == b))
+
 def rbmain():
     from legacypipe.catalog import read_fits_catalog
     from legacypipe.survey import LegacySurveyData, wcs_for_brick
@@ -606,6 +621,35 @@ def rbmain():
                '--checkpoint', checkpoint_fn,
                '--checkpoint-period', '1' ])
 
+    # Fitting each source's models in threads (--model-threads) gives
+    # the same catalog as fitting them serially.
+    for mt,od in [(3, 'out-testcase3-mt'), (None, 'out-testcase3-serial')]:
+        main(args=['--brick', '2447p120', '--zoom', '1020', '1070', '2775', '2815',
+                   '--no-wise', '--force-all', '--no-write', '--skip-coadd',
+                   '--survey-dir', surveydir,
+                   '--outdir', od, '--threads', '2'] +
+             (['--model-threads', str(mt)] if mt else []))
+    assert_same_catalogs(
+        os.path.join('out-testcase3-serial', 'tractor', '244', 'tractor-2447p120.fits'),
+        os.path.join('out-testcase3-mt', 'tractor', '244', 'tractor-2447p120.fits'))
+
+    # --crop-detmaps is opt-in.  The default catalog is the one checked
+    # against the reference types and positions above; with the option,
+    # the same sources are found, with the same types.
+    main(args=['--brick', '2447p120', '--zoom', '1020', '1070', '2775', '2815',
+               '--no-wise', '--force-all', '--no-write', '--skip-coadd',
+               '--survey-dir', surveydir,
+               '--outdir', 'out-testcase3-cropdet', '--crop-detmaps'])
+    T1 = fits_table(os.path.join('out-testcase3-serial', 'tractor', '244', 'tractor-2447p120.fits'))
+    T2 = fits_table(os.path.join('out-testcase3-cropdet', 'tractor', '244', 'tractor-2447p120.fits'))
+    cat1 = read_fits_catalog(T1)
+    assert(len(cat1) == 2)
+    assert(type(cat1[0]) == PointSource)
+    assert(np.abs(cat1[0].pos.ra  - 244.77828) < 0.00001)
+    assert(np.abs(cat1[0].pos.dec -  12.07250) < 0.00001)
+    assert(len(T2) == len(T1))
+    assert(np.all(T2.type == T1.type))
+
     # From Kaylan's Bootes pre-DR4 run
     # surveydir2 = os.path.join(os.path.dirname(__file__), 'mzlsbass3')
     # main(args=['--brick', '2173p350', '--zoom', '100', '200', '100', '200',
@@ -103,6 +103,633 @@ class TestOneblob(unittest.TestCase):
         mod = _select_model(chisqs, nparams, galaxy_margin)
         self.assertTrue(mod == 'dev')
 
+    def test_selection_threshold(self):
+        from legacypipe.oneblob import _select_model, _selection_threshold
+
+        nparams = dict(psf=2, rex=3, exp=5, dev=5, ser=6)
+        galaxy_margin = 3.**2 + (nparams['exp'] - nparams['psf'])
+
+        for chisqs,name in [(dict(none=0, psf=500, rex=505), 'exp'),
+                            (dict(none=0, psf=10, rex=11), 'dev'),
+                            (dict(none=0, psf=5000, rex=5005), 'exp'),
+                            (dict(none=0, psf=500, rex=505, exp=520, dev=510), 'ser')]:
+            t = _selection_threshold(name, chisqs, nparams, galaxy_margin)
+            c = chisqs.copy()
+            c[name] = t
+            self.assertEqual(_select_model(c, nparams, galaxy_margin), name)
+            c[name] = t - 0.1
+            self.assertNotEqual(_select_model(c, nparams, galaxy_margin), name)
+        # faint: galaxy model must also pass the detection threshold
+        t = _selection_threshold('dev', dict(none=0, psf=10, rex=11),
+                                 nparams, galaxy_margin)
+        self.assertTrue(abs(t - 30.) < 0.1)
+
+class TestLRUCache(unittest.TestCase):
+    def test_evict(self):
+        import numpy as np
+        from legacypipe.utils import LRUCache
+
+        cache = LRUCache(maxitems=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertTrue(cache.get('a') == 1)
+        cache.put('c', 3)
+        # 'b' was the least-recently used
+        self.assertTrue('b' not in cache)
+        self.assertTrue('a' in cache and 'c' in cache)
+
+        cache = LRUCache(maxsize=90)
+        cache.put('a', np.zeros(10))
+        cache.put('b', np.zeros(2))
+        self.assertTrue('a' not in cache)
+        self.assertTrue(cache.size == 16)
+        # an entry larger than the limit is still kept
+        cache.put('c', np.zeros(20))
+        self.assertTrue(list(cache.items.keys()) == ['c'])
+
+class TestSharedTims(unittest.TestCase):
+    def test_cutouts(self):
+        import pickle
+        import numpy as np
+        from legacypipe.shared_tims import SharedTimArena, resolve_timargs
+
+        class FakeTim(object):
+            def __init__(self, img, inverr, dq):
+                self.img = img
+                self.inverr = inverr
+                self.dq = dq
+            def getImage(self):
+                return self.img
+            def getInvError(self):
+                return self.inverr
+
+        img = np.arange(200, dtype=np.float32).reshape(10,20)
+        tims = [FakeTim(img, img + 1000, np.ones(img.shape, np.int16)),
+                FakeTim(img * 2, img, None)]
+        slc = slice(2,5), slice(3,9)
+        with SharedTimArena(tims) as arena:
+            timargs = [tuple(arena.cutouts(tim, slc)) for tim in tims]
+            # descriptors must survive pickling to worker processes
+            timargs = pickle.loads(pickle.dumps(timargs))
+            (img0, ie0, dq0), (img1, ie1, dq1) = resolve_timargs(timargs)
+        self.assertTrue(np.all(img0 == img[slc]))
+        self.assertTrue(np.all(ie0 == img[slc] + 1000))
+        self.assertTrue(np.all(dq0 == 1))
+        self.assertTrue(dq0.dtype == np.int16)
+        self.assertTrue(np.all(img1 == 2 * img[slc]))
+        self.assertTrue(dq1 is None)
+
+class TestResampling(unittest.TestCase):
+    def test_descriptor(self):
+        import os
+        import pickle
+        import tempfile
+        import numpy as np
+        from legacypipe.resampling import TimResampling
+
+        n,nrev = 7,5
+        yx = np.arange(4*n, dtype=np.int16).reshape(4,n)
+        dxy = np.linspace(-0.5, 0.5, 2*n).astype(np.float32).reshape(2,n)
+        rev = -np.arange(4*nrev, dtype=np.int16).reshape(4,nrev)
+        with tempfile.TemporaryDirectory() as tempdir:
+            fn = os.path.join(tempdir, 'resamp.dat')
+            with open(fn, 'wb') as f:
+                # (non-overlapping entries take no space in the file)
+                for a in [yx, dxy, rev]:
+                    f.write(a.tobytes())
+            empty = TimResampling(fn, 0, 0, 0, 'key')
+            R = TimResampling(fn, 0, n, nrev, 'key')
+            R = pickle.loads(pickle.dumps(R))
+            self.assertTrue(empty.nearest() is None)
+            self.assertTrue(empty.reverse() is None)
+            Yo,Xo,Yi,Xi = R.nearest()
+            self.assertTrue(np.all(Yo == yx[0]))
+            self.assertTrue(np.all(Xi == yx[3]))
+            self.assertTrue(Xi.dtype == np.int16)
+            self.assertTrue(np.all(R.reverse()[2] == rev[2]))
+            self.assertTrue(np.all(R._arrays()[1] == dxy))
+            self.assertTrue(R._arrays()[1].dtype == np.float32)
+            R._mm = None
+        # cache file gone
+        self.assertTrue(R._arrays() is None)
+
+    def test_digest(self):
+        import os
+        import tempfile
+        import numpy as np
+        from legacypipe.resampling import (TimResampling, DIGEST_LEN,
+                                           _read_cache_index)
+
+        n = 4
+        yx = np.arange(4*n, dtype=np.int16).reshape(4,n)
+        dxy = np.zeros((2,n), np.float32)
+        digest = 'a' * DIGEST_LEN
+        sizes = np.array([[n, 0], [0, 0]], np.int64)
+        with tempfile.TemporaryDirectory() as tempdir:
+            fn = os.path.join(tempdir, 'resamp.dat')
+            with open(fn, 'wb') as f:
+                f.write(digest.encode('ascii'))
+                f.write(np.array([2], np.int64).tobytes())
+                f.write(sizes.tobytes())
+                f.write(yx.tobytes())
+                f.write(dxy.tobytes())
+            hdrsize = DIGEST_LEN + 8 * 5
+            self.assertTrue(np.all(_read_cache_index(fn, digest, 2) == sizes))
+            # different tims or WCS
+            self.assertTrue(_read_cache_index(fn, 'b' * DIGEST_LEN, 2) is None)
+            self.assertTrue(_read_cache_index(fn, digest, 3) is None)
+            R = TimResampling(fn, hdrsize, n, 0, 'key', digest=digest)
+            self.assertTrue(np.all(R.nearest()[1] == yx[1]))
+            R = TimResampling(fn, hdrsize, n, 0, 'key', digest='b' * DIGEST_LEN)
+            self.assertTrue(R._arrays() is None)
+
+    def test_outlier_stack(self):
+        import os
+        import pickle
+        import tempfile
+        import numpy as np
+        from legacypipe.resampling import TimResampling
+        from legacypipe.outliers import ResampledStack
+
+        rng = np.random.RandomState(1)
+        with tempfile.TemporaryDirectory() as tempdir:
+            # a resampling cache holding the pixel mappings
+            fn = os.path.join(tempdir, 'resamp.dat')
+            resamps = []
+            offset = 0
+            with open(fn, 'wb') as f:
+                for n in [5, 3]:
+                    yx = rng.randint(0, 100, size=(4,n)).astype(np.int16)
+                    f.write(yx.tobytes())
+                    f.write(np.zeros((2,n), np.float32).tobytes())
+                    resamps.append(TimResampling(fn, offset, n, 0, 'key'))
+                    offset += TimResampling.nbytes(n, 0)
+            stack = ResampledStack(tempdir)
+            ins = []
+            descs = []
+            for R in resamps:
+                iw = (rng.normal(size=R.n).astype(np.float32),
+                      rng.uniform(size=R.n).astype(np.float32))
+                ins.append(R.nearest() + iw)
+                descs.append(stack.append(R, *iw))
+            descs.append(stack.append(None))
+            stack.close()
+            descs = pickle.loads(pickle.dumps(descs))
+            for R,d in zip(ins, descs):
+                out = d.read()
+                self.assertEqual(len(out), 6)
+                for a,b in zip(R, out):
+                    self.assertTrue(a.dtype == b.dtype)
+                    self.assertTrue(np.all(a == b))
+            self.assertEqual(descs[-1].n, 0)
+            stack.remove()
+            # stack file gone
+            self.assertTrue(descs[0].read() is None)
+
+class TestBlobCost(unittest.TestCase):
+    def test_fit(self):
+        import numpy as np
+        from legacypipe.blobcost import BlobCostModel
+
+        rng = np.random.RandomState(42)
+        n = 500
+        nsrcs = rng.randint(1, 100, size=n)
+        npix = rng.randint(100, 100000, size=n)
+        nimages = rng.randint(1, 50, size=n)
+        has_ref = rng.uniform(size=n) < 0.3
+        has_largegal = rng.uniform(size=n) < 0.05
+        truth = BlobCostModel([-4., 1.2, 0.4, 0.6, 0.3, 2.0])
+        cpu = truth.predict(nsrcs, npix, nimages, has_ref, has_largegal)
+        model = BlobCostModel.fit(nsrcs, npix, nimages, has_ref, has_largegal, cpu)
+        self.assertTrue(np.allclose(model.coeffs, truth.coeffs, atol=1e-6))
+        # more sources and more pixels cost more
+        c = model.predict([1, 10, 10], [100, 100, 1000], 10)
+        self.assertTrue(c[0] < c[1] < c[2])
+
+    def test_features(self):
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.blobcost import blob_features, catalog_blob_table
+
+        # per-source blob numbers and reference catalogs
+        blob = np.array([0, 0, 1, 2, 2, 2, -1])
+        ref_cat = np.array(['  ', 'G2', 'L3', '  ', 'T2', '  ', 'G2'])
+        npix = np.array([100, 200, 300])
+        nimages = np.array([3, 4, 5])
+        nsrcs,_,_,has_ref,has_largegal = blob_features(blob, ref_cat, npix, nimages)
+        self.assertTrue(np.all(nsrcs == [2, 1, 3]))
+        self.assertTrue(np.all(has_ref == [True, True, True]))
+        self.assertTrue(np.all(has_largegal == [False, True, False]))
+
+        # the same features from a tractor catalog (training)
+        T = fits_table()
+        T.blob = blob
+        T.ref_cat = ref_cat
+        T.blob_npix = np.append(npix[blob[:-1]], 0)
+        T.blob_nimages = np.append(nimages[blob[:-1]], 0)
+        T.cpu_blob = np.ones(len(blob), np.float32)
+        R = catalog_blob_table(T)
+        F = blob_features(blob, ref_cat, npix, nimages)
+        for a,b in zip(R[:-1], F):
+            self.assertTrue(np.all(a == b))
+
+    def test_extents(self):
+        import numpy as np
+        from legacypipe.blobcost import tim_blob_extents
+
+        # simple linear WCSes: brick pixel = 10 * RA,Dec; tim pixel =
+        # brick pixel + offset
+        class BrickWcs(object):
+            def pixelxy2radec(self, x, y):
+                return np.asarray(x) / 10., np.asarray(y) / 10.
+        class TimWcs(object):
+            def __init__(self, dx, dy):
+                self.dx, self.dy = dx, dy
+            def radec2pixelxy(self, r, d):
+                r = np.asarray(r)
+                return (np.ones(r.shape, bool), 10. * r + self.dx,
+                        10. * np.asarray(d) + self.dy)
+        class Tim(object):
+            def __init__(self, dx, dy):
+                self.shape = (100, 200)
+                self.subwcs = TimWcs(dx, dy)
+        tims = [Tim(0, 0), Tim(-150, 0), Tim(0, 50), Tim(-500, 0)]
+
+        bx0 = np.array([0, 10, 140, 300])
+        bx1 = np.array([20, 30, 160, 320])
+        by0 = np.array([0, 10, 60, 0])
+        by1 = np.array([5, 40, 80, 5])
+        ext,over = tim_blob_extents(tims, BrickWcs(), bx0, bx1, by0, by1)
+        self.assertEqual(ext.shape, (4, 4, 4))
+        # same as one blob at a time
+        for i in range(4):
+            e,o = tim_blob_extents(tims, BrickWcs(), bx0[i], bx1[i], by0[i], by1[i])
+            self.assertTrue(np.all(e[:,0] == ext[:,i]))
+            self.assertTrue(np.all(o[:,0] == over[:,i]))
+        self.assertTrue(np.allclose(ext[1,2], [-10, 10, 60, 80]))
+        self.assertTrue(np.all(over == [[True, True, True, False],
+                                        [False, False, True, True],
+                                        [True, True, False, False],
+                                        [False, False, False, False]]))
+        # no blobs
+        ext,over = tim_blob_extents(tims, BrickWcs(), [], [], [], [])
+        self.assertEqual(over.shape, (4, 0))
+
+class TestFarmCredit(unittest.TestCase):
+    def test_renewal_in_flight(self):
+        import time
+        from collections import OrderedDict
+        from legacypipe.farm import set_worker_credit
+        from legacypipe.worker import FeederCredit
+
+        # farm.py network_thread state
+        credits = OrderedDict()
+        nsent = {}
+        def deliver(ident, msg):
+            nreceived,room = [int(x) for x in msg.split(b':')]
+            set_worker_credit(credits, nsent, ident, nreceived, room)
+        def send():
+            ident = next(iter(credits))
+            nsent[ident] = nsent.get(ident, 0) + 1
+            credits[ident] -= 1
+            if credits[ident] == 0:
+                del credits[ident]
+            else:
+                credits.move_to_end(ident)
+            return ident
+
+        prefetch = 4
+        A = FeederCredit(prefetch)
+        deliver(b'A', A.report(0))
+        self.assertEqual(credits, {b'A': 4})
+        # Three packets go out, but have not arrived yet
+        for i in range(3):
+            send()
+        # A hears nothing for a long time, and renews its credit, repeatedly.
+        A.last_recv = A.last_report = time.time() - 1000
+        self.assertTrue(A.need_report(0))
+        for i in range(5):
+            deliver(b'A', A.report(0))
+            self.assertEqual(credits, {b'A': 1})
+        self.assertFalse(A.need_report(0))
+        # A second worker shows up; they take turns.
+        B = FeederCredit(prefetch)
+        deliver(b'B', B.report(0))
+        self.assertEqual([send() for i in range(3)], [b'A', b'B', b'B'])
+        # A receives its four packets, and finishes two of them.
+        for i in range(4):
+            A.received()
+        self.assertFalse(A.need_report(4))
+        self.assertTrue(A.need_report(2))
+        deliver(b'A', A.report(2))
+        self.assertEqual(credits[b'A'], 2)
+        # A server restart forgets everything; A's (absolute) report
+        # gives it only as much credit as it has room for.
+        credits.clear()
+        nsent.clear()
+        deliver(b'A', A.report(2))
+        self.assertEqual(credits, {b'A': 2})
+
+class TestCheckpointLog(unittest.TestCase):
+    def test_append_and_truncate(self):
+        import os
+        import pickle
+        import tempfile
+        from legacypipe.runbrick import CheckpointLog, _read_checkpoint
+
+        R = [dict(brickname='b', iblob=i, result=None) for i in range(3)]
+        with tempfile.TemporaryDirectory() as tempdir:
+            fn = os.path.join(tempdir, 'checkpoint.pickle')
+            ckpt = CheckpointLog(fn, R[:1])
+            ckpt.append(R[1])
+            ckpt.sync()
+            ckpt.append(R[2])
+            ckpt.close()
+            self.assertTrue(list(_read_checkpoint(fn)) == R)
+            # a partially-written final record is ignored
+            with open(fn, 'r+b') as f:
+                f.truncate(os.path.getsize(fn) - 3)
+            self.assertTrue(list(_read_checkpoint(fn)) == R[:2])
+            # old-style checkpoint: a pickled list
+            with open(fn, 'wb') as f:
+                pickle.dump(R, f)
+            self.assertTrue(list(_read_checkpoint(fn)) == R)
+
+class TestStageStore(unittest.TestCase):
+    def test_lazy(self):
+        import os
+        import tempfile
+        import numpy as np
+        from legacypipe.stagestore import (write_stage_store, read_stage_store,
+                                           read_stage_outputs)
+
+        img = np.arange(12, dtype=np.float32).reshape(3,4)
+        with tempfile.TemporaryDirectory() as tempdir:
+            d1 = os.path.join(tempdir, 'a.d')
+            write_stage_store(dict(img=img, name='b', lst=[1,2]), d1)
+            R = read_stage_outputs(os.path.join(tempdir, 'a.pickle'))
+            self.assertTrue(sorted(R.keys()) == ['img', 'lst', 'name'])
+            self.assertFalse(R.is_loaded('img'))
+            self.assertTrue(R['name'] == 'b')
+            R['lst'] = [3]
+            # unread keys are hard-linked into the next store
+            d2 = os.path.join(tempdir, 'b.d')
+            write_stage_store(R, d2)
+            self.assertFalse(R.is_loaded('img'))
+            self.assertTrue(os.path.samefile(os.path.join(d1, 'img.npy'),
+                                             os.path.join(d2, 'img.npy')))
+            R2 = read_stage_store(d2)
+            self.assertTrue(R2['lst'] == [3])
+            self.assertTrue(np.all(R2['img'] == img))
+            # memory-mapped copy-on-write: changes don't reach the file
+            R2['img'][0,0] = -1
+            self.assertTrue(read_stage_store(d1)['img'][0,0] == 0)
+        self.assertTrue(read_stage_outputs(os.path.join(tempdir, 'a.pickle')) is None)
+
+class TestStarFit(unittest.TestCase):
+    def test_fit(self):
+        import numpy as np
+        from legacyzpts.starfit import fit_point_sources, render_point_sources
+
+        r = np.arange(31) - 15
+        psf = np.exp(-0.5 * (r[:,np.newaxis]**2 + r[np.newaxis,:]**2) / 1.8**2)
+        psf /= psf.sum()
+        psfs = np.array([psf, psf])
+        x = np.array([10.3, 9.8])
+        y = np.array([9.6, 10.1])
+        flux = np.array([1000., 50.])
+        imgs = render_point_sources(psfs, x, y, 21) * flux[:,np.newaxis,np.newaxis]
+        self.assertTrue(np.allclose(imgs.sum(axis=(1,2)), flux, rtol=1e-3))
+        ies = np.ones_like(imgs)
+        # second star: masked pixels
+        ies[1, :5, :] = 0.
+        xf,yf,ff,var,mod = fit_point_sources(imgs, ies, psfs, x + 0.4, y - 0.3)
+        self.assertTrue(np.allclose(xf, x, atol=1e-4))
+        self.assertTrue(np.allclose(yf, y, atol=1e-4))
+        self.assertTrue(np.allclose(ff, flux, rtol=1e-5))
+        self.assertTrue(np.all(var > 0))
+        self.assertTrue(np.allclose(mod, imgs, atol=1e-6))
+
+    def test_singular(self):
+        import numpy as np
+        from legacyzpts.starfit import fit_point_sources, render_point_sources
+
+        r = np.arange(31) - 15
+        psf = np.exp(-0.5 * (r[:,np.newaxis]**2 + r[np.newaxis,:]**2) / 1.8**2)
+        psf /= psf.sum()
+        psfs = np.array([psf] * 4)
+        x = np.array([10.3, 10.0, 9.8, 10.2])
+        y = np.array([9.6, 10.0, 10.1, 9.9])
+        # stars 1 (blank image: zero flux) and 2 (fully masked) have
+        # singular normal equations
+        flux = np.array([1000., 0., 300., 50.])
+        imgs = render_point_sources(psfs, x, y, 21) * flux[:,np.newaxis,np.newaxis]
+        ies = np.ones_like(imgs)
+        ies[2] = 0.
+        xf,yf,ff,var,_ = fit_point_sources(imgs, ies, psfs, x + 0.4, y - 0.3)
+        good = np.array([0, 3])
+        self.assertTrue(np.allclose(xf[good], x[good], atol=1e-4))
+        self.assertTrue(np.allclose(ff[good], flux[good], rtol=1e-5))
+        self.assertTrue(np.all(var[good] > 0))
+        # the singular ones do not move
+        self.assertTrue(np.allclose(xf[1:3], x[1:3] + 0.4))
+        self.assertTrue(np.allclose(yf[1:3], y[1:3] - 0.3))
+        self.assertEqual(ff[1], 0.)
+        self.assertTrue(np.all(var[2] == 0))
+
+class TestHalos(unittest.TestCase):
+    def test_profile(self):
+        import numpy as np
+        from legacypipe.halos import decam_halo_profile, moffat
+
+        pixscale = 0.262
+        r0,dr,prof = decam_halo_profile('z', 'N4', pixscale, 500.,
+                                        inner_moffat=(0.8, 2.5), outer_weight=0.5)
+        self.assertTrue(prof[0] == 0.)
+        # past the inner apodization ramp
+        r1 = 8. / pixscale
+        k = int(np.ceil((r1 - r0) / dr)) + 10
+        r = (r0 + k * dr) * pixscale
+        expect = (0.5 * 0.0145 * moffat(r, 17.65, 1.7) +
+                  moffat(r, 0.8, 2.5)) * pixscale**2
+        self.assertTrue(np.isclose(prof[k], expect, rtol=1e-6))
+        self.assertTrue(r0 + (len(prof) - 2) * dr >= 500.)
+
+class TestHealpix(unittest.TestCase):
+    def test_radec_to_healpix(self):
+        import numpy as np
+        from legacypipe.ps1cat import radec_to_healpix
+
+        ra  = [0.3, 45., 123.4, 200., 359.9, 10.]
+        dec = [0.5, 60., -30., -75., 89., -89.]
+        # (from healpy.ang2pix)
+        self.assertTrue(list(radec_to_healpix(ra, dec, 32, 'ring')) ==
+                        [5952, 850, 9195, 12090, 3, 12284])
+        self.assertTrue(list(radec_to_healpix(ra, dec, 32, 'nested')) ==
+                        [4864, 819, 9941, 10286, 4095, 8192])
+
+class TestUbercal(unittest.TestCase):
+    def test_overlapping_boxes(self):
+        import numpy as np
+        from legacypipe.fit_on_coadds import overlapping_boxes
+
+        rng = np.random.RandomState(3)
+        n = 50
+        x0 = rng.randint(0, 1000, n)
+        y0 = rng.randint(0, 1000, n)
+        x1 = x0 + rng.randint(0, 300, n)
+        y1 = y0 + rng.randint(0, 300, n)
+        I,J = overlapping_boxes(x0, x1, y0, y1)
+        self.assertTrue(np.all(I < J))
+        brute = set((i,j) for i in range(n) for j in range(i+1, n)
+                    if x0[i] <= x1[j] and x0[j] <= x1[i] and
+                    y0[i] <= y1[j] and y0[j] <= y1[i])
+        self.assertTrue(set(zip(I.tolist(), J.tolist())) == brute)
+
+class TestUnwiseTiles(unittest.TestCase):
+    def test_split_merge(self):
+        import numpy as np
+        from astrometry.util.util import Tan
+        from astrometry.util.fits import fits_table
+        from tractor import PointSource, RaDecPos, NanoMaggies
+        from legacypipe.unwise import (plan_unwise_phot, merge_unwise_phot,
+                                       wphotduck)
+
+        W,H = 3600, 3600
+        pixscale = 0.262 / 3600.
+        wcs = Tan(100., 20., W/2.+0.5, H/2.+0.5, -pixscale, 0., 0., pixscale,
+                  float(W), float(H))
+        rng = np.random.RandomState(42)
+        N = 4000
+        x = rng.uniform(-10, W+10, N)
+        y = rng.uniform(-10, H+10, N)
+        ra,dec = wcs.pixelxy2radec(x+1, y+1)
+        wcat = [PointSource(RaDecPos(r, d), NanoMaggies(w=1.))
+                for r,d in zip(ra, dec)]
+        jobs = [((-1,band), (wcat, None, band, None, True, True, True,
+                             (wcs if band == 1 else None), None, True, None,
+                             'Full-depth W%i' % band))
+                for band in [1,2,3,4]]
+        runargs,splits = plan_unwise_phot(jobs, wcs, 8)
+        self.assertTrue(len(splits) == 4)
+        self.assertTrue(len(runargs) > len(jobs))
+        results = {}
+        for key,args in runargs:
+            # fake results: the flux is the source's index
+            ids = dict((id(src), i) for i,src in enumerate(wcat))
+            r = wphotduck()
+            r.phot = fits_table()
+            r.phot.flux_w1 = np.array([ids[id(src)] for src in args[0]], np.float32)
+            r.models = []
+            r.maskmap = None
+            if args[7] is not None:
+                r.maskmap = np.ones(args[7].shape, np.uint32)
+            results[key] = r
+        for key,parts in splits.items():
+            r = merge_unwise_phot(N, parts, results, maskshape=(H,W))
+            self.assertTrue(np.all(r.phot.flux_w1 == np.arange(N)))
+            if key == (-1,1):
+                self.assertTrue(np.all(r.maskmap == 1))
+
+class TestUnwiseCache(unittest.TestCase):
+    def test_stage_evict(self):
+        import os
+        import tempfile
+        from legacypipe import unwise_cache
+        from legacypipe.unwise_cache import UnwiseCache
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            srcdir = os.path.join(tempdir, 'unwise')
+            for tile in ['1000p000', '1010p000']:
+                d = os.path.join(srcdir, tile[:3], tile)
+                os.makedirs(d)
+                for fn in ['w1-img-m.fits', 'w1-n-m.fits.gz', 'w2-img-m.fits', 'msk.fits.gz']:
+                    with open(os.path.join(d, 'unwise-%s-%s' % (tile, fn)), 'wb') as f:
+                        f.write(b'x' * 1000)
+            cache = UnwiseCache(os.path.join(tempdir, 'cache'), maxsize=5000)
+            udir = cache.unwise_dir('/nonexistent:' + srcdir, '1000p000', 1)
+            base,rest = udir.split(':', 1)
+            self.assertEqual(rest, '/nonexistent:' + srcdir)
+            self.assertEqual(sorted(os.listdir(os.path.join(base, '100', '1000p000'))),
+                             ['.lock-w1', '.staged-w1', 'unwise-1000p000-msk.fits.gz',
+                              'unwise-1000p000-w1-img-m.fits',
+                              'unwise-1000p000-w1-n-m.fits.gz'])
+            self.assertEqual(cache.unwise_dir(srcdir, '1000p000', 1), udir.replace(
+                '/nonexistent:', ''))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            # Unknown tiles are read from the original directory
+            self.assertEqual(cache.unwise_dir(srcdir, '2000p000', 1), srcdir)
+            # Over the size limit: the least-recently-used entry goes,
+            # once it is past the grace period.
+            cache.unwise_dir(srcdir, '1010p000', 1)
+            cache.unwise_dir(srcdir, '1010p000', 2)
+            self.assertEqual(len(cache.entries()), 3)
+            marker = os.path.join(base, '100', '1000p000', '.staged-w1')
+            os.utime(marker, (0, 0))
+            unwise_cache.eviction_grace = 60.
+            try:
+                cache.evict()
+            finally:
+                unwise_cache.eviction_grace = 3600.
+            self.assertFalse(os.path.exists(marker))
+            self.assertFalse(os.path.exists(os.path.join(
+                base, '100', '1000p000', 'unwise-1000p000-w1-img-m.fits')))
+            self.assertEqual(sum(e[1] for e in cache.entries()), 4000)
+
+    def test_array(self):
+        import os
+        import tempfile
+        import numpy as np
+        from legacypipe.unwise_cache import UnwiseCache
+
+        calls = []
+        def compute():
+            calls.append(1)
+            return np.arange(100, dtype=np.float32).reshape(10,10)
+        with tempfile.TemporaryDirectory() as tempdir:
+            cachedir = os.path.join(tempdir, 'cache')
+            cache = UnwiseCache(cachedir, maxsize=1e6)
+            a = cache.array('psf-w1.npy', compute)
+            b = cache.array('psf-w1.npy', compute)
+            self.assertTrue(np.all(a == b))
+            self.assertEqual(len(calls), 1)
+            # Staged as a cache entry (counted towards the size limit),
+            # and no scratch files left behind
+            E = cache.entries()
+            self.assertEqual(len(E), 1)
+            self.assertTrue(E[0][1] >= a.nbytes)
+            self.assertEqual(sorted(os.listdir(cachedir)), ['.lock-evict', 'arrays'])
+
+class TestTelemetry(unittest.TestCase):
+    def test_events(self):
+        import os
+        import tempfile
+        from legacypipe.telemetry import Telemetry
+        from legacypipe.perf import read_events, stage_summary, compare_stages
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            fn = os.path.join(tempdir, 'tel.jsonl')
+            for brick in ['0001p000', '0002p000']:
+                tel = Telemetry(fn, brick, profile='cprofile')
+                with tel.stage('tims') as st:
+                    sum(range(100000))
+                    st.set_tims([1,2,3])
+                tel.finish()
+            # a truncated line, eg from a killed job
+            with open(fn, 'a') as f:
+                f.write('{"kind": "sta')
+            events = read_events([tempdir])
+        self.assertEqual(len(events), 4)
+        ev = events[0]
+        self.assertEqual(ev['stage'], 'tims')
+        self.assertEqual(ev['ntims'], 3)
+        self.assertTrue(ev['main']['cpu'] >= 0)
+        self.assertTrue(len(ev['profile']) > 0)
+        S = stage_summary(events)
+        self.assertEqual(S['tims']['nbricks'], 2)
+        [(stage, wr, cr, bad)] = compare_stages(S, S)
+        self.assertEqual(wr, 1.)
+        self.assertFalse(bad)
 
 if __name__ == '__main__':
     unittest.main()